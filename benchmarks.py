@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the Claude-on-OpenAI Proxy hot paths.
+
+These benchmarks run entirely offline - they import the proxy directly and
+never talk to a real API.
+
+Usage:
+  python benchmarks.py                   # Run all benchmarks
+  python benchmarks.py --only parse      # Run a single benchmark
+  python benchmarks.py --list            # List available benchmarks
+"""
+
+import os
+import json
+import time
+import argparse
+import asyncio
+from typing import Dict, Any, List, Callable
+
+# Don't fetch LiteLLM's model cost map from the network on import
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import server as proxy
+from tests import make_fake_chunk, FakeBackend, LocalProxy
+
+MODEL = "claude-3-sonnet-20240229"
+
+# ================= HELPERS =================
+
+def make_large_request(num_messages=200, tool_result_size=2000, stream=False) -> Dict[str, Any]:
+    """Build a Claude Code style request with a long tool_use/tool_result history."""
+    messages: List[Dict[str, Any]] = [{"role": "user", "content": "Please refactor the project."}]
+    for i in range((num_messages - 1) // 2):
+        tool_id = f"toolu_{i:024d}"
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"Let me look at file {i}."},
+            {"type": "tool_use", "id": tool_id, "name": "read_file", "input": {"path": f"src/module_{i}.py"}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": [
+                {"type": "text", "text": ("x = compute(y)  # line\n" * (tool_result_size // 22))[:tool_result_size]},
+            ]},
+        ]})
+    return {
+        "model": MODEL,
+        "max_tokens": 4096,
+        "stream": stream,
+        "system": [{"type": "text", "text": "You are a coding assistant."}],
+        "messages": messages,
+    }
+
+def make_tools(num_tools=18, num_properties=12) -> List[Dict[str, Any]]:
+    """Build Claude Code sized tool definitions with nested schemas."""
+    tools = []
+    for t in range(num_tools):
+        properties = {
+            f"param_{p}": {
+                "type": "object",
+                "description": f"Parameter {p} of tool {t}. " * 4,
+                "additionalProperties": False,
+                "properties": {
+                    "path": {"type": "string", "format": "uri", "default": "."},
+                    "items": {"type": "array", "items": {"type": "string", "format": "date-time"}},
+                    "mode": {"type": "string", "enum": ["a", "b", "c"]},
+                },
+            }
+            for p in range(num_properties)
+        }
+        tools.append({
+            "name": f"tool_{t}",
+            "description": f"Tool number {t}. " * 20,
+            "input_schema": {"type": "object", "properties": properties, "required": ["param_0"], "additionalProperties": False},
+        })
+    return tools
+
+def measure(fn: Callable[[], Any], iterations: int) -> float:
+    """Return the mean wall time of fn() in milliseconds."""
+    fn()  # Warm up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) * 1000 / iterations
+
+def report(name: str, results: Dict[str, float], unit="ms/op", higher_is_better=False):
+    """Print benchmark results relative to the first entry."""
+    print(f"\n--- {name} ---")
+    baseline = next(iter(results.values()))
+    for label, value in results.items():
+        if higher_is_better:
+            ratio = value / baseline if baseline else float("inf")
+        else:
+            ratio = baseline / value if value else float("inf")
+        print(f"{label:<40} {value:>10.3f} {unit}  ({ratio:.2f}x)")
+
+def measure_cpu(fn: Callable[[], int]) -> float:
+    """Return how many events fn() produces per CPU second."""
+    fn()  # Warm up
+    start = time.process_time()
+    events = fn()
+    return events / (time.process_time() - start)
+
+def fake_stream(chunks):
+    """Wrap a list of chunks in an async generator like LiteLLM's."""
+    async def generator():
+        for chunk in chunks:
+            yield chunk
+    return generator()
+
+def make_text_chunks(num_chunks=5000, chunk_text="ab "):
+    """Build a stream of small text deltas, like OpenAI or Gemini send."""
+    chunks = [make_fake_chunk(content=chunk_text) for _ in range(num_chunks)]
+    chunks.append(make_fake_chunk(finish_reason="stop"))
+    return chunks
+
+def run_handle_streaming(chunks, request_data=None) -> int:
+    """Drain handle_streaming over chunks and return the number of frames."""
+    request = proxy.MessagesRequest.model_validate(request_data or {**make_large_request(3), "stream": True})
+
+    async def drain():
+        return sum([1 async for _ in proxy.handle_streaming(fake_stream(chunks), request)])
+    return asyncio.run(drain())
+
+STUB_COMPLETION = json.dumps({
+    "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": "gpt-4.1",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+}).encode("utf-8")
+
+class StubUpstream:
+    """Minimal HTTP/1.1 keep-alive server answering every request with an OpenAI chat completion.
+
+    handshake_ms delays the first response on each new connection, standing
+    in for the TCP and TLS setup a real provider costs.
+    """
+
+    def __init__(self, handshake_ms=0.0, response_ms=0.0):
+        self.handshake_ms = handshake_ms
+        self.response_ms = response_ms
+        self.connections = 0
+        self.requests = 0
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/v1"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        if self.handshake_ms:
+            await asyncio.sleep(self.handshake_ms / 1000)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                self.requests += 1
+                if self.response_ms:
+                    await asyncio.sleep(self.response_ms / 1000)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\n"
+                    b"content-length: " + str(len(STUB_COMPLETION)).encode() + b"\r\n\r\n" + STUB_COMPLETION
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+# ================= BENCHMARKS =================
+
+def bench_parse(iterations=50):
+    """Request body decoding: the old double parse vs a single parse."""
+    body = json.dumps(make_large_request()).encode("utf-8")
+    print(f"Request body size: {len(body) / 1024:.0f} KB")
+
+    def double_parse():
+        request = proxy.MessagesRequest.model_validate(json.loads(body))
+        return request, json.loads(body.decode("utf-8")).get("model")
+
+    def single_parse_json():
+        request = proxy.MessagesRequest.model_validate(json.loads(body))
+        return request, request.original_model
+
+    results = {
+        "double parse (json)": measure(double_parse, iterations),
+        "single parse (json)": measure(single_parse_json, iterations),
+    }
+
+    if proxy.orjson is not None:
+        def single_parse_orjson():
+            request = proxy.MessagesRequest.model_validate(proxy.orjson.loads(body))
+            return request, request.original_model
+        results["single parse (orjson)"] = measure(single_parse_orjson, iterations)
+    else:
+        print("orjson not installed - skipping orjson variant")
+
+    report("Request parsing", results)
+
+def bench_sse(num_events=50000):
+    """SSE frame encoding: json.dumps f-strings vs pre-encoded byte templates."""
+    text = "Hello, wo"
+    partial_json = '{"path": "src/'
+
+    def legacy_frames():
+        for _ in range(num_events):
+            f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}})}\n\n".encode("utf-8")
+            f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 1, 'delta': {'type': 'input_json_delta', 'partial_json': partial_json}})}\n\n".encode("utf-8")
+            f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n".encode("utf-8")
+        return num_events * 3
+
+    def encoded_frames():
+        for _ in range(num_events):
+            proxy.sse_text_delta(0, text)
+            proxy.sse_input_json_delta(1, partial_json)
+            proxy.SSE_PING
+        return num_events * 3
+
+    report("SSE frame encoding", {
+        "json.dumps f-string": measure_cpu(legacy_frames),
+        "pre-encoded bytes": measure_cpu(encoded_frames),
+    }, unit="events/s", higher_is_better=True)
+
+    chunks = make_text_chunks()
+    report("handle_streaming (text deltas)", {
+        "handle_streaming": measure_cpu(lambda: run_handle_streaming(chunks)),
+    }, unit="events/s", higher_is_better=True)
+
+def bench_tools(iterations=200):
+    """Gemini tool conversion cost in convert_anthropic_to_litellm, with and without the tool cache."""
+    data = {"model": "gemini/gemini-2.0-flash", "max_tokens": 1024, "messages": [{"role": "user", "content": "hi"}], "tools": make_tools()}
+    request = proxy.MessagesRequest.model_validate(data)
+    results = {}
+    saved_cache = proxy.tool_cache
+    try:
+        proxy.tool_cache = proxy.LRUCache(0)
+        results["no cache"] = measure(lambda: proxy.convert_anthropic_to_litellm(request), iterations)
+        proxy.tool_cache = proxy.LRUCache(256)
+        results["warm cache"] = measure(lambda: proxy.convert_anthropic_to_litellm(request), iterations)
+        print(f"Cache stats: {proxy.tool_cache.stats()}")
+    finally:
+        proxy.tool_cache = saved_cache
+    report("Gemini tool conversion (18 tools)", results)
+
+def bench_conversation(num_messages=200):
+    """Translating a growing agentic session turn by turn, with and without the conversation cache."""
+    session = make_large_request(num_messages)
+    turns = [
+        proxy.MessagesRequest.model_validate({**session, "model": "openai/gpt-4.1", "messages": session["messages"][:n]})
+        for n in range(1, len(session["messages"]) + 1, 2)
+    ]
+
+    def run_session():
+        for request in turns:
+            proxy.convert_anthropic_to_litellm(request, flatten_for_openai=True)
+
+    results = {}
+    saved_cache = proxy.conversation_cache
+    try:
+        proxy.conversation_cache = proxy.ConversationCache(0, 0)
+        results["no cache"] = measure(run_session, 3)
+        # A fresh cache per session run, so the measurement covers the incremental path
+        def run_cached_session():
+            proxy.conversation_cache = proxy.ConversationCache(128, 64 * 1024 * 1024)
+            run_session()
+        results["conversation cache"] = measure(run_cached_session, 3)
+        print(f"Cache stats: {proxy.conversation_cache.stats()}")
+    finally:
+        proxy.conversation_cache = saved_cache
+    report(f"Session of {len(turns)} turns up to {num_messages} messages (per session)", results)
+
+def bench_translate(num_messages=200, iterations=50):
+    """Translating a 200 message history for each target, without the conversation cache."""
+    data = make_large_request(num_messages)
+    results = {}
+    saved_cache = proxy.conversation_cache
+    try:
+        proxy.conversation_cache = proxy.ConversationCache(0, 0)
+        for model, flatten_for_openai in (("anthropic/claude-3-sonnet-20240229", False), ("openai/gpt-4.1", True)):
+            request = proxy.MessagesRequest.model_validate({**data, "model": model})
+            results[model] = measure(lambda: proxy.convert_anthropic_to_litellm(request, flatten_for_openai, "text"), iterations)
+        results["openai/gpt-4.1 (native tool calls)"] = measure(
+            lambda: proxy.convert_anthropic_to_litellm(request, True, "native"), iterations
+        )
+        for tool_message_format in ("text", "native"):
+            messages = proxy.convert_anthropic_to_litellm(request, True, tool_message_format)["messages"]
+            print(f"Prompt size with {tool_message_format} tool messages: {len(json.dumps(messages)) / 1024:.0f} KB")
+    finally:
+        proxy.conversation_cache = saved_cache
+    report(f"Message translation ({num_messages} messages)", results)
+
+async def bench_upstream(bursts=40, burst_size=8, handshake_ms=20.0):
+    """Upstream call latency through LiteLLM against a local stub: LiteLLM's own client vs the pooled client."""
+    import litellm
+
+    stub = StubUpstream(handshake_ms=handshake_ms, response_ms=2.0)
+    await stub.start()
+    saved_key, saved_base = proxy.OPENAI_API_KEY, os.environ.get("OPENAI_API_BASE")
+    proxy.OPENAI_API_KEY = "sk-bench"
+    os.environ["OPENAI_API_BASE"] = stub.url
+    clients = proxy.UpstreamClients()
+    await clients.start()
+    try:
+        async def call(extra):
+            start = time.perf_counter()
+            await litellm.acompletion(
+                model="openai/gpt-4.1", messages=[{"role": "user", "content": "hi"}],
+                api_key="sk-bench", api_base=stub.url, **extra,
+            )
+            return (time.perf_counter() - start) * 1000
+
+        async def run_bursts(extra):
+            # Warm up, so both clients start with open connections
+            await asyncio.gather(*[call(extra) for _ in range(burst_size)])
+            latencies = []
+            connections = stub.connections
+            for _ in range(bursts):
+                latencies += await asyncio.gather(*[call(extra) for _ in range(burst_size)])
+                await asyncio.sleep(0.02)
+            return latencies, stub.connections - connections
+
+        results = {}
+        for label, extra in (("litellm client", {}), ("pooled client", {"client": clients.get("openai/gpt-4.1")})):
+            latencies, connections = await run_bursts(extra)
+            print(f"{label}: {connections} new connections for {len(latencies)} requests")
+            results[f"{label} p50"] = percentile(latencies, 50)
+            results[f"{label} p99"] = percentile(latencies, 99)
+    finally:
+        await clients.aclose()
+        await stub.stop()
+        proxy.OPENAI_API_KEY = saved_key
+        if saved_base is None:
+            os.environ.pop("OPENAI_API_BASE", None)
+        else:
+            os.environ["OPENAI_API_BASE"] = saved_base
+
+    print(f"\n--- Upstream latency ({bursts} bursts of {burst_size}, {handshake_ms:.0f} ms connection setup) ---")
+    for label, value in results.items():
+        print(f"{label:<40} {value:>10.3f} ms")
+
+def bench_count_tokens(num_messages=200, iterations=20):
+    """count_tokens on a long history: convert + litellm.token_counter vs the counting engine."""
+    import litellm
+
+    data = {**make_large_request(num_messages), "model": "openai/gpt-4.1", "tools": make_tools()}
+    data.pop("max_tokens"), data.pop("stream")
+    request = proxy.TokenCountRequest.model_validate(data)
+    # The same session one turn earlier, so the next count only has new messages
+    earlier = proxy.TokenCountRequest.model_validate({**data, "messages": data["messages"][:-2]})
+    print(f"Decoding and validating the request: {measure(lambda: proxy.TokenCountRequest.model_validate(json.loads(json.dumps(data))), iterations):.3f} ms/op")
+
+    def convert_and_count():
+        converted = proxy.convert_anthropic_to_litellm(proxy.MessagesRequest(
+            model=request.model, max_tokens=100, messages=request.messages, system=request.system,
+            tools=request.tools, tool_choice=request.tool_choice,
+        ))
+        return litellm.token_counter(model=converted["model"], messages=converted["messages"], tools=converted.get("tools"))
+
+    engine = proxy.TokenCounter(8192)
+
+    def engine_cold():
+        for cache in (engine.request_counts, engine.message_counts, engine.extra_counts):
+            cache.clear()
+        return engine.count(request)
+
+    def engine_next_turn():
+        engine.request_counts.clear()
+        engine.count(earlier)
+        start = time.perf_counter()
+        engine.count(request)
+        return time.perf_counter() - start
+
+    assert convert_and_count() == engine.count(request), "Token counts differ"
+    next_turn = sum(engine_next_turn() for _ in range(iterations)) * 1000 / iterations
+    report(f"count_tokens ({num_messages} messages, {len(data['tools'])} tools)", {
+        "convert + token_counter": measure(convert_and_count, iterations),
+        "engine (cold caches)": measure(engine_cold, iterations),
+        "engine (one new turn)": next_turn,
+        "engine (repeated request)": measure(lambda: engine.count(request), iterations * 10),
+    })
+
+def bench_response_cache(num_messages=200, iterations=200):
+    """Response cache lookup on a long history: key hashing plus a memory or disk hit."""
+    import tempfile
+
+    request = proxy.MessagesRequest.model_validate({**make_large_request(num_messages), "temperature": 0})
+    litellm_request = proxy.convert_anthropic_to_litellm(request)
+    record = proxy.completion_record_from_response(proxy.completion_record_to_response({
+        "text": "x" * 4000, "tool_calls": [], "finish_reason": "stop", "prompt_tokens": 100, "completion_tokens": 1000,
+    }))
+    key = proxy.ResponseCache.key_for(litellm_request)
+    with tempfile.TemporaryDirectory() as directory:
+        memory = proxy.ResponseCache(proxy.MemoryResponseStore(3600, 1024, 256 << 20))
+        disk = proxy.ResponseCache(proxy.DiskResponseStore(directory, 3600, 1024, 256 << 20))
+        for cache in (memory, disk):
+            asyncio.run(cache.put(key, record))
+            assert asyncio.run(cache.get(key)) == record, "Cache round trip failed"
+        report(f"response cache ({num_messages} messages)", {
+            "key": measure(lambda: proxy.ResponseCache.key_for(litellm_request), iterations),
+            "memory hit": measure(lambda: asyncio.run(memory.get(key)), iterations),
+            "disk hit": measure(lambda: asyncio.run(disk.get(key)), iterations),
+        })
+
+async def bench_admission(num_requests=120, small_share=0.25, max_concurrency=8, upstream_ms=50.0):
+    """Load test of the admission queue against a stub backend: latency by priority class and queue depth."""
+    import httpx
+
+    backend = FakeBackend(completion_delay=upstream_ms / 1000, chunk_delay=0)
+    saved_scheduler = proxy.admission_scheduler
+    results = {}
+    try:
+        async with LocalProxy(backend) as local:
+            small_every = max(1, round(1 / small_share))
+            models = [
+                "claude-3-haiku-20240307" if i % small_every == 0 else "claude-3-sonnet-20240229"
+                for i in range(num_requests)
+            ]
+            for label, small_first in (("fifo", False), ("small first", True)):
+                proxy.admission_scheduler = proxy.AdmissionScheduler(
+                    {"openai": {"max_concurrency": max_concurrency}},
+                    max_queue=num_requests, small_model_first=small_first,
+                )
+                limits = httpx.Limits(max_connections=num_requests)
+                async with httpx.AsyncClient(base_url=local.url, timeout=60, limits=limits) as client:
+                    async def call(model):
+                        data = {"model": model, "max_tokens": 100, "messages": [{"role": "user", "content": "Hello"}]}
+                        start = time.perf_counter()
+                        response = await client.post("/v1/messages", json=data)
+                        return model, response.status_code, (time.perf_counter() - start) * 1000
+
+                    calls = await asyncio.gather(*(call(model) for model in models))
+                assert all(status == 200 for _, status, _ in calls), "Requests failed"
+                stats = proxy.admission_scheduler.stats()["openai"]
+                print(f"{label}: max queue depth {stats['max_queue_depth']}, "
+                      f"mean queue wait {stats['wait_seconds'] * 1000 / num_requests:.1f} ms")
+                for size in ("haiku", "sonnet"):
+                    latencies = [ms for model, _, ms in calls if size in model]
+                    results[f"{label}: {size} p50"] = percentile(latencies, 50)
+                    results[f"{label}: {size} p95"] = percentile(latencies, 95)
+    finally:
+        proxy.admission_scheduler = saved_scheduler
+
+    print(f"\n--- Admission queue ({num_requests} requests, {max_concurrency} upstream slots, {upstream_ms:.0f} ms upstream) ---")
+    for label, value in results.items():
+        print(f"{label:<40} {value:>10.3f} ms")
+
+async def bench_hedging(num_requests=200, concurrency=20, stall_share=0.05, stall_ms=1000.0, upstream_ms=50.0):
+    """Small model latency with occasional upstream stalls: no hedging vs hedged requests."""
+    import httpx
+    import random
+
+    class StallingBackend(FakeBackend):
+        async def acompletion(self, **kwargs):
+            self.calls.append(kwargs)
+            stalled = random.random() < stall_share
+            await asyncio.sleep((stall_ms if stalled else upstream_ms * random.uniform(0.8, 1.2)) / 1000)
+            return proxy.completion_record_to_response({
+                "text": "Title", "tool_calls": [], "finish_reason": "stop", "prompt_tokens": 10, "completion_tokens": 2,
+            })
+
+    saved = (proxy.HEDGE_REQUESTS, proxy.upstream_latency)
+    results = {}
+    try:
+        for label, hedging in (("no hedging", False), ("hedged", True)):
+            random.seed(1)
+            backend = StallingBackend()
+            proxy.HEDGE_REQUESTS = hedging
+            proxy.upstream_latency = proxy.UpstreamLatency(percentile=95, default_delay=0.5, min_samples=20)
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=60) as client:
+                    data = {"model": "claude-3-haiku-20240307", "max_tokens": 50, "messages": [{"role": "user", "content": "Title?"}]}
+                    semaphore = asyncio.Semaphore(concurrency)
+
+                    async def call():
+                        async with semaphore:
+                            start = time.perf_counter()
+                            response = await client.post("/v1/messages", json=data)
+                            assert response.status_code == 200, response.text
+                            return (time.perf_counter() - start) * 1000
+
+                    latencies = await asyncio.gather(*(call() for _ in range(num_requests)))
+            extra = len(backend.calls) - num_requests
+            print(f"{label}: {extra} extra upstream calls ({extra * 100 / num_requests:.1f}%), "
+                  f"hedge delay {proxy.upstream_latency.hedge_delay(proxy.model_router.small_target) * 1000:.0f} ms")
+            for pct in (50, 95, 99):
+                results[f"{label} p{pct}"] = percentile(latencies, pct)
+    finally:
+        proxy.HEDGE_REQUESTS, proxy.upstream_latency = saved
+
+    print(f"\n--- Small model latency ({num_requests} requests, {stall_share:.0%} stall for {stall_ms:.0f} ms) ---")
+    for label, value in results.items():
+        print(f"{label:<40} {value:>10.3f} ms")
+
+def bench_metrics(iterations=20000):
+    """Per-request cost of the Prometheus instrumentation, and the stream wrappers' cost per chunk."""
+    labels = ("claude-3-sonnet-20240229", "openai/gpt-4.1", "openai")
+    response = {"usage": {"prompt_tokens": 100, "completion_tokens": 50}}
+
+    def record_request():
+        started = time.perf_counter()
+        proxy.translation_duration.observe(("request",) + labels, 0.0004)
+        proxy.observe_completion(labels, started, started, response)
+        proxy.translation_duration.observe(("response",) + labels, 0.0001)
+        proxy.observe_request("messages", labels, 200, started)
+
+    print(f"Metrics for one non-streaming request: {measure(record_request, iterations) * 1000:.2f} us")
+    samples = proxy.metrics.render().count("\n")
+    print(f"Rendering /metrics ({samples} lines): {measure(proxy.metrics.render, 100):.3f} ms")
+
+    chunks = make_text_chunks()
+    request = proxy.MessagesRequest.model_validate({**make_large_request(3), "stream": True})
+
+    def timed_stream() -> int:
+        async def drain():
+            timer = proxy.StreamTimer(labels, time.perf_counter())
+            stream = timer.client(proxy.handle_streaming(timer.upstream(fake_stream(chunks)), request))
+            return sum([1 async for _ in stream])
+        return asyncio.run(drain())
+
+    report("handle_streaming with stream metrics", {
+        "handle_streaming": measure_cpu(lambda: run_handle_streaming(chunks)),
+        "with StreamTimer": measure_cpu(timed_stream),
+    }, unit="events/s", higher_is_better=True)
+
+def bench_logging(iterations=1000, write_ms=0.1):
+    """Logging cost per request on the event loop: the old print() lines, logging off, inline handlers and the queued writer."""
+    import logging
+
+    class SlowStream:
+        """A busy terminal or pipe that takes write_ms per write."""
+        def write(self, text):
+            time.sleep(write_ms / 1000)
+
+        def flush(self):
+            pass
+
+    request = proxy.MessagesRequest.model_validate(make_large_request(3))
+    root = logging.getLogger()
+    queued_handlers = list(root.handlers)
+    inline_handlers = [proxy.log_handler, proxy.request_log_handler]
+    streams = (proxy.log_handler.stream, proxy.request_log_handler.stream)
+
+    def log_request():
+        proxy.logger.debug("📊 PROCESSING REQUEST: Model=%s, Stream=%s", request.model, request.stream)
+        proxy.logger.debug("Using OpenAI API key for model: %s", request.model)
+        proxy.log_request_beautifully("POST", "/v1/messages", MODEL, request.model, len(request.messages), 0, 200)
+        proxy.logger.debug("✅ RESPONSE RECEIVED: Model=%s, Time=%.2fs", request.model, 0.5)
+
+    def print_request(stream):
+        # How requests were logged before: eager f-strings, and print() on the event loop
+        def log():
+            proxy.logger.debug(f"📊 PROCESSING REQUEST: Model={request.model}, Stream={request.stream}")
+            proxy.logger.debug(f"Using OpenAI API key for model: {request.model}")
+            record = logging.makeLogRecord({
+                "method": "POST", "path": "/v1/messages", "original_model": MODEL, "mapped_model": request.model,
+                "messages": len(request.messages), "tools": 0, "status_code": 200,
+            })
+            log_line, model_line = proxy.RequestLineFormatter().format(record).split("\n")
+            print(log_line, file=stream)
+            print(model_line, file=stream)
+            stream.flush()
+            proxy.logger.debug(f"✅ RESPONSE RECEIVED: Model={request.model}, Time={0.5:.2f}s")
+        return log
+
+    def run(log, stream, handlers=queued_handlers, level=logging.WARNING, request_level=logging.INFO):
+        """Microseconds per request to log with these handlers and levels."""
+        proxy.log_handler.setStream(stream)
+        proxy.request_log_handler.setStream(stream)
+        root.handlers = handlers
+        root.setLevel(level)
+        proxy.request_logger.setLevel(request_level)
+        try:
+            elapsed = measure(log, iterations) * 1000
+            if proxy.log_listener is not None:
+                # Let the writer catch up before the next run
+                proxy.log_listener.queue.join()
+            return elapsed
+        finally:
+            root.handlers = queued_handlers
+            root.setLevel(logging.WARNING)
+            proxy.request_logger.setLevel(logging.INFO)
+            proxy.log_handler.setStream(streams[0])
+            proxy.request_log_handler.setStream(streams[1])
+
+    with open(os.devnull, "w") as devnull:
+        for sink, stream in (("/dev/null", devnull), (f"a {write_ms} ms/write terminal", SlowStream())):
+            report(f"Logging per request, writing to {sink}", {
+                "print() lines (before)": run(print_request(stream), stream),
+                "logging off": run(log_request, stream, request_level=logging.WARNING),
+                "inline handlers": run(log_request, stream, handlers=inline_handlers),
+                "queued writer": run(log_request, stream),
+                "queued writer, DEBUG": run(log_request, stream, level=logging.DEBUG),
+            }, unit="us/request")
+
+async def bench_load(duration=5.0, concurrency=8):
+    """Throughput, latency and proxy CPU/RSS under load, end to end against a mock upstream (see loadgen.py)."""
+    import loadgen
+
+    report = await loadgen.run_load(loadgen.LoadConfig(concurrency=concurrency, duration=duration, warmup=2.0))
+    loadgen.print_report(report)
+
+async def bench_passthrough(duration=5.0, concurrency=8):
+    """anthropic/ models through the Anthropic passthrough against translation through LiteLLM, end to end against a mock upstream."""
+    import loadgen
+
+    results = {}
+    for label, enabled in (("translated through LiteLLM", "false"), ("passthrough", "true")):
+        config = loadgen.LoadConfig(provider="anthropic", concurrency=concurrency, duration=duration, warmup=2.0,
+                                    mix="messages=1,stream=1", proxy_env={"ANTHROPIC_PASSTHROUGH": enabled})
+        results[label] = await loadgen.run_load(config)
+    report("Proxy CPU per request", {label: run["proxy"]["cpu_ms_per_request"] for label, run in results.items()}, unit="ms/request")
+    report("Throughput", {label: run["requests_per_second"] for label, run in results.items()}, unit="req/s", higher_is_better=True)
+    report("Stream time to first byte, p50", {label: run["routes"]["stream"]["first_byte_ms"]["p50"] for label, run in results.items()}, unit="ms")
+
+async def bench_native_streaming(duration=5.0, concurrency=8, output_tokens=400):
+    """openai/ streams through the native adapter against LiteLLM's chunk objects: proxy CPU per upstream chunk, end to end against a mock upstream."""
+    import loadgen
+
+    # One token per chunk, and no tool calls, so each stream has output_tokens + 3 chunks
+    chunks = output_tokens + 3
+    results = {}
+    for label, enabled in (("LiteLLM chunks", "false"), ("native adapter", "true")):
+        mock = loadgen.MockSettings(output_tokens=output_tokens, chunk_tokens=1, first_token_ms=0, tool_share=0.0)
+        config = loadgen.LoadConfig(concurrency=concurrency, duration=duration, warmup=2.0, mix="stream=1", mock=mock,
+                                    proxy_env={"OPENAI_NATIVE_STREAMING": enabled})
+        results[label] = await loadgen.run_load(config)
+    report("Proxy CPU per upstream chunk", {label: run["proxy"]["cpu_ms_per_request"] * 1000 / chunks for label, run in results.items()}, unit="us/chunk")
+    report("Throughput", {label: run["requests_per_second"] for label, run in results.items()}, unit="req/s", higher_is_better=True)
+    report("Stream latency, p50", {label: run["routes"]["stream"]["latency_ms"]["p50"] for label, run in results.items()}, unit="ms")
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "sse": bench_sse,
+    "tools": bench_tools,
+    "conversation": bench_conversation,
+    "translate": bench_translate,
+    "upstream": bench_upstream,
+    "count_tokens": bench_count_tokens,
+    "response_cache": bench_response_cache,
+    "admission": bench_admission,
+    "hedging": bench_hedging,
+    "metrics": bench_metrics,
+    "logging": bench_logging,
+    "load": bench_load,
+    "passthrough": bench_passthrough,
+    "native_streaming": bench_native_streaming,
+}
+
+# ================= MAIN =================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Claude-on-OpenAI proxy")
+    parser.add_argument("--only", choices=sorted(BENCHMARKS), help="Run a single benchmark")
+    parser.add_argument("--list", action="store_true", help="List available benchmarks")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, bench in BENCHMARKS.items():
+            print(f"{name}: {bench.__doc__}")
+        return
+
+    for name, bench in BENCHMARKS.items():
+        if args.only and name != args.only:
+            continue
+        print(f"\n{'='*20} BENCHMARK: {name} {'='*20}")
+        result = bench()
+        if asyncio.iscoroutine(result):
+            asyncio.run(result)
+
+if __name__ == "__main__":
+    main()
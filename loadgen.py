@@ -0,0 +1,884 @@
+#!/usr/bin/env python3
+"""
+Offline load generator for the Claude-on-OpenAI Proxy.
+
+Starts a mock OpenAI-, Gemini- and Anthropic-compatible upstream, runs the proxy as a
+uvicorn subprocess pointed at it, and drives /v1/messages (streaming and
+non-streaming) and /v1/messages/count_tokens at a fixed concurrency. Reports
+requests per second, time to first byte, p50/p95/p99 latency, and CPU and
+RSS for each proxy worker process. No API keys or network access are needed.
+
+Results can be saved as a JSON baseline and later runs compared against it,
+so regressions show up as a failing exit status.
+
+Usage:
+  python loadgen.py                                   # 20 s at concurrency 16, mock OpenAI upstream
+  python loadgen.py --provider gemini --mix stream=1  # Only streams, through the Gemini API
+  python loadgen.py --provider anthropic --proxy-env ANTHROPIC_PASSTHROUGH=true  # Anthropic API, relayed as is
+  python loadgen.py --tokens-per-second 80 --chunk-tokens 4 --tool-share 0.3 --error-rate 0.02
+  python loadgen.py --proxy-env RESPONSE_CACHE=memory --proxy-env SINGLE_FLIGHT_ROUTES=messages
+  python loadgen.py --workers 4 --proxy-env SHARED_STORE=shm  # Four workers sharing state in /dev/shm
+  python loadgen.py --workers 4 --proxy-env SHARED_STORE=redis  # ...or in a stand-in Redis server
+  python loadgen.py --save loadgen_baseline.json      # Write the results as a baseline
+  python loadgen.py --baseline loadgen_baseline.json  # Compare against a baseline
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import fnmatch
+import argparse
+import asyncio
+import tempfile
+import threading
+import subprocess
+import socketserver
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Any, List, Optional
+
+import httpx
+
+# ================= MOCK UPSTREAM =================
+
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do")
+
+@dataclass
+class MockSettings:
+    """How the mock upstream answers."""
+    output_tokens: int = 200          # Tokens in each response (capped by the request's max_tokens)
+    chunk_tokens: int = 5             # Tokens per streamed chunk
+    tokens_per_second: float = 0.0    # Generation speed; 0 streams as fast as possible
+    first_token_ms: float = 50.0      # Delay before the first token
+    tool_share: float = 0.2           # Share of requests with tools that are answered with a tool call
+    error_rate: float = 0.0           # Share of requests answered with error_status
+    error_status: int = 503
+    disconnect_rate: float = 0.0      # Share of streams cut off halfway through
+    seed: int = 0
+
+class MockUpstream:
+    """HTTP/1.1 keep-alive server that mimics the OpenAI, Gemini and Anthropic generation APIs.
+
+    Serves POST /v1/chat/completions (OpenAI), POST
+    /v1beta/models/<model>:generateContent or :streamGenerateContent
+    (Gemini) and POST /v1/messages (Anthropic). Responses are made of filler
+    words, one token each, paced by the settings; streams are sent as SSE
+    with chunked transfer encoding. Anthropic responses report half of the
+    prompt as read from the prompt cache.
+    """
+
+    def __init__(self, settings: Optional[MockSettings] = None):
+        self.settings = settings or MockSettings()
+        self.random = random.Random(self.settings.seed)
+        self.server = None
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0  # Streams the client closed before the end
+        self.last_headers: Dict[str, str] = {}
+        self.last_body: Dict[str, Any] = {}
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    @property
+    def openai_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    @property
+    def gemini_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1beta"
+
+    @property
+    def anthropic_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                path = request_line.split(" ")[1]
+                headers = dict(line.split(":", 1) for line in header_lines if ":" in line)
+                headers = {name.strip().lower(): value.strip() for name, value in headers.items()}
+                length = int(headers.get("content-length", 0))
+                body = json.loads(await reader.readexactly(length)) if length else {}
+                self.requests += 1
+                self.last_headers, self.last_body = headers, body
+                if not await self.respond(writer, path, body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, path: str, body: Dict[str, Any]) -> bool:
+        """Answer one request, returning False if the connection was cut off."""
+        settings = self.settings
+        if path.startswith("/v1/chat/completions"):
+            api = "openai"
+        elif path.startswith("/v1beta/models/"):
+            api = "gemini"
+        elif path.startswith("/v1/messages"):
+            api = "anthropic"
+        else:
+            self.write_json(writer, 404, {"error": {"message": f"No mock for {path}"}})
+            await writer.drain()
+            return True
+
+        if self.random.random() < settings.error_rate:
+            self.errors += 1
+            await asyncio.sleep(settings.first_token_ms / 1000)
+            self.write_json(writer, settings.error_status, self.error_body(api, settings.error_status))
+            await writer.drain()
+            return True
+
+        if api == "openai":
+            max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or settings.output_tokens
+            stream = bool(body.get("stream"))
+            tools = [tool["function"]["name"] for tool in body.get("tools") or []]
+            prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        elif api == "anthropic":
+            max_tokens = body.get("max_tokens") or settings.output_tokens
+            stream = bool(body.get("stream"))
+            tools = [tool["name"] for tool in body.get("tools") or []]
+            prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        else:
+            # The API takes both camelCase and snake_case field names
+            generation_config = body.get("generationConfig") or body.get("generation_config") or {}
+            max_tokens = generation_config.get("maxOutputTokens") or generation_config.get("max_output_tokens") or settings.output_tokens
+            stream = "streamGenerateContent" in path
+            tools = [
+                declaration["name"] for tool in body.get("tools") or []
+                for declaration in tool.get("functionDeclarations") or tool.get("function_declarations") or []
+            ]
+            prompt_tokens = len(json.dumps(body.get("contents", []))) // 4
+        output_tokens = min(settings.output_tokens, max_tokens)
+        tool_name = tools[0] if tools and self.random.random() < settings.tool_share else None
+        model = body.get("model") or path.split("/models/", 1)[-1].split(":", 1)[0]
+
+        await asyncio.sleep(settings.first_token_ms / 1000)
+        if not stream:
+            if settings.tokens_per_second:
+                await asyncio.sleep(output_tokens / settings.tokens_per_second)
+            text = " ".join(WORDS[i % len(WORDS)] for i in range(output_tokens))
+            builder = {"openai": self.openai_response, "gemini": self.gemini_response, "anthropic": self.anthropic_response}[api]
+            self.write_json(writer, 200, builder(model, text, tool_name, prompt_tokens, output_tokens))
+            await writer.drain()
+            return True
+
+        writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\ntransfer-encoding: chunked\r\n\r\n")
+        cut_off = self.random.random() < settings.disconnect_rate
+        events = {"openai": self.openai_stream, "gemini": self.gemini_stream, "anthropic": self.anthropic_stream}[api]
+        chunk_delay = settings.chunk_tokens / settings.tokens_per_second if settings.tokens_per_second else 0
+        chunks = list(events(model, tool_name, prompt_tokens, output_tokens))
+        for index, event in enumerate(chunks):
+            if cut_off and index >= len(chunks) // 2:
+                self.errors += 1
+                writer.transport.abort()
+                return False
+            if index and chunk_delay:
+                await asyncio.sleep(chunk_delay)
+            if writer.is_closing():
+                self.cancelled += 1  # The proxy closed the stream early
+                return False
+            # Anthropic events come with their event lines
+            frame = (event if api == "anthropic" else f"data: {event}\n\n").encode("utf-8")
+            writer.write(f"{len(frame):x}\r\n".encode("ascii") + frame + b"\r\n")
+            try:
+                await writer.drain()
+            except ConnectionError:
+                self.cancelled += 1
+                return False
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
+
+    @staticmethod
+    def write_json(writer, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} Mock\r\ncontent-type: application/json\r\ncontent-length: {len(body)}\r\n\r\n".encode("ascii") + body
+        )
+
+    @staticmethod
+    def error_body(api: str, status: int) -> Dict[str, Any]:
+        if api == "openai":
+            return {"error": {"message": "Injected mock upstream error", "type": "server_error", "code": status}}
+        if api == "anthropic":
+            return {"type": "error", "error": {"type": "overloaded_error" if status == 529 else "api_error", "message": "Injected mock upstream error"}}
+        return {"error": {"code": status, "message": "Injected mock upstream error", "status": "UNAVAILABLE"}}
+
+    def text_pieces(self, output_tokens: int):
+        """The response text, chunk_tokens words at a time."""
+        step = max(1, self.settings.chunk_tokens)
+        for start in range(0, output_tokens, step):
+            yield "".join(f"{WORDS[i % len(WORDS)]} " for i in range(start, min(start + step, output_tokens)))
+
+    @staticmethod
+    def openai_response(model, text, tool_name, prompt_tokens, output_tokens):
+        message = {"role": "assistant", "content": text}
+        if tool_name:
+            message["tool_calls"] = [{
+                "id": "call_mock", "type": "function",
+                "function": {"name": tool_name, "arguments": json.dumps({"query": text[:40]})},
+            }]
+        return {
+            "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_name else "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens},
+        }
+
+    def openai_stream(self, model, tool_name, prompt_tokens, output_tokens):
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": 0, "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+        yield chunk({"role": "assistant", "content": ""})
+        for piece in self.text_pieces(output_tokens):
+            yield chunk({"content": piece})
+        if tool_name:
+            yield chunk({"tool_calls": [{"index": 0, "id": "call_mock", "type": "function", "function": {"name": tool_name, "arguments": ""}}]})
+            for piece in ('{"query": ', '"lorem ipsum', ' dolor"}'):
+                yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": piece}}]})
+        yield chunk({}, "tool_calls" if tool_name else "stop")
+        yield json.dumps({
+            "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": 0, "model": model, "choices": [],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens},
+        })
+        yield "[DONE]"
+
+    @staticmethod
+    def gemini_response(model, text, tool_name, prompt_tokens, output_tokens):
+        parts = [{"text": text}]
+        if tool_name:
+            parts.append({"functionCall": {"name": tool_name, "args": {"query": text[:40]}}})
+        return {
+            "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens, "totalTokenCount": prompt_tokens + output_tokens},
+            "modelVersion": model,
+        }
+
+    def gemini_stream(self, model, tool_name, prompt_tokens, output_tokens):
+        pieces = list(self.text_pieces(output_tokens))
+        for index, piece in enumerate(pieces):
+            parts = [{"text": piece}]
+            candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+            event = {"candidates": [candidate], "modelVersion": model}
+            if index == len(pieces) - 1:
+                if tool_name:
+                    parts.append({"functionCall": {"name": tool_name, "args": {"query": "lorem ipsum dolor"}}})
+                candidate["finishReason"] = "STOP"
+                event["usageMetadata"] = {
+                    "promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                    "totalTokenCount": prompt_tokens + output_tokens,
+                }
+            yield json.dumps(event)
+
+    @staticmethod
+    def anthropic_usage(prompt_tokens, output_tokens):
+        cached = prompt_tokens // 2
+        return {
+            "input_tokens": prompt_tokens - cached, "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": cached, "output_tokens": output_tokens,
+        }
+
+    @staticmethod
+    def anthropic_response(model, text, tool_name, prompt_tokens, output_tokens):
+        content = [{"type": "text", "text": text}]
+        if tool_name:
+            content.append({"type": "tool_use", "id": "toolu_mock", "name": tool_name, "input": {"query": text[:40]}})
+        return {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": model, "content": content,
+            "stop_reason": "tool_use" if tool_name else "end_turn", "stop_sequence": None,
+            "usage": MockUpstream.anthropic_usage(prompt_tokens, output_tokens),
+        }
+
+    def anthropic_stream(self, model, tool_name, prompt_tokens, output_tokens):
+        def event(data):
+            return f"event: {data['type']}\ndata: {json.dumps(data)}\n\n"
+        message = {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": model, "content": [],
+            "stop_reason": None, "stop_sequence": None, "usage": self.anthropic_usage(prompt_tokens, 1),
+        }
+        yield event({"type": "message_start", "message": message})
+        yield event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        yield event({"type": "ping"})
+        for piece in self.text_pieces(output_tokens):
+            yield event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}})
+        yield event({"type": "content_block_stop", "index": 0})
+        if tool_name:
+            block = {"type": "tool_use", "id": "toolu_mock", "name": tool_name, "input": {}}
+            yield event({"type": "content_block_start", "index": 1, "content_block": block})
+            for piece in ('{"query": ', '"lorem ipsum', ' dolor"}'):
+                yield event({"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": piece}})
+            yield event({"type": "content_block_stop", "index": 1})
+        delta = {"stop_reason": "tool_use" if tool_name else "end_turn", "stop_sequence": None}
+        yield event({"type": "message_delta", "delta": delta, "usage": {"output_tokens": output_tokens}})
+        yield event({"type": "message_stop"})
+
+# ================= MOCK SHARED STORE =================
+
+class MockRedis:
+    """A stand-in for a Redis server, for the proxy's SHARED_STORE=redis without installing one.
+
+    Speaks RESP on a local port, one thread per connection, and implements
+    the commands the proxy uses: GET, SET (with PX and NX), INCRBYFLOAT, DEL
+    and SCAN, plus PING, AUTH and SELECT, which are accepted and ignored.
+    """
+
+    def __init__(self):
+        self.data = {}  # key -> (expiry time or None, value)
+        self.lock = threading.Lock()
+        self.commands = 0
+        store = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                while True:
+                    try:
+                        command = store.read_command(self.rfile)
+                    except (ValueError, ConnectionError):
+                        return
+                    if command is None:
+                        return
+                    self.wfile.write(store.execute(command))
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.server.server_address[1]}/0"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def read_command(rfile) -> Optional[List[bytes]]:
+        line = rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()  # Inline command
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(rfile.readline()[1:])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def reply(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(MockRedis.reply(item) for item in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def live(self, key: bytes) -> Optional[bytes]:
+        entry = self.data.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.time():
+            del self.data[key]
+            return None
+        return entry[1] if entry is not None else None
+
+    def execute(self, args: List[bytes]) -> bytes:
+        name = args[0].upper()
+        with self.lock:
+            self.commands += 1
+            if name == b"PING":
+                return b"+PONG\r\n"
+            if name in (b"AUTH", b"SELECT"):
+                return b"+OK\r\n"
+            if name == b"GET":
+                return self.reply(self.live(args[1]))
+            if name == b"SET":
+                options = [arg.upper() for arg in args[3:]]
+                if b"NX" in options and self.live(args[1]) is not None:
+                    return self.reply(None)
+                expiry = None
+                if b"PX" in options:
+                    expiry = time.time() + int(args[3 + options.index(b"PX") + 1]) / 1000
+                self.data[args[1]] = (expiry, args[2])
+                return b"+OK\r\n"
+            if name == b"INCRBYFLOAT":
+                current = self.live(args[1])
+                total = float(current or 0) + float(args[2])
+                expiry = self.data[args[1]][0] if current is not None else None
+                value = repr(total).encode("ascii")
+                self.data[args[1]] = (expiry, value)
+                return self.reply(value)
+            if name == b"DEL":
+                return self.reply(sum(self.data.pop(key, None) is not None for key in args[1:]))
+            if name == b"SCAN":
+                options = [arg.upper() for arg in args[2:]]
+                pattern = args[2 + options.index(b"MATCH") + 1].decode("utf-8") if b"MATCH" in options else "*"
+                keys = [key for key in list(self.data) if self.live(key) is not None
+                        and fnmatch.fnmatchcase(key.decode("utf-8"), pattern)]
+                return self.reply([b"0", keys])
+            return b"-ERR unknown command '%s'\r\n" % args[0]
+
+# ================= PROXY PROCESS =================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def child_pids(pid: int) -> List[int]:
+    """Direct children of pid, from /proc."""
+    children = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                children.append(int(entry))
+    return children
+
+def process_stats(pid: int) -> Optional[Dict[str, float]]:
+    """CPU seconds used so far, and current and peak RSS in MB, from /proc. None off Linux or once it exited."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_mb": int(status["VmRSS"].split()[0]) / 1024,
+        "peak_rss_mb": int(status["VmHWM"].split()[0]) / 1024,
+    }
+
+class ProxyProcess:
+    """The proxy under uvicorn in a subprocess, with its upstreams pointed at a mock."""
+
+    def __init__(self, upstream: MockUpstream, provider: str = "openai", workers: int = 1,
+                 env: Optional[Dict[str, str]] = None, verbose: bool = False):
+        self.upstream = upstream
+        self.provider = provider
+        self.workers = workers
+        self.extra_env = env or {}
+        self.verbose = verbose
+        self.port = free_port()
+        self.process = None
+        self.routes_file = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def environment(self) -> Dict[str, str]:
+        env = {
+            **os.environ,
+            "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+            "OPENAI_API_KEY": "sk-loadgen",
+            "OPENAI_API_BASE": self.upstream.openai_url,
+            "GEMINI_API_KEY": "loadgen",
+            "GEMINI_API_BASE": self.upstream.gemini_url,
+            "ANTHROPIC_API_KEY": "loadgen",
+            "ANTHROPIC_API_BASE": self.upstream.anthropic_url,
+        }
+        if self.provider == "gemini":
+            env.update({"PREFERRED_PROVIDER": "google", "BIG_MODEL": "gemini-2.0-flash", "SMALL_MODEL": "gemini-2.0-flash"})
+        elif self.provider == "anthropic":
+            # Claude models only reach the Anthropic API through a routing rule
+            env["MODEL_ROUTES_FILE"] = self.routes_file
+        else:
+            env.update({"PREFERRED_PROVIDER": "openai", "BIG_MODEL": "gpt-4.1", "SMALL_MODEL": "gpt-4.1-mini"})
+        env.update(self.extra_env)
+        return env
+
+    async def start(self, timeout: float = 120.0):
+        if self.provider == "anthropic":
+            fd, self.routes_file = tempfile.mkstemp(prefix="loadgen-routes-", suffix=".json")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"routes": [{"pattern": "*", "model": "anthropic/claude-sonnet-4-20250514"}]}, f)
+        command = [
+            sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(self.port),
+            "--log-level", "error", "--workers", str(self.workers),
+        ]
+        output = None if self.verbose else subprocess.DEVNULL
+        self.process = subprocess.Popen(
+            command, cwd=os.path.dirname(os.path.abspath(__file__)), env=self.environment(), stdout=output, stderr=output,
+        )
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient(timeout=1.0) as client:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Proxy exited with status {self.process.returncode} (rerun with --verbose)")
+                try:
+                    if (await client.get(f"{self.url}/")).status_code == 200:
+                        return
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"Proxy didn't start within {timeout:.0f}s")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.routes_file is not None:
+            os.unlink(self.routes_file)
+            self.routes_file = None
+
+    def worker_pids(self) -> List[int]:
+        """The processes serving requests: uvicorn's workers, or the proxy itself with one worker."""
+        if self.workers <= 1:
+            return [self.process.pid]
+        workers = []
+        for pid in child_pids(self.process.pid):
+            try:
+                with open(f"/proc/{pid}/cmdline", "rb") as f:
+                    if b"resource_tracker" in f.read():
+                        continue
+            except OSError:
+                continue
+            workers.append(pid)
+        return workers
+
+    def stats(self) -> Dict[int, Dict[str, float]]:
+        pids = self.worker_pids() if os.path.isdir("/proc") else []
+        return {pid: stats for pid in pids if (stats := process_stats(pid)) is not None}
+
+# ================= LOAD =================
+
+ROUTES = ("messages", "stream", "count_tokens")
+
+TOOLS = [
+    {
+        "name": name,
+        "description": f"Mock {name} tool",
+        "input_schema": {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]},
+    }
+    for name in ("search_files", "read_file", "run_command")
+]
+
+def make_request(num_messages: int, max_tokens: int, with_tools: bool) -> Dict[str, Any]:
+    """A Claude Code style request: a system prompt, a tool_use/tool_result history and tools."""
+    messages = [{"role": "user", "content": "Please look into the failing build."}]
+    for i in range((num_messages - 1) // 2):
+        tool_id = f"toolu_{i:024d}"
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"Checking step {i}."},
+            {"type": "tool_use", "id": tool_id, "name": "read_file", "input": {"query": f"src/module_{i}.py"}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": "def handler():\n    return 42\n" * 20},
+        ]})
+    request = {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": max_tokens,
+        "system": "You are a helpful coding assistant.",
+        "messages": messages,
+    }
+    if with_tools:
+        request["tools"] = TOOLS
+    return request
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parse "messages=0.4,stream=0.4,count_tokens=0.2" into route weights."""
+    weights = {}
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        route = route.strip()
+        if route not in ROUTES:
+            raise ValueError(f"Unknown route '{route}' in mix, expected one of {', '.join(ROUTES)}")
+        weights[route] = float(weight or 1)
+    return weights
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99)}
+
+@dataclass
+class LoadConfig:
+    provider: str = "openai"
+    concurrency: int = 16
+    duration: float = 20.0
+    warmup: float = 3.0
+    mix: str = "messages=0.4,stream=0.4,count_tokens=0.2"
+    messages: int = 11
+    workers: int = 1
+    mock: MockSettings = field(default_factory=MockSettings)
+    proxy_env: Dict[str, str] = field(default_factory=dict)
+
+@dataclass
+class RouteResults:
+    latencies: List[float] = field(default_factory=list)
+    first_bytes: List[float] = field(default_factory=list)
+    errors: Dict[str, int] = field(default_factory=dict)
+
+async def send(client: httpx.AsyncClient, route: str, body: Dict[str, Any]):
+    """Send one request, returning (status, time to first byte in ms, latency in ms)."""
+    start = time.perf_counter()
+    first_byte = None
+    if route == "stream":
+        frames = []
+        async with client.stream("POST", "/v1/messages", json={**body, "stream": True}) as response:
+            async for data in response.aiter_raw():
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                frames.append(data)
+            status = response.status_code
+        # Upstream failures after the stream started end it with an error stop reason
+        if status == 200 and b'"stop_reason": "error"' in b"".join(frames):
+            status = "stream error"
+    elif route == "count_tokens":
+        response = await client.post("/v1/messages/count_tokens", json={key: body[key] for key in ("model", "system", "messages", "tools") if key in body})
+        status = response.status_code
+    else:
+        response = await client.post("/v1/messages", json=body)
+        status = response.status_code
+    end = time.perf_counter()
+    return status, ((first_byte or end) - start) * 1000, (end - start) * 1000
+
+async def run_load(config: LoadConfig, verbose: bool = False) -> Dict[str, Any]:
+    """Start the mock upstream and the proxy, run the load, and return the results."""
+    weights = parse_mix(config.mix)
+    routes, cumulative = list(weights), []
+    total = 0.0
+    for route in routes:
+        total += weights[route]
+        cumulative.append(total)
+    chooser = random.Random(config.mock.seed)
+    bodies = [make_request(config.messages, config.mock.output_tokens, with_tools) for with_tools in (True, False)]
+
+    upstream = MockUpstream(config.mock)
+    await upstream.start()
+    proxy_env = dict(config.proxy_env)
+    redis = None
+    if proxy_env.get("SHARED_STORE") == "redis" and "SHARED_STORE_URL" not in proxy_env:
+        redis = MockRedis()
+        redis.start()
+        proxy_env["SHARED_STORE_URL"] = redis.url
+    proxy = ProxyProcess(upstream, config.provider, config.workers, proxy_env, verbose)
+    try:
+        await proxy.start()
+        results = {route: RouteResults() for route in routes}
+        measuring = False
+        limits = httpx.Limits(max_connections=config.concurrency, max_keepalive_connections=config.concurrency)
+        async with httpx.AsyncClient(base_url=proxy.url, timeout=120.0, limits=limits) as client:
+            async def worker(stop_at: float):
+                while time.monotonic() < stop_at:
+                    route = routes[next(i for i, bound in enumerate(cumulative) if chooser.random() * total < bound)]
+                    body = bodies[0] if chooser.random() < 0.5 else bodies[1]
+                    try:
+                        status, first_byte, latency = await send(client, route, body)
+                    except httpx.HTTPError as e:
+                        status, first_byte, latency = type(e).__name__, 0.0, 0.0
+                    if not measuring:
+                        continue
+                    route_results = results[route]
+                    if status == 200:
+                        route_results.latencies.append(latency)
+                        route_results.first_bytes.append(first_byte)
+                    else:
+                        route_results.errors[str(status)] = route_results.errors.get(str(status), 0) + 1
+
+            # Warm up connections, caches and the tokenizer before measuring
+            await asyncio.gather(*[worker(time.monotonic() + config.warmup) for _ in range(config.concurrency)])
+            before = proxy.stats()
+            measuring = True
+            start = time.monotonic()
+            await asyncio.gather(*[worker(start + config.duration) for _ in range(config.concurrency)])
+            elapsed = time.monotonic() - start
+            after = proxy.stats()
+    finally:
+        proxy.stop()
+        await upstream.stop()
+        if redis is not None:
+            redis.stop()
+
+    completed = sum(len(result.latencies) for result in results.values())
+    report = {
+        "config": {**asdict(config), "mock": asdict(config.mock)},
+        "duration_seconds": elapsed,
+        "requests": completed,
+        "errors": sum(sum(result.errors.values()) for result in results.values()),
+        "requests_per_second": completed / elapsed,
+        "routes": {
+            route: {
+                "requests": len(result.latencies),
+                "requests_per_second": len(result.latencies) / elapsed,
+                "errors": result.errors,
+                "first_byte_ms": summarize(result.first_bytes),
+                "latency_ms": summarize(result.latencies),
+            }
+            for route, result in results.items()
+        },
+        "workers": [],
+    }
+    handled = completed + report["errors"]
+    for pid, stats in after.items():
+        cpu = stats["cpu_seconds"] - before.get(pid, {}).get("cpu_seconds", 0.0)
+        report["workers"].append({
+            "pid": pid,
+            "cpu_seconds": cpu,
+            "cpu_percent": cpu / elapsed * 100,
+            "rss_mb": stats["rss_mb"],
+            "peak_rss_mb": stats["peak_rss_mb"],
+        })
+    if report["workers"]:
+        report["proxy"] = {
+            "cpu_ms_per_request": sum(worker["cpu_seconds"] for worker in report["workers"]) * 1000 / max(handled, 1),
+            "rss_mb": sum(worker["rss_mb"] for worker in report["workers"]),
+        }
+    return report
+
+# ================= REPORTING =================
+
+def print_report(report: Dict[str, Any]):
+    config = report["config"]
+    print(f"\n--- {config['provider']} upstream, concurrency {config['concurrency']}, {report['duration_seconds']:.1f} s ---")
+    print(f"{'route':<14} {'req/s':>8} {'errors':>7} {'ttfb p50':>9} {'p95':>8} {'p99':>8} {'lat p50':>9} {'p95':>8} {'p99':>8}")
+    for route, stats in report["routes"].items():
+        first_byte, latency = stats["first_byte_ms"], stats["latency_ms"]
+        print(
+            f"{route:<14} {stats['requests_per_second']:>8.1f} {sum(stats['errors'].values()):>7} "
+            f"{first_byte['p50']:>9.1f} {first_byte['p95']:>8.1f} {first_byte['p99']:>8.1f} "
+            f"{latency['p50']:>9.1f} {latency['p95']:>8.1f} {latency['p99']:>8.1f}"
+        )
+    print(f"{'total':<14} {report['requests_per_second']:>8.1f} {report['errors']:>7}   (latencies in ms)")
+    for worker in report["workers"]:
+        print(f"worker {worker['pid']}: {worker['cpu_percent']:.0f}% CPU, {worker['rss_mb']:.0f} MB RSS (peak {worker['peak_rss_mb']:.0f} MB)")
+    if "proxy" in report:
+        print(f"proxy: {report['proxy']['cpu_ms_per_request']:.2f} ms CPU per request")
+
+def comparable_metrics(report: Dict[str, Any]) -> Dict[str, tuple]:
+    """Metrics to compare against a baseline, as name -> (value, higher_is_better)."""
+    metrics = {"requests_per_second": (report["requests_per_second"], True)}
+    for route, stats in report["routes"].items():
+        for kind in ("first_byte_ms", "latency_ms"):
+            for pct in ("p50", "p99"):
+                metrics[f"{route}.{kind}.{pct}"] = (stats[kind][pct], False)
+    if "proxy" in report:
+        metrics["proxy.cpu_ms_per_request"] = (report["proxy"]["cpu_ms_per_request"], False)
+        metrics["proxy.rss_mb"] = (report["proxy"]["rss_mb"], False)
+    return metrics
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Print each metric against the baseline, returning those worse by more than tolerance."""
+    if report["config"] != baseline["config"]:
+        print("\n⚠️ The baseline was recorded with a different configuration")
+    current, previous = comparable_metrics(report), comparable_metrics(baseline)
+    regressions = []
+    print(f"\n--- Against the baseline (tolerance {tolerance:.0%}) ---")
+    for name, (value, higher_is_better) in current.items():
+        if name not in previous:
+            continue
+        old = previous[name][0]
+        if not old:
+            continue
+        change = (value - old) / old
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  ❌ regression"
+            regressions.append(name)
+        print(f"{name:<40} {old:>10.2f} -> {value:>10.2f}  ({change:+.1%}){flag}")
+    return regressions
+
+# ================= MAIN =================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of the Claude-on-OpenAI proxy against a mock upstream")
+    parser.add_argument("--provider", choices=("openai", "gemini", "anthropic"), default="openai", help="Upstream API the proxy is routed to")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds of unmeasured load first")
+    parser.add_argument("--mix", default="messages=0.4,stream=0.4,count_tokens=0.2", help="Route weights")
+    parser.add_argument("--messages", type=int, default=11, help="Messages in each request's history")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--output-tokens", type=int, default=200, help="Tokens in each mock response")
+    parser.add_argument("--chunk-tokens", type=int, default=5, help="Tokens per streamed chunk")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Mock generation speed (0 is unpaced)")
+    parser.add_argument("--first-token-ms", type=float, default=50.0, help="Mock delay before the first token")
+    parser.add_argument("--tool-share", type=float, default=0.2, help="Share of requests with tools answered with a tool call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of upstream calls that fail")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected errors")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Share of upstream streams cut off halfway")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the request mix and injected errors")
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="NAME=VALUE", help="Extra proxy setting (repeatable)")
+    parser.add_argument("--save", metavar="PATH", help="Write the results to PATH as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="Compare the results with the baseline at PATH")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change counted as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Show the proxy's output")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    config = LoadConfig(
+        provider=args.provider,
+        concurrency=args.concurrency,
+        duration=args.duration,
+        warmup=args.warmup,
+        mix=args.mix,
+        messages=args.messages,
+        workers=args.workers,
+        mock=MockSettings(
+            output_tokens=args.output_tokens,
+            chunk_tokens=args.chunk_tokens,
+            tokens_per_second=args.tokens_per_second,
+            first_token_ms=args.first_token_ms,
+            tool_share=args.tool_share,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            disconnect_rate=args.disconnect_rate,
+            seed=args.seed,
+        ),
+        proxy_env=dict(setting.split("=", 1) for setting in args.proxy_env),
+    )
+    report = asyncio.run(run_load(config, verbose=args.verbose))
+    print_report(report)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} metrics regressed: {', '.join(regressions)}")
+            return 1
+        print("\n✅ No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
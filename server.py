@@ -1,8 +1,9 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.routing import APIRoute
 import uvicorn
 import logging
 import json
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, PrivateAttr, field_validator, model_validator
 from typing import List, Dict, Any, Optional, Union, Literal
 import httpx
 import os
@@ -12,18 +13,74 @@ import uuid
 import time
 from dotenv import load_dotenv
 import re
+import fnmatch
 from datetime import datetime
 import sys
+import functools
+import asyncio
+import atexit
+import bisect
+import copy
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import queue
+import random
+import socket
+import struct
+import tempfile
+import threading
+import urllib.parse
+import zlib
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+import contextlib
+from contextlib import asynccontextmanager
+from json.encoder import encode_basestring_ascii
+
+# orjson is optional - when installed it's used to decode request bodies, which
+# matters for the large tool_result histories Claude Code sends
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# OpenTelemetry is optional - it's only needed when TRACING_EXPORTER is set
+try:
+    from opentelemetry import context as otel_context, propagate as otel_propagate, trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+def fast_json_loads(data: Union[str, bytes]) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def fast_json_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode("utf-8")
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.WARN,  # Change to INFO level to show more details
-    format='%(asctime)s - %(levelname)s - %(message)s',
-)
+# Configure logging. Records go on a queue and a background thread formats
+# and writes them, so the event loop never waits on the terminal. Log calls
+# pass %-style arguments, so records below the level are never formatted.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING").upper()  # INFO or DEBUG shows more details
+# "text", or "json" for one JSON object per line
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# Records waiting for the writer before new ones are dropped; 0 writes them inline
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# No format uses thread or process names, so records don't look them up
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
 logger = logging.getLogger(__name__)
+# The per-request summary lines, shown whatever LOG_LEVEL is
+request_logger = logging.getLogger(f"{__name__}.requests")
+request_logger.setLevel(logging.INFO)
 
 # Configure uvicorn to be quieter
 import uvicorn
@@ -34,25 +91,19 @@ logging.getLogger("uvicorn.error").setLevel(logging.WARNING)
 
 # Create a filter to block any log messages containing specific strings
 class MessageFilter(logging.Filter):
-    def filter(self, record):
-        # Block messages containing these strings
-        blocked_phrases = [
-            "LiteLLM completion()",
-            "HTTP Request:", 
-            "selected model name for cost calculation",
-            "utils.py",
-            "cost_calculator"
-        ]
-        
-        if hasattr(record, 'msg') and isinstance(record.msg, str):
-            for phrase in blocked_phrases:
-                if phrase in record.msg:
-                    return False
-        return True
+    BLOCKED_PHRASES = (
+        "LiteLLM completion()",
+        "HTTP Request:",
+        "selected model name for cost calculation",
+        "utils.py",
+        "cost_calculator",
+    )
+    BLOCKED = re.compile("|".join(re.escape(phrase) for phrase in BLOCKED_PHRASES))
 
-# Apply the filter to the root logger to catch all messages
-root_logger = logging.getLogger()
-root_logger.addFilter(MessageFilter())
+    def filter(self, record):
+        # Checked against the unformatted message, in one pass
+        msg = record.msg
+        return not (isinstance(msg, str) and self.BLOCKED.search(msg))
 
 # Custom formatter for model mapping logs
 class ColorizedFormatter(logging.Formatter):
@@ -65,17 +116,152 @@ class ColorizedFormatter(logging.Formatter):
     BOLD = "\033[1m"
     
     def format(self, record):
-        if record.levelno == logging.debug and "MODEL MAPPING" in record.msg:
+        if record.levelno == logging.DEBUG and isinstance(record.msg, str) and "MODEL MAPPING" in record.msg:
             # Apply colors and formatting to model mapping logs
-            return f"{self.BOLD}{self.GREEN}{record.msg}{self.RESET}"
+            return f"{self.BOLD}{self.GREEN}{record.getMessage()}{self.RESET}"
         return super().format(record)
 
-# Apply custom formatter to console handler
-for handler in logger.handlers:
-    if isinstance(handler, logging.StreamHandler):
-        handler.setFormatter(ColorizedFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+class RequestLineFormatter(logging.Formatter):
+    """Formats log_request_beautifully's fields as the colored two-line request summary."""
+
+    def format(self, record):
+        # Format the Claude model name nicely
+        claude_display = f"{Colors.CYAN}{record.original_model}{Colors.RESET}"
+        
+        # Extract endpoint name
+        endpoint = record.path.split("?")[0]
+        
+        # Extract just the OpenAI model name without provider prefix
+        openai_display = f"{Colors.GREEN}{record.mapped_model.split('/')[-1]}{Colors.RESET}"
+        
+        # Format tools and messages
+        tools_str = f"{Colors.MAGENTA}{record.tools} tools{Colors.RESET}"
+        messages_str = f"{Colors.BLUE}{record.messages} messages{Colors.RESET}"
+        
+        # Format status code
+        status_code = record.status_code
+        status_str = f"{Colors.GREEN}✓ {status_code} OK{Colors.RESET}" if status_code == 200 else f"{Colors.RED}✗ {status_code}{Colors.RESET}"
+        
+        # Put it all together in a clear, beautiful format
+        log_line = f"{Colors.BOLD}{record.method} {endpoint}{Colors.RESET} {status_str}"
+        model_line = f"{claude_display} → {openai_display} {tools_str} {messages_str}"
+        return f"{log_line}\n{model_line}"
+
+class JSONFormatter(logging.Formatter):
+    """Formats each record as one JSON object, including the request fields passed as extra."""
+
+    FIELDS = ("method", "path", "original_model", "mapped_model", "messages", "tools", "status_code")
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if field in record.__dict__:
+                entry[field] = record.__dict__[field]
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return fast_json_dumps(entry).decode("utf-8")
+
+class LazyJSON:
+    """Log argument that is only serialized if its record gets written."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, indent=2, default=str)
+
+class LogQueueHandler(QueueHandler):
+    """Queues records unformatted for the writer thread, dropping them when the queue is full.
+
+    Unlike QueueHandler, the message isn't formatted on the way in - the
+    writer formats it, off the event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Request summaries go to stdout and everything else to stderr
+log_handler = logging.StreamHandler()
+log_handler.addFilter(lambda record: record.name != request_logger.name)
+request_log_handler = logging.StreamHandler(sys.stdout)
+request_log_handler.addFilter(logging.Filter(request_logger.name))
+if LOG_FORMAT == "json":
+    log_handler.setFormatter(JSONFormatter())
+    request_log_handler.setFormatter(JSONFormatter())
+else:
+    log_handler.setFormatter(ColorizedFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+    request_log_handler.setFormatter(RequestLineFormatter())
+
+log_listener = None
+if LOG_QUEUE_SIZE > 0:
+    log_handlers = [LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))]
+    log_listener = QueueListener(log_handlers[0].queue, log_handler, request_log_handler, respect_handler_level=True)
+    log_listener.start()
+    # Write out what's still queued at exit
+    atexit.register(log_listener.stop)
+else:
+    log_handlers = [log_handler, request_log_handler]
+for handler in log_handlers:
+    handler.addFilter(MessageFilter())
+logging.basicConfig(level=LOG_LEVEL, handlers=log_handlers)
+if LOG_FORMAT not in ("text", "json"):
+    logger.warning("Unknown LOG_FORMAT '%s', using 'text'", LOG_FORMAT)
+
+class FastJSONRequest(Request):
+    """Request that decodes its JSON body with orjson when it's available."""
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            body = await self.body()
+            self._json = fast_json_loads(body)
+        return self._json
+
+class FastJSONRoute(APIRoute):
+    """Route that hands FastJSONRequest to FastAPI so the body is only parsed once, with the fastest decoder."""
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+
+        async def fast_json_route_handler(request: Request):
+            # When the body started being read and validated, for the request's trace
+            request.scope["received_ns"] = time.time_ns()
+            return await original_route_handler(FastJSONRequest(request.scope, request.receive))
+
+        return fast_json_route_handler
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The pooled upstream clients live as long as the app
+    await upstream_clients.start()
+    publisher = None
+    if shared_store.shared:
+        publisher = asyncio.create_task(metrics.publish_periodically(shared_store, METRICS_PUBLISH_SECONDS))
+    try:
+        yield
+    finally:
+        if publisher is not None:
+            publisher.cancel()
+        await upstream_clients.aclose()
+        tracing.shutdown()
+        shared_store.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = FastJSONRoute
 
 # Get API keys from environment
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
@@ -90,6 +276,158 @@ PREFERRED_PROVIDER = os.environ.get("PREFERRED_PROVIDER", "openai").lower()
 BIG_MODEL = os.environ.get("BIG_MODEL", "gpt-4.1")
 SMALL_MODEL = os.environ.get("SMALL_MODEL", "gpt-4.1-mini")
 
+# Optional JSON file with extra model routing rules (see README). It is re-read
+# when it changes, checked at most every MODEL_ROUTES_RELOAD_SECONDS.
+MODEL_ROUTES_FILE = os.environ.get("MODEL_ROUTES_FILE")
+MODEL_ROUTES_RELOAD_SECONDS = float(os.environ.get("MODEL_ROUTES_RELOAD_SECONDS", "5"))
+
+# Max number of converted tool definitions kept in the tool cache (0 disables it)
+TOOL_CACHE_SIZE = int(os.environ.get("TOOL_CACHE_SIZE", "256"))
+
+# Limits for the conversation translation cache (0 disables it)
+CONVERSATION_CACHE_SIZE = int(os.environ.get("CONVERSATION_CACHE_SIZE", "128"))
+CONVERSATION_CACHE_MAX_MB = float(os.environ.get("CONVERSATION_CACHE_MAX_MB", "64"))
+
+# Optional coalescing of streamed text deltas. When STREAM_COALESCE_MS > 0, small
+# text chunks from upstream are buffered for up to that many milliseconds (or
+# STREAM_COALESCE_BYTES bytes) and sent as a single content_block_delta.
+STREAM_COALESCE_MS = float(os.environ.get("STREAM_COALESCE_MS", "0"))
+STREAM_COALESCE_BYTES = int(os.environ.get("STREAM_COALESCE_BYTES", "256"))
+
+# Streams are sent to clients through a buffer of STREAM_BUFFER_FRAMES SSE
+# frames (0 sends each frame as it's made). When a slow client lets it fill,
+# STREAM_BUFFER_POLICY "wait" stops reading upstream until the client catches
+# up, and "disconnect" ends the stream if it hasn't within
+# STREAM_SLOW_CLIENT_TIMEOUT_SECONDS. Either way, a stream whose client
+# disconnects is closed upstream right away.
+STREAM_BUFFER_FRAMES = int(os.environ.get("STREAM_BUFFER_FRAMES", "64"))
+STREAM_BUFFER_POLICY = os.environ.get("STREAM_BUFFER_POLICY", "wait").lower()
+if STREAM_BUFFER_POLICY not in ("wait", "disconnect"):
+    logger.warning("Unknown STREAM_BUFFER_POLICY '%s', using 'wait'", STREAM_BUFFER_POLICY)
+    STREAM_BUFFER_POLICY = "wait"
+STREAM_SLOW_CLIENT_TIMEOUT_SECONDS = float(os.environ.get("STREAM_SLOW_CLIENT_TIMEOUT_SECONDS", "30"))
+
+# Max number of per-message token counts kept by the count_tokens engine (0 disables caching)
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", "8192"))
+
+# Optional exact response cache for deterministic (temperature 0) requests:
+# "off", "memory", "disk" (entries kept in RESPONSE_CACHE_DIR) or "shared"
+# (entries kept in SHARED_STORE, for all workers)
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "off").lower()
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", ".response_cache")
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_MB = float(os.environ.get("RESPONSE_CACHE_MAX_MB", "256"))
+
+# Routes whose concurrent identical requests share one upstream call or count,
+# as a comma separated list of "messages" and "count_tokens" (empty disables it)
+SINGLE_FLIGHT_ROUTES = {route.strip() for route in os.environ.get("SINGLE_FLIGHT_ROUTES", "").lower().split(",") if route.strip()}
+for route in SINGLE_FLIGHT_ROUTES - {"messages", "count_tokens"}:
+    logger.warning("Unknown SINGLE_FLIGHT_ROUTES entry '%s', ignoring it", route)
+
+# How tool_use/tool_result blocks are sent upstream: "text" flattens them into
+# the message text, "native" maps them to assistant tool_calls and role "tool"
+# messages, which keeps prompts smaller and upstream prompt caching stable.
+TOOL_MESSAGE_FORMAT = os.environ.get("TOOL_MESSAGE_FORMAT", "text").lower()
+if TOOL_MESSAGE_FORMAT not in ("text", "native"):
+    logger.warning("Unknown TOOL_MESSAGE_FORMAT '%s', using 'text'", TOOL_MESSAGE_FORMAT)
+    TOOL_MESSAGE_FORMAT = "text"
+
+# Pooled HTTP clients for upstream providers (see UpstreamClients). HTTP/2 needs
+# the optional h2 package.
+UPSTREAM_CONNECTION_POOL = os.environ.get("UPSTREAM_CONNECTION_POOL", "false").lower() in ("1", "true", "yes")
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_SECONDS = float(os.environ.get("UPSTREAM_KEEPALIVE_SECONDS", "60"))
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+UPSTREAM_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_TIMEOUT_SECONDS", "600"))
+
+# Send anthropic/ models' requests straight to the Anthropic API and relay its
+# SSE bytes unchanged, instead of translating both ways through LiteLLM (see
+# AnthropicPassthrough). The API base is read like LiteLLM reads it.
+ANTHROPIC_PASSTHROUGH = os.environ.get("ANTHROPIC_PASSTHROUGH", "false").lower() in ("1", "true", "yes")
+ANTHROPIC_API_BASE = os.environ.get("ANTHROPIC_API_BASE") or os.environ.get("ANTHROPIC_BASE_URL") or "https://api.anthropic.com"
+
+# Read openai/ models' streams straight from OpenAI's SSE bytes, instead of
+# through LiteLLM's chunk objects (see OpenAIStreamAdapter).
+OPENAI_NATIVE_STREAMING = os.environ.get("OPENAI_NATIVE_STREAMING", "false").lower() in ("1", "true", "yes")
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE") or os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+
+# Per-provider admission control (see AdmissionScheduler). For each provider,
+# <PROVIDER>_MAX_CONCURRENCY caps in-flight upstream requests, and <PROVIDER>_RPM
+# and <PROVIDER>_TPM cap requests and tokens per minute (0 means unlimited).
+PROVIDER_LIMITS = {
+    provider: {
+        "max_concurrency": int(os.environ.get(f"{provider.upper()}_MAX_CONCURRENCY", "0")),
+        "rpm": float(os.environ.get(f"{provider.upper()}_RPM", "0")),
+        "tpm": float(os.environ.get(f"{provider.upper()}_TPM", "0")),
+    }
+    for provider in ("openai", "gemini", "anthropic")
+}
+# Requests over the limits wait in a bounded queue, small model (haiku) requests first
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30"))
+ADMISSION_SMALL_MODEL_FIRST = os.environ.get("ADMISSION_SMALL_MODEL_FIRST", "true").lower() in ("1", "true", "yes")
+
+# Retries of failed upstream calls (see RetryPolicy), with jittered exponential
+# backoff that honors Retry-After. UPSTREAM_ATTEMPT_TIMEOUT_SECONDS bounds the
+# wait for a response, or a stream's first chunk, before an attempt counts as failed.
+UPSTREAM_MAX_RETRIES = int(os.environ.get("UPSTREAM_MAX_RETRIES", "0"))
+RETRY_BACKOFF_SECONDS = float(os.environ.get("RETRY_BACKOFF_SECONDS", "0.5"))
+RETRY_MAX_BACKOFF_SECONDS = float(os.environ.get("RETRY_MAX_BACKOFF_SECONDS", "8"))
+RETRY_STATUS_CODES = os.environ.get("RETRY_STATUS_CODES", "408,409,429,500,502,503,504,529")
+UPSTREAM_ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_ATTEMPT_TIMEOUT_SECONDS", "0"))
+
+# Ordered fallback chains, comma separated, e.g.
+# "openai/gpt-4.1>gemini/gemini-2.5-pro>anthropic/claude-sonnet-4-20250514".
+# A request for a model in a chain fails over to the models after it.
+FALLBACK_CHAINS = os.environ.get("FALLBACK_CHAINS", "")
+
+# Optional hedging of small model (haiku) requests: if the first byte hasn't
+# arrived after the model's HEDGE_PERCENTILE latency, a duplicate request is
+# sent (to HEDGE_MODEL if set, else the same model) and the first to respond
+# wins. HEDGE_DELAY_SECONDS is used until HEDGE_MIN_SAMPLES latencies are known.
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+HEDGE_DELAY_SECONDS = float(os.environ.get("HEDGE_DELAY_SECONDS", "2"))
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get("HEDGE_MIN_DELAY_SECONDS", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MODEL = os.environ.get("HEDGE_MODEL", "")
+
+# Optional circuit breaker per upstream model (see CircuitBreaker). A model
+# whose error rate over the window reaches CIRCUIT_BREAKER_ERROR_RATE is
+# skipped for CIRCUIT_BREAKER_OPEN_SECONDS - requests go to its FALLBACK_CHAINS
+# alternatives, or fail fast - and then probed. Calls slower than
+# CIRCUIT_BREAKER_SLOW_CALL_SECONDS (0 disables it) count as errors.
+CIRCUIT_BREAKER = os.environ.get("CIRCUIT_BREAKER", "false").lower() in ("1", "true", "yes")
+CIRCUIT_BREAKER_WINDOW_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_WINDOW_SECONDS", "60"))
+CIRCUIT_BREAKER_MIN_REQUESTS = int(os.environ.get("CIRCUIT_BREAKER_MIN_REQUESTS", "10"))
+CIRCUIT_BREAKER_ERROR_RATE = float(os.environ.get("CIRCUIT_BREAKER_ERROR_RATE", "0.5"))
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", "0"))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = int(os.environ.get("CIRCUIT_BREAKER_HALF_OPEN_PROBES", "1"))
+
+# Optional OpenTelemetry tracing of each request's stages (see Tracing):
+# "otlp" exports over HTTP to OTEL_EXPORTER_OTLP_ENDPOINT (a local collector
+# at http://localhost:4318 by default), "file" appends one JSON span per line
+# to TRACING_FILE.
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "off").lower()
+TRACING_FILE = os.environ.get("TRACING_FILE", "traces.jsonl")
+TRACING_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "anthropic-proxy")
+
+# Worker processes for `python server.py`, and where they share rate limits,
+# the response cache and metrics (see create_shared_store): "memory" keeps
+# state in each process, "shm" uses a memory-mapped file in /dev/shm that the
+# workers on one host share, and "redis" uses any Redis-compatible server.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+SHARED_STORE = os.environ.get("SHARED_STORE", "memory").lower()
+SHARED_STORE_PATH = os.environ.get("SHARED_STORE_PATH", "")  # Default: /dev/shm/anthropic-proxy.store
+SHARED_STORE_SLOTS = int(os.environ.get("SHARED_STORE_SLOTS", "512"))
+SHARED_STORE_SLOT_KB = int(os.environ.get("SHARED_STORE_SLOT_KB", "32"))
+SHARED_STORE_URL = os.environ.get("SHARED_STORE_URL", "redis://localhost:6379/0")
+SHARED_STORE_PREFIX = os.environ.get("SHARED_STORE_PREFIX", "anthropic-proxy:")
+METRICS_PUBLISH_SECONDS = float(os.environ.get("METRICS_PUBLISH_SECONDS", "5"))
+
 # List of OpenAI models
 OPENAI_MODELS = [
     "o3-mini",
@@ -112,6 +450,175 @@ GEMINI_MODELS = [
     "gemini-2.0-flash"
 ]
 
+class ModelRouter:
+    """Maps client model names (e.g. claude-3-haiku) to provider/model names.
+
+    The routing table is compiled once from the environment, plus optional
+    glob/regex rules from a JSON routes file, and resolved names are cached.
+    The routes file is reloaded when it changes on disk.
+    """
+    PROVIDER_PREFIXES = ('anthropic/', 'openai/', 'gemini/')
+
+    def __init__(self, routes_file: Optional[str] = None, reload_seconds: float = 5.0, cache_size: int = 1024):
+        self.routes_file = routes_file
+        self.reload_seconds = reload_seconds
+        self.rules = []
+        self._routes_mtime = None
+        self._next_check = 0.0
+        self._resolve_cached = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+        self.openai_models = frozenset(OPENAI_MODELS)
+        self.gemini_models = frozenset(GEMINI_MODELS)
+        use_gemini = PREFERRED_PROVIDER == "google"
+        self.small_target = f"gemini/{SMALL_MODEL}" if use_gemini and SMALL_MODEL in self.gemini_models else f"openai/{SMALL_MODEL}"
+        self.big_target = f"gemini/{BIG_MODEL}" if use_gemini and BIG_MODEL in self.gemini_models else f"openai/{BIG_MODEL}"
+        logger.debug("📋 MODEL ROUTES: Preferred='%s', haiku='%s', sonnet='%s'", PREFERRED_PROVIDER, self.small_target, self.big_target)
+
+        if routes_file:
+            self.check_for_changes(force=True)
+
+    @staticmethod
+    def load_rules(path: str) -> List[tuple]:
+        """Load routing rules from a JSON file.
+
+        The file holds {"routes": [...]}, where each route has a "pattern" (glob)
+        or "regex", and a target "model" (optionally split into "provider" and "model").
+        Patterns are matched case-insensitively against the model name as sent.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        routes = config.get("routes", []) if isinstance(config, dict) else config
+        rules = []
+        for route in routes:
+            target = route["model"]
+            if route.get("provider"):
+                target = f"{route['provider']}/{target}"
+            if "regex" in route:
+                matcher = re.compile(route["regex"], re.IGNORECASE).search
+            else:
+                matcher = re.compile(fnmatch.translate(route["pattern"]), re.IGNORECASE).match
+            rules.append((matcher, target))
+        return rules
+
+    def check_for_changes(self, force: bool = False):
+        """Reload the routes file if it changed since it was last loaded."""
+        self._next_check = time.monotonic() + self.reload_seconds
+        try:
+            mtime = os.stat(self.routes_file).st_mtime_ns
+        except OSError as e:
+            logger.error("Could not read model routes file %s: %s", self.routes_file, e)
+            return
+        if not force and mtime == self._routes_mtime:
+            return
+        try:
+            self.rules = self.load_rules(self.routes_file)
+        except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+            # Keep serving the previous rules rather than failing requests
+            logger.error("Invalid model routes file %s, keeping previous rules: %s", self.routes_file, e)
+            return
+        finally:
+            self._routes_mtime = mtime
+        self._resolve_cached.cache_clear()
+        logger.info("Loaded %s model routes from %s", len(self.rules), self.routes_file)
+
+    def resolve(self, model: str) -> str:
+        """Return the provider/model name a client model name should be sent to."""
+        if self.routes_file and time.monotonic() >= self._next_check:
+            self.check_for_changes()
+        return self._resolve_cached(model)
+
+    def _resolve(self, model: str) -> str:
+        new_model = self._route(model)
+        if new_model is not None:
+            logger.debug("📌 MODEL MAPPING: '%s' ➡️ '%s'", model, new_model)
+            return new_model
+        if not model.startswith(self.PROVIDER_PREFIXES):
+            logger.warning("⚠️ No prefix or mapping rule for model: '%s'. Using as is.", model)
+        return model
+
+    def _route(self, model: str) -> Optional[str]:
+        for matcher, target in self.rules:
+            if matcher(model):
+                return target
+
+        # Remove provider prefixes for easier matching
+        clean_model = model
+        for prefix in self.PROVIDER_PREFIXES:
+            if clean_model.startswith(prefix):
+                clean_model = clean_model[len(prefix):]
+                break
+
+        lower_model = clean_model.lower()
+        if 'haiku' in lower_model:
+            return self.small_target
+        if 'sonnet' in lower_model:
+            return self.big_target
+
+        # Add prefixes to models that match the known lists
+        if clean_model in self.gemini_models and not model.startswith('gemini/'):
+            return f"gemini/{clean_model}"
+        if clean_model in self.openai_models and not model.startswith('openai/'):
+            return f"openai/{clean_model}"
+        return None
+
+model_router = ModelRouter(MODEL_ROUTES_FILE, reload_seconds=MODEL_ROUTES_RELOAD_SECONDS)
+
+class LRUCache:
+    """A bounded least-recently-used cache that counts hits and misses.
+
+    It is locked, since token counting reaches shared caches such as
+    tool_cache from worker threads while the event loop uses them too.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self.data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+def canonical_json(obj: Any) -> bytes:
+    """Serialize obj deterministically (sorted keys) so equal content hashes equally."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(obj, sort_keys=True, default=str).encode("utf-8")
+
+def content_hash(obj: Any) -> str:
+    return hashlib.sha256(canonical_json(obj)).hexdigest()
+
 # Helper function to clean schema for Gemini
 def clean_gemini_schema(schema: Any) -> Any:
     """Recursively removes unsupported fields from a JSON schema for Gemini."""
@@ -124,7 +631,7 @@ def clean_gemini_schema(schema: Any) -> Any:
         if schema.get("type") == "string" and "format" in schema:
             allowed_formats = {"enum", "date-time"}
             if schema["format"] not in allowed_formats:
-                logger.debug(f"Removing unsupported format '{schema['format']}' for string type in Gemini schema.")
+                logger.debug("Removing unsupported format '%s' for string type in Gemini schema.", schema['format'])
                 schema.pop("format")
 
         # Recursively clean nested schemas (properties, items, etc.)
@@ -186,67 +693,32 @@ class MessagesRequest(BaseModel):
     tool_choice: Optional[Dict[str, Any]] = None
     thinking: Optional[ThinkingConfig] = None
     original_model: Optional[str] = None  # Will store the original model name
+    _raw_messages: Optional[List[Any]] = PrivateAttr(default=None)  # Messages as decoded from JSON
+    _raw_body: Optional[Dict[str, Any]] = PrivateAttr(default=None)  # The whole body, for the Anthropic passthrough
+    _anthropic_headers: Dict[str, str] = PrivateAttr(default_factory=dict)  # Client headers the passthrough forwards
     
-    @field_validator('model')
-    def validate_model_field(cls, v, info): # Renamed to avoid conflict
-        original_model = v
-        new_model = v # Default to original value
-
-        logger.debug(f"📋 MODEL VALIDATION: Original='{original_model}', Preferred='{PREFERRED_PROVIDER}', BIG='{BIG_MODEL}', SMALL='{SMALL_MODEL}'")
-
-        # Remove provider prefixes for easier matching
-        clean_v = v
-        if clean_v.startswith('anthropic/'):
-            clean_v = clean_v[10:]
-        elif clean_v.startswith('openai/'):
-            clean_v = clean_v[7:]
-        elif clean_v.startswith('gemini/'):
-            clean_v = clean_v[7:]
-
-        # --- Mapping Logic --- START ---
-        mapped = False
-        # Map Haiku to SMALL_MODEL based on provider preference
-        if 'haiku' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google" and SMALL_MODEL in GEMINI_MODELS:
-                new_model = f"gemini/{SMALL_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{SMALL_MODEL}"
-                mapped = True
-
-        # Map Sonnet to BIG_MODEL based on provider preference
-        elif 'sonnet' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google" and BIG_MODEL in GEMINI_MODELS:
-                new_model = f"gemini/{BIG_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{BIG_MODEL}"
-                mapped = True
-
-        # Add prefixes to non-mapped models if they match known lists
-        elif not mapped:
-            if clean_v in GEMINI_MODELS and not v.startswith('gemini/'):
-                new_model = f"gemini/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-            elif clean_v in OPENAI_MODELS and not v.startswith('openai/'):
-                new_model = f"openai/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-        # --- Mapping Logic --- END ---
-
-        if mapped:
-            logger.debug(f"📌 MODEL MAPPING: '{original_model}' ➡️ '{new_model}'")
-        else:
-             # If no mapping occurred and no prefix exists, log warning or decide default
-             if not v.startswith(('openai/', 'gemini/', 'anthropic/')):
-                 logger.warning(f"⚠️ No prefix or mapping rule for model: '{original_model}'. Using as is.")
-             new_model = v # Ensure we return the original if no rule applied
+    @model_validator(mode='before')
+    @classmethod
+    def store_original_model(cls, data):
+        # Keep the model name exactly as the client sent it, before mapping
+        if isinstance(data, dict) and 'model' in data:
+            data = {**data, 'original_model': data['model']}
+        return data
 
-        # Store the original model in the values dictionary
-        values = info.data
-        if isinstance(values, dict):
-            values['original_model'] = original_model
+    @model_validator(mode='wrap')
+    @classmethod
+    def keep_raw_messages(cls, data, handler):
+        # The raw message dicts are much cheaper to hash than the validated models
+        request = handler(data)
+        if isinstance(data, dict):
+            request._raw_body = data
+            if isinstance(data.get('messages'), list):
+                request._raw_messages = data['messages']
+        return request
 
-        return new_model
+    @field_validator('model')
+    def validate_model_field(cls, v, info): # Renamed to avoid conflict
+        return model_router.resolve(v)
 
 class TokenCountRequest(BaseModel):
     model: str
@@ -256,69 +728,32 @@ class TokenCountRequest(BaseModel):
     thinking: Optional[ThinkingConfig] = None
     tool_choice: Optional[Dict[str, Any]] = None
     original_model: Optional[str] = None  # Will store the original model name
+    _raw_messages: Optional[List[Any]] = PrivateAttr(default=None)  # Messages as decoded from JSON
+    _raw_tools: Optional[List[Any]] = PrivateAttr(default=None)  # Tools as decoded from JSON
     
-    @field_validator('model')
-    def validate_model_token_count(cls, v, info): # Renamed to avoid conflict
-        # Use the same logic as MessagesRequest validator
-        # NOTE: Pydantic validators might not share state easily if not class methods
-        # Re-implementing the logic here for clarity, could be refactored
-        original_model = v
-        new_model = v # Default to original value
+    @model_validator(mode='before')
+    @classmethod
+    def store_original_model(cls, data):
+        # Keep the model name exactly as the client sent it, before mapping
+        if isinstance(data, dict) and 'model' in data:
+            data = {**data, 'original_model': data['model']}
+        return data
 
-        logger.debug(f"📋 TOKEN COUNT VALIDATION: Original='{original_model}', Preferred='{PREFERRED_PROVIDER}', BIG='{BIG_MODEL}', SMALL='{SMALL_MODEL}'")
+    @model_validator(mode='wrap')
+    @classmethod
+    def keep_raw_messages(cls, data, handler):
+        # The raw message and tool dicts are much cheaper to hash than the validated models
+        request = handler(data)
+        if isinstance(data, dict):
+            if isinstance(data.get('messages'), list):
+                request._raw_messages = data['messages']
+            if isinstance(data.get('tools'), list):
+                request._raw_tools = data['tools']
+        return request
 
-        # Remove provider prefixes for easier matching
-        clean_v = v
-        if clean_v.startswith('anthropic/'):
-            clean_v = clean_v[10:]
-        elif clean_v.startswith('openai/'):
-            clean_v = clean_v[7:]
-        elif clean_v.startswith('gemini/'):
-            clean_v = clean_v[7:]
-
-        # --- Mapping Logic --- START ---
-        mapped = False
-        # Map Haiku to SMALL_MODEL based on provider preference
-        if 'haiku' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google" and SMALL_MODEL in GEMINI_MODELS:
-                new_model = f"gemini/{SMALL_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{SMALL_MODEL}"
-                mapped = True
-
-        # Map Sonnet to BIG_MODEL based on provider preference
-        elif 'sonnet' in clean_v.lower():
-            if PREFERRED_PROVIDER == "google" and BIG_MODEL in GEMINI_MODELS:
-                new_model = f"gemini/{BIG_MODEL}"
-                mapped = True
-            else:
-                new_model = f"openai/{BIG_MODEL}"
-                mapped = True
-
-        # Add prefixes to non-mapped models if they match known lists
-        elif not mapped:
-            if clean_v in GEMINI_MODELS and not v.startswith('gemini/'):
-                new_model = f"gemini/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-            elif clean_v in OPENAI_MODELS and not v.startswith('openai/'):
-                new_model = f"openai/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-        # --- Mapping Logic --- END ---
-
-        if mapped:
-            logger.debug(f"📌 TOKEN COUNT MAPPING: '{original_model}' ➡️ '{new_model}'")
-        else:
-             if not v.startswith(('openai/', 'gemini/', 'anthropic/')):
-                 logger.warning(f"⚠️ No prefix or mapping rule for token count model: '{original_model}'. Using as is.")
-             new_model = v # Ensure we return the original if no rule applied
-
-        # Store the original model in the values dictionary
-        values = info.data
-        if isinstance(values, dict):
-            values['original_model'] = original_model
-
-        return new_model
+    @field_validator('model')
+    def validate_model_token_count(cls, v, info): # Renamed to avoid conflict
+        return model_router.resolve(v)
 
 class TokenCountResponse(BaseModel):
     input_tokens: int
@@ -346,7 +781,7 @@ async def log_requests(request: Request, call_next):
     path = request.url.path
     
     # Log only basic request details at debug level
-    logger.debug(f"Request: {method} {path}")
+    logger.debug("Request: %s %s", method, path)
     
     # Process the request and get the response
     response = await call_next(request)
@@ -399,143 +834,445 @@ def parse_tool_result_content(content):
     except:
         return "Unparseable content"
 
-def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str, Any]:
-    """Convert Anthropic API request format to LiteLLM format (which follows OpenAI)."""
+# Converted tools keyed by a hash of the tool definition. Claude Code sends the
+# same large tool definitions on every turn, so this skips re-cleaning them.
+tool_cache = LRUCache(TOOL_CACHE_SIZE)
+
+def convert_tool_to_openai(tool_dict: Dict[str, Any], is_gemini_model: bool) -> Dict[str, Any]:
+    """Convert an Anthropic tool definition to an OpenAI function tool."""
+    # Clean the schema if targeting a Gemini model
+    input_schema = tool_dict.get("input_schema", {})
+    if is_gemini_model:
+         logger.debug("Cleaning schema for Gemini tool: %s", tool_dict.get('name'))
+         input_schema = clean_gemini_schema(copy.deepcopy(input_schema))
+
+    # Create OpenAI-compatible function tool
+    return {
+        "type": "function",
+        "function": {
+            "name": tool_dict["name"],
+            "description": tool_dict.get("description", ""),
+            "parameters": input_schema # Use potentially cleaned schema
+        }
+    }
+
+def get_openai_tool(tool_dict: Dict[str, Any], is_gemini_model: bool) -> Dict[str, Any]:
+    """Return the converted OpenAI tool for tool_dict, using the tool cache.
+
+    Only Gemini tools are cached - other providers take the schema as is, which
+    is cheaper than hashing it. The cache holds serialized tools and every call
+    returns a fresh copy, since LiteLLM modifies Gemini tool schemas in place.
+    """
+    if not is_gemini_model or tool_cache.maxsize <= 0:
+        return convert_tool_to_openai(tool_dict, is_gemini_model)
+
+    key = content_hash([tool_dict.get("name"), tool_dict.get("description"), tool_dict.get("input_schema")])
+    encoded = tool_cache.get(key)
+    if encoded is not None:
+        return fast_json_loads(encoded)
+
+    openai_tool = convert_tool_to_openai(tool_dict, is_gemini_model)
+    tool_cache.put(key, fast_json_dumps(openai_tool))
+    return openai_tool
+
+class ConversationCache:
+    """Caches translated conversations keyed by a rolling hash of their messages.
+
+    Agentic sessions resend the whole history on every turn, so the longest
+    previously translated prefix of the conversation is reused and only the
+    new tail messages are translated. Translated messages are stored
+    serialized, which gives an exact memory bound and hands every request its
+    own copy to modify.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # prefix hash -> (encoded messages, size in bytes)
+        self.total_bytes = 0
+        self.hits = 0  # Messages reused from the cache
+        self.misses = 0  # Messages that had to be translated
+
+    @staticmethod
+    def prefix_hashes(messages: List[Any], flavor: str) -> List[bytes]:
+        """Return the rolling hash of messages[:i + 1] for every i."""
+        hasher = hashlib.sha256(flavor.encode("utf-8"))
+        hashes = []
+        for msg in messages:
+            if isinstance(msg, BaseModel):
+                hasher.update(msg.__pydantic_serializer__.to_json(msg))
+            else:
+                hasher.update(fast_json_dumps(msg))
+            # Separate messages so content can't shift across a message boundary
+            hasher.update(b"\x00")
+            hashes.append(hasher.copy().digest())
+        return hashes
+
+    def translate(self, messages: List[Any], translate_message, flavor: str,
+                  raw_messages: Optional[List[Any]] = None) -> List[Dict[str, Any]]:
+        """Translate messages with translate_message, reusing any cached prefix.
+
+        flavor identifies the translation, so different targets don't share
+        entries. raw_messages, if given, are the messages as decoded from JSON
+        and are hashed instead of the models.
+        """
+        if self.max_entries <= 0 or self.max_bytes <= 0 or not messages:
+            return [translate_message(msg) for msg in messages]
+
+        if raw_messages is None or len(raw_messages) != len(messages):
+            raw_messages = messages
+        hashes = self.prefix_hashes(raw_messages, flavor)
+        encoded = []
+        for length in range(len(messages), 0, -1):
+            entry = self.entries.get(hashes[length - 1])
+            if entry is not None:
+                self.entries.move_to_end(hashes[length - 1])
+                encoded = list(entry[0])
+                break
+
+        reused = len(encoded)
+        self.hits += reused
+        self.misses += len(messages) - reused
+        translated = [fast_json_loads(item) for item in encoded]
+        if reused == len(messages):
+            return translated
+
+        try:
+            for msg in messages[reused:]:
+                translated_msg = translate_message(msg)
+                encoded.append(fast_json_dumps(translated_msg))
+                translated.append(translated_msg)
+        except (TypeError, ValueError) as e:
+            # Content that can't round-trip through JSON is translated without caching
+            logger.debug("Not caching conversation translation: %s", e)
+            translated.extend(translate_message(msg) for msg in messages[len(translated):])
+            return translated
+
+        self.put(hashes[-1], encoded)
+        return translated
+
+    def put(self, key: bytes, encoded: List[bytes]):
+        size = sum(len(item) for item in encoded)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (encoded, size)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries), "bytes": self.total_bytes,
+            "max_entries": self.max_entries, "max_bytes": self.max_bytes,
+            "hits": self.hits, "misses": self.misses,
+        }
+
+conversation_cache = ConversationCache(CONVERSATION_CACHE_SIZE, int(CONVERSATION_CACHE_MAX_MB * 1024 * 1024))
+
+def dump_json_or_str(value) -> str:
+    """Serialize value as JSON, falling back to str() for values JSON can't encode."""
+    try:
+        return json.dumps(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+def append_result_items(parts: List[str], items: List[Any]):
+    """Append the text of each dict in a tool_result content list to parts, one per line."""
+    for item in items:
+        if isinstance(item, dict):
+            if item.get("type") == "text":
+                parts.append(item.get("text", ""))
+            elif "text" in item:
+                parts.append(item["text"])
+            else:
+                parts.append(dump_json_or_str(item))
+            parts.append("\n")
+        elif getattr(item, "type", None) == "text":
+            parts.append(item.text)
+            parts.append("\n")
+
+def tool_result_to_text(result: Any) -> str:
+    """Return the text of a tool_result block's content."""
+    if isinstance(result, str):
+        return result
+    if isinstance(result, list):
+        parts = []
+        append_result_items(parts, result)
+        return "".join(parts)
+    if isinstance(result, dict):
+        return result.get("text", "") if result.get("type") == "text" else dump_json_or_str(result)
+    return str(result)
+
+def tool_results_to_user_text(content: List[Any]) -> str:
+    """Flatten a user message with tool_result blocks into the plain text OpenAI-style APIs expect.
+
+    OpenAI/LiteLLM format expects the assistant to call the tool, and the
+    user's next message to include the result as plain text.
+    """
+    parts = []
+    for block in content:
+        if block.type == "text":
+            parts.append(block.text)
+            parts.append("\n")
+        elif block.type == "tool_result":
+            parts.append(f"Tool result for {block.tool_use_id}:\n")
+            parts.append(tool_result_to_text(block.content))
+            parts.append("\n")
+    return "".join(parts).strip()
+
+def has_tool_result(msg: Message) -> bool:
+    return msg.role == "user" and any(block.type == "tool_result" for block in msg.content)
+
+def convert_message_to_litellm(msg: Message) -> Dict[str, Any]:
+    """Convert a single Anthropic message to LiteLLM format (which follows OpenAI)."""
+    content = msg.content
+    if isinstance(content, str):
+        return {"role": msg.role, "content": content}
+
+    # Tool results in user messages are sent as a single plain text user message
+    if has_tool_result(msg):
+        return {"role": "user", "content": tool_results_to_user_text(content)}
+
+    processed_content = []
+    for block in content:
+        if block.type == "text":
+            processed_content.append({"type": "text", "text": block.text})
+        elif block.type == "image":
+            processed_content.append({"type": "image", "source": block.source})
+        elif block.type == "tool_use":
+            processed_content.append({"type": "tool_use", "id": block.id, "name": block.name, "input": block.input})
+        elif block.type == "tool_result":
+            # Normalize tool result content to a list of blocks
+            result = block.content
+            if isinstance(result, str):
+                result = [{"type": "text", "text": result}]
+            elif not isinstance(result, list):
+                result = [{"type": "text", "text": str(result)}]
+            processed_content.append({"type": "tool_result", "tool_use_id": block.tool_use_id, "content": result})
+    return {"role": msg.role, "content": processed_content}
+
+def append_tool_result_text(parts: List[str], block: ContentBlockToolResult):
+    """Append a tool_result block's content to parts, as convert_message_to_litellm normalizes it."""
+    result = block.content
+    if isinstance(result, list):
+        append_result_items(parts, result)
+    else:
+        parts.append(result if isinstance(result, str) else str(result))
+        parts.append("\n")
+
+def translate_message_for_openai(msg: Message) -> Dict[str, Any]:
+    """Convert a single Anthropic message to a LiteLLM message ready for OpenAI models.
+
+    Content blocks are flattened to a single string in one pass over the
+    message, as OpenAI models require.
+    """
+    content = msg.content
+    if isinstance(content, str):
+        return {"role": msg.role, "content": content}
+
+    if has_tool_result(msg):
+        return {"role": "user", "content": tool_results_to_user_text(content)}
+
+    parts = []
+    if content and all(block.type == "tool_result" for block in content):
+        logger.warning("Found message with only tool_result content - special handling required")
+        for block in content:
+            parts.append("Tool Result:\n")
+            append_tool_result_text(parts, block)
+        text = "".join(parts).strip()
+        logger.warning("Converted tool_result to plain text: %.200s...", text)
+        return {"role": msg.role, "content": text or "..."}
+
+    for block in content:
+        if block.type == "text":
+            parts.append(block.text)
+            parts.append("\n")
+        elif block.type == "tool_result":
+            parts.append(f"[Tool Result ID: {block.tool_use_id}]\n")
+            append_tool_result_text(parts, block)
+        elif block.type == "tool_use":
+            parts.append(f"[Tool: {block.name} (ID: {block.id})]\nInput: {json.dumps(block.input)}\n\n")
+        elif block.type == "image":
+            parts.append("[Image content - not displayed in text format]\n")
+
+    # Make sure content is never empty for OpenAI models
+    return {"role": msg.role, "content": "".join(parts).strip() or "..."}
+
+def image_block_to_openai(block: ContentBlockImage) -> Dict[str, Any]:
+    """Convert an Anthropic image block to an OpenAI image_url content part."""
+    source = block.source
+    if source.get("type") == "base64":
+        url = f"data:{source.get('media_type', 'image/png')};base64,{source.get('data', '')}"
+    else:
+        url = source.get("url", "")
+    return {"type": "image_url", "image_url": {"url": url}}
+
+def translate_message_native(msg: Message) -> List[Dict[str, Any]]:
+    """Convert a single Anthropic message to OpenAI messages with native tool calls.
+
+    tool_use blocks become the assistant's tool_calls and each tool_result
+    becomes a role "tool" message, so one Anthropic message can map to
+    several OpenAI messages.
+    """
+    content = msg.content
+    if isinstance(content, str):
+        return [{"role": msg.role, "content": content}]
+
+    messages = []
+    parts = []  # Text and image content parts, in order
+    tool_calls = []
+    for block in content:
+        if block.type == "text":
+            parts.append({"type": "text", "text": block.text})
+        elif block.type == "image":
+            parts.append(image_block_to_openai(block))
+        elif block.type == "tool_use":
+            tool_calls.append({
+                "id": block.id,
+                "type": "function",
+                "function": {"name": block.name, "arguments": json.dumps(block.input)},
+            })
+        elif block.type == "tool_result":
+            result_text = tool_result_to_text(block.content).strip()
+            if msg.role == "user":
+                # Tool messages have to directly follow the assistant's tool calls
+                messages.append({"role": "tool", "tool_call_id": block.tool_use_id, "content": result_text or "..."})
+            else:
+                parts.append({"type": "text", "text": f"[Tool Result ID: {block.tool_use_id}]\n{result_text}"})
+
+    if msg.role == "assistant":
+        text = "".join(part["text"] + "\n" for part in parts if part["type"] == "text").strip()
+        assistant_msg = {"role": "assistant", "content": text or (None if tool_calls else "...")}
+        if tool_calls:
+            assistant_msg["tool_calls"] = tool_calls
+        messages.append(assistant_msg)
+    elif parts:
+        if all(part["type"] == "text" for part in parts):
+            user_content = "".join(part["text"] + "\n" for part in parts).strip()
+            if user_content:
+                messages.append({"role": "user", "content": user_content})
+        else:
+            messages.append({"role": "user", "content": parts})
+    elif not messages:
+        messages.append({"role": "user", "content": "..."})
+    return messages
+
+def convert_system_to_litellm(system: Optional[Union[str, List[Any]]]) -> Optional[Dict[str, Any]]:
+    """Convert an Anthropic system prompt to a LiteLLM system message, if there is one."""
+    if not system:
+        return None
+    # Handle different formats of system messages
+    if isinstance(system, str):
+        # Simple string format
+        return {"role": "system", "content": system}
+    if isinstance(system, list):
+        # List of content blocks
+        system_parts = []
+        for block in system:
+            if hasattr(block, 'type') and block.type == "text":
+                system_parts.append(block.text)
+            elif isinstance(block, dict) and block.get("type") == "text":
+                system_parts.append(block.get("text", ""))
+        
+        if system_parts:
+            return {"role": "system", "content": "\n\n".join(system_parts).strip()}
+    return None
+
+def get_message_translator(flatten_for_openai: bool = False, tool_message_format: Optional[str] = None):
+    """Return (translate_message, flavor) for a translation target.
+
+    The native translator returns a list of messages per Anthropic message,
+    the others a single message.
+    """
+    if (tool_message_format or TOOL_MESSAGE_FORMAT) == "native":
+        return translate_message_native, "native"
+    if flatten_for_openai:
+        return translate_message_for_openai, "openai"
+    return convert_message_to_litellm, "litellm"
+
+def convert_tools_to_openai(tools: List[Any], model: str) -> List[Dict[str, Any]]:
+    """Convert Anthropic tool definitions to OpenAI function tools for model."""
+    openai_tools = []
+    is_gemini_model = model.startswith("gemini/")
+
+    for tool in tools:
+        # Read the fields directly if it's a pydantic model
+        if isinstance(tool, Tool):
+            tool_dict = {"name": tool.name, "description": tool.description, "input_schema": tool.input_schema}
+        else:
+            # Ensure tool_dict is a dictionary, handle potential errors if 'tool' isn't dict-like
+            try:
+                tool_dict = dict(tool) if not isinstance(tool, dict) else tool
+            except (TypeError, ValueError):
+                 logger.error("Could not convert tool to dict: %s", tool)
+                 continue # Skip this tool if conversion fails
+
+        openai_tools.append(get_openai_tool(tool_dict, is_gemini_model))
+    return openai_tools
+
+def convert_tool_choice_to_openai(tool_choice: Any) -> Union[str, Dict[str, Any]]:
+    """Convert an Anthropic tool_choice to the OpenAI format."""
+    if hasattr(tool_choice, 'dict'):
+        tool_choice_dict = tool_choice.dict()
+    else:
+        tool_choice_dict = tool_choice
+        
+    # Handle Anthropic's tool_choice format
+    choice_type = tool_choice_dict.get("type")
+    if choice_type == "auto":
+        return "auto"
+    elif choice_type == "any":
+        return "any"
+    elif choice_type == "tool" and "name" in tool_choice_dict:
+        return {
+            "type": "function",
+            "function": {"name": tool_choice_dict["name"]}
+        }
+    # Default to auto if we can't determine
+    return "auto"
+
+def convert_anthropic_to_litellm(anthropic_request: MessagesRequest, flatten_for_openai: bool = False,
+                                 tool_message_format: Optional[str] = None) -> Dict[str, Any]:
+    """Convert Anthropic API request format to LiteLLM format (which follows OpenAI).
+
+    With flatten_for_openai, content blocks are also flattened to plain text,
+    as OpenAI models require. tool_message_format overrides TOOL_MESSAGE_FORMAT;
+    with "native", tool blocks are sent as OpenAI tool calls for every provider.
+    """
     # LiteLLM already handles Anthropic models when using the format model="anthropic/claude-3-opus-20240229"
     # So we just need to convert our Pydantic model to a dict in the expected format
     
     messages = []
     
     # Add system message if present
-    if anthropic_request.system:
-        # Handle different formats of system messages
-        if isinstance(anthropic_request.system, str):
-            # Simple string format
-            messages.append({"role": "system", "content": anthropic_request.system})
-        elif isinstance(anthropic_request.system, list):
-            # List of content blocks
-            system_text = ""
-            for block in anthropic_request.system:
-                if hasattr(block, 'type') and block.type == "text":
-                    system_text += block.text + "\n\n"
-                elif isinstance(block, dict) and block.get("type") == "text":
-                    system_text += block.get("text", "") + "\n\n"
-            
-            if system_text:
-                messages.append({"role": "system", "content": system_text.strip()})
+    system_message = convert_system_to_litellm(anthropic_request.system)
+    if system_message:
+        messages.append(system_message)
     
-    # Add conversation messages
-    for idx, msg in enumerate(anthropic_request.messages):
-        content = msg.content
-        if isinstance(content, str):
-            messages.append({"role": msg.role, "content": content})
-        else:
-            # Special handling for tool_result in user messages
-            # OpenAI/LiteLLM format expects the assistant to call the tool, 
-            # and the user's next message to include the result as plain text
-            if msg.role == "user" and any(block.type == "tool_result" for block in content if hasattr(block, "type")):
-                # For user messages with tool_result, split into separate messages
-                text_content = ""
-                
-                # Extract all text parts and concatenate them
-                for block in content:
-                    if hasattr(block, "type"):
-                        if block.type == "text":
-                            text_content += block.text + "\n"
-                        elif block.type == "tool_result":
-                            # Add tool result as a message by itself - simulate the normal flow
-                            tool_id = block.tool_use_id if hasattr(block, "tool_use_id") else ""
-                            
-                            # Handle different formats of tool result content
-                            result_content = ""
-                            if hasattr(block, "content"):
-                                if isinstance(block.content, str):
-                                    result_content = block.content
-                                elif isinstance(block.content, list):
-                                    # If content is a list of blocks, extract text from each
-                                    for content_block in block.content:
-                                        if hasattr(content_block, "type") and content_block.type == "text":
-                                            result_content += content_block.text + "\n"
-                                        elif isinstance(content_block, dict) and content_block.get("type") == "text":
-                                            result_content += content_block.get("text", "") + "\n"
-                                        elif isinstance(content_block, dict):
-                                            # Handle any dict by trying to extract text or convert to JSON
-                                            if "text" in content_block:
-                                                result_content += content_block.get("text", "") + "\n"
-                                            else:
-                                                try:
-                                                    result_content += json.dumps(content_block) + "\n"
-                                                except:
-                                                    result_content += str(content_block) + "\n"
-                                elif isinstance(block.content, dict):
-                                    # Handle dictionary content
-                                    if block.content.get("type") == "text":
-                                        result_content = block.content.get("text", "")
-                                    else:
-                                        try:
-                                            result_content = json.dumps(block.content)
-                                        except:
-                                            result_content = str(block.content)
-                                else:
-                                    # Handle any other type by converting to string
-                                    try:
-                                        result_content = str(block.content)
-                                    except:
-                                        result_content = "Unparseable content"
-                            
-                            # In OpenAI format, tool results come from the user (rather than being content blocks)
-                            text_content += f"Tool result for {tool_id}:\n{result_content}\n"
-                
-                # Add as a single user message with all the content
-                messages.append({"role": "user", "content": text_content.strip()})
-            else:
-                # Regular handling for other message types
-                processed_content = []
-                for block in content:
-                    if hasattr(block, "type"):
-                        if block.type == "text":
-                            processed_content.append({"type": "text", "text": block.text})
-                        elif block.type == "image":
-                            processed_content.append({"type": "image", "source": block.source})
-                        elif block.type == "tool_use":
-                            # Handle tool use blocks if needed
-                            processed_content.append({
-                                "type": "tool_use",
-                                "id": block.id,
-                                "name": block.name,
-                                "input": block.input
-                            })
-                        elif block.type == "tool_result":
-                            # Handle different formats of tool result content
-                            processed_content_block = {
-                                "type": "tool_result",
-                                "tool_use_id": block.tool_use_id if hasattr(block, "tool_use_id") else ""
-                            }
-                            
-                            # Process the content field properly
-                            if hasattr(block, "content"):
-                                if isinstance(block.content, str):
-                                    # If it's a simple string, create a text block for it
-                                    processed_content_block["content"] = [{"type": "text", "text": block.content}]
-                                elif isinstance(block.content, list):
-                                    # If it's already a list of blocks, keep it
-                                    processed_content_block["content"] = block.content
-                                else:
-                                    # Default fallback
-                                    processed_content_block["content"] = [{"type": "text", "text": str(block.content)}]
-                            else:
-                                # Default empty content
-                                processed_content_block["content"] = [{"type": "text", "text": ""}]
-                                
-                            processed_content.append(processed_content_block)
-                
-                messages.append({"role": msg.role, "content": processed_content})
+    # Add conversation messages, reusing the translation of any previously seen prefix
+    translate_message, flavor = get_message_translator(flatten_for_openai, tool_message_format)
+    with tracing.span("translate_messages", **{"proxy.flavor": flavor}):
+        translated = conversation_cache.translate(
+            anthropic_request.messages, translate_message, flavor, raw_messages=anthropic_request._raw_messages
+        )
+    if flavor == "native":
+        for message_group in translated:
+            messages.extend(message_group)
+    else:
+        messages.extend(translated)
     
     # Cap max_tokens for OpenAI models to their limit of 16384
     max_tokens = anthropic_request.max_tokens
     if anthropic_request.model.startswith("openai/") or anthropic_request.model.startswith("gemini/"):
         max_tokens = min(max_tokens, 16384)
-        logger.debug(f"Capping max_tokens to 16384 for OpenAI/Gemini model (original value: {anthropic_request.max_tokens})")
+        logger.debug("Capping max_tokens to 16384 for OpenAI/Gemini model (original value: %s)", anthropic_request.max_tokens)
     
     # Create LiteLLM request dict
     litellm_request = {
@@ -558,67 +1295,162 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
     
     # Convert tools to OpenAI format
     if anthropic_request.tools:
-        openai_tools = []
-        is_gemini_model = anthropic_request.model.startswith("gemini/")
-
-        for tool in anthropic_request.tools:
-            # Convert to dict if it's a pydantic model
-            if hasattr(tool, 'dict'):
-                tool_dict = tool.dict()
-            else:
-                # Ensure tool_dict is a dictionary, handle potential errors if 'tool' isn't dict-like
-                try:
-                    tool_dict = dict(tool) if not isinstance(tool, dict) else tool
-                except (TypeError, ValueError):
-                     logger.error(f"Could not convert tool to dict: {tool}")
-                     continue # Skip this tool if conversion fails
-
-            # Clean the schema if targeting a Gemini model
-            input_schema = tool_dict.get("input_schema", {})
-            if is_gemini_model:
-                 logger.debug(f"Cleaning schema for Gemini tool: {tool_dict.get('name')}")
-                 input_schema = clean_gemini_schema(input_schema)
-
-            # Create OpenAI-compatible function tool
-            openai_tool = {
-                "type": "function",
-                "function": {
-                    "name": tool_dict["name"],
-                    "description": tool_dict.get("description", ""),
-                    "parameters": input_schema # Use potentially cleaned schema
-                }
-            }
-            openai_tools.append(openai_tool)
-
-        litellm_request["tools"] = openai_tools
+        litellm_request["tools"] = convert_tools_to_openai(anthropic_request.tools, anthropic_request.model)
     
     # Convert tool_choice to OpenAI format if present
     if anthropic_request.tool_choice:
-        if hasattr(anthropic_request.tool_choice, 'dict'):
-            tool_choice_dict = anthropic_request.tool_choice.dict()
-        else:
-            tool_choice_dict = anthropic_request.tool_choice
-            
-        # Handle Anthropic's tool_choice format
-        choice_type = tool_choice_dict.get("type")
-        if choice_type == "auto":
-            litellm_request["tool_choice"] = "auto"
-        elif choice_type == "any":
-            litellm_request["tool_choice"] = "any"
-        elif choice_type == "tool" and "name" in tool_choice_dict:
-            litellm_request["tool_choice"] = {
-                "type": "function",
-                "function": {"name": tool_choice_dict["name"]}
-            }
-        else:
-            # Default to auto if we can't determine
-            litellm_request["tool_choice"] = "auto"
+        litellm_request["tool_choice"] = convert_tool_choice_to_openai(anthropic_request.tool_choice)
     
     return litellm_request
 
+class TokenCounter:
+    """Counts prompt tokens for /v1/messages/count_tokens without building a LiteLLM request.
+
+    LiteLLM's token_counter adds up a count per message plus a fixed amount
+    for the tool definitions, so each part is counted once and cached:
+    messages by a hash of their content, and the tool and tool_choice
+    overhead by a hash of the definitions. Totals are also kept per request,
+    so an exact repeat costs one hash of the request. Tokenizers are selected
+    once per model and reused.
+    """
+
+    def __init__(self, max_entries: int):
+        self.lock = threading.Lock()  # Serializes count_in_thread, whose worker threads share the caches
+        self.message_counts = LRUCache(max_entries)  # (model, flavor, message hash) -> tokens
+        self.extra_counts = LRUCache(max(16, max_entries // 64))  # (model, has system, tools hash) -> tokens
+        self.request_counts = LRUCache(max(16, max_entries // 64))  # (model, flavor, request hash) -> tokens
+        self.tokenizers: Dict[str, Any] = {}
+
+    def get_tokenizer(self, model: str) -> Optional[Any]:
+        """Return the tokenizer LiteLLM would pick for model, loading it once."""
+        if model not in self.tokenizers:
+            try:
+                from litellm.utils import _select_tokenizer
+                self.tokenizers[model] = _select_tokenizer(model)
+            except Exception as e:
+                # Let LiteLLM select the tokenizer on every call instead
+                logger.debug("Could not preload tokenizer for %s: %s", model, e)
+                self.tokenizers[model] = None
+        return self.tokenizers[model]
+
+    def count_messages(self, model: str, messages: List[Dict[str, Any]], **kwargs) -> int:
+        return litellm.token_counter(model=model, custom_tokenizer=self.get_tokenizer(model), messages=messages, **kwargs)
+
+    def count_message(self, model: str, key: Any, translate) -> int:
+        """Return the token count of one message, translating it with translate() on a cache miss."""
+        cache_key = (model, key)
+        count = self.message_counts.get(cache_key)
+        if count is None:
+            translated = translate()
+            if isinstance(translated, dict):
+                translated = [translated]
+            # count_response_tokens leaves out the per-request overhead
+            count = self.count_messages(model, translated, count_response_tokens=True)
+            self.message_counts.put(cache_key, count)
+        return count
+
+    def count_extra(self, model: str, has_system: bool, tools: Optional[List[Tool]], tool_choice: Optional[Dict[str, Any]],
+                    tools_hash: bytes) -> int:
+        """Return the per-request overhead: reply priming, tool definitions and tool_choice."""
+        key = (model, has_system, tools_hash)
+        count = self.extra_counts.get(key)
+        if count is None:
+            # LiteLLM only checks whether there is a system message, so an empty one stands in for it
+            messages = [{"role": "system", "content": ""}] if has_system else []
+            openai_tools = convert_tools_to_openai(tools, model) if tools else None
+            openai_tool_choice = convert_tool_choice_to_openai(tool_choice) if tool_choice else None
+            count = (
+                self.count_messages(model, messages, tools=openai_tools, tool_choice=openai_tool_choice)
+                - self.count_messages(model, messages, count_response_tokens=True)
+            )
+            self.extra_counts.put(key, count)
+        return count
+
+    @staticmethod
+    def encode(value: Any, model: Optional[BaseModel] = None) -> bytes:
+        """Serialize raw JSON data for hashing, or model if value isn't JSON serializable."""
+        if isinstance(value, BaseModel):
+            return value.__pydantic_serializer__.to_json(value)
+        try:
+            return fast_json_dumps(value)
+        except (TypeError, ValueError):
+            if model is None:
+                raise
+            return model.__pydantic_serializer__.to_json(model)
+
+    def count(self, request: TokenCountRequest) -> int:
+        """Return the number of input tokens request would use, as litellm.token_counter counts them."""
+        model = request.model
+        translate_message, flavor = get_message_translator()
+
+        raw_messages = request._raw_messages
+        if raw_messages is None or len(raw_messages) != len(request.messages):
+            raw_messages = request.messages
+        raw_tools = request._raw_tools
+        if raw_tools is None or len(raw_tools) != len(request.tools or []):
+            raw_tools = request.tools or []
+        system_message = convert_system_to_litellm(request.system)
+
+        tools_hasher = hashlib.sha256()
+        for raw_tool, tool in zip(raw_tools, request.tools or []):
+            tools_hasher.update(self.encode(raw_tool, tool))
+            tools_hasher.update(b"\x00")
+        if request.tool_choice:
+            tools_hasher.update(canonical_json(request.tool_choice))
+        tools_hash = tools_hasher.digest()
+
+        # Exact repeats of a request skip the per-message work
+        request_hasher = hashlib.sha256(tools_hash)
+        if system_message:
+            request_hasher.update(system_message["content"].encode("utf-8"))
+        request_hasher.update(b"\x00")
+        try:
+            request_hasher.update(fast_json_dumps(raw_messages) if raw_messages is not request.messages
+                                  else b"".join(self.encode(msg) for msg in raw_messages))
+        except (TypeError, ValueError):
+            request_hasher.update(b"".join(self.encode(msg) for msg in request.messages))
+        request_key = (model, flavor, request_hasher.digest())
+        total = self.request_counts.get(request_key)
+        if total is not None:
+            return total
+
+        total = 0
+        if system_message:
+            system_hash = hashlib.sha256(system_message["content"].encode("utf-8")).digest()
+            total += self.count_message(model, ("system", system_hash), lambda: system_message)
+
+        for msg, raw_msg in zip(request.messages, raw_messages):
+            key = (flavor, hashlib.sha256(self.encode(raw_msg, msg)).digest())
+            total += self.count_message(model, key, lambda: translate_message(msg))
+
+        total += self.count_extra(model, system_message is not None, request.tools, request.tool_choice, tools_hash)
+        self.request_counts.put(request_key, total)
+        return total
+
+    async def count_in_thread(self, request: TokenCountRequest) -> int:
+        """Run count() in a worker thread, so a cold count doesn't stall the event loop."""
+        def count_locked():
+            with self.lock:
+                return self.count(request)
+        return await asyncio.to_thread(count_locked)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.request_counts.stats(), "messages": self.message_counts.stats(),
+            "extra": self.extra_counts.stats(), "tokenizers": len(self.tokenizers),
+        }
+
+prompt_token_counter = TokenCounter(TOKEN_COUNT_CACHE_SIZE)
+
 def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any], 
-                                 original_request: MessagesRequest) -> MessagesResponse:
-    """Convert LiteLLM (OpenAI format) response to Anthropic API response format."""
+                                 original_request: MessagesRequest,
+                                 tool_message_format: Optional[str] = None) -> MessagesResponse:
+    """Convert LiteLLM (OpenAI format) response to Anthropic API response format.
+
+    Tool calls become tool_use blocks for Claude models, or for every model
+    with the "native" tool_message_format (default TOOL_MESSAGE_FORMAT).
+    Otherwise they are appended to the text.
+    """
     
     # Enhanced response extraction with better error handling
     try:
@@ -631,6 +1463,7 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
         
         # Check if this is a Claude model (which supports content blocks)
         is_claude_model = clean_model.startswith("claude-")
+        native_tool_calls = is_claude_model or (tool_message_format or TOOL_MESSAGE_FORMAT) == "native"
         
         # Handle ModelResponse object from LiteLLM
         if hasattr(litellm_response, 'choices') and hasattr(litellm_response, 'usage'):
@@ -675,16 +1508,16 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
         if content_text is not None and content_text != "":
             content.append({"type": "text", "text": content_text})
         
-        # Add tool calls if present (tool_use in Anthropic format) - only for Claude models
-        if tool_calls and is_claude_model:
-            logger.debug(f"Processing tool calls: {tool_calls}")
+        # Add tool calls if present (tool_use in Anthropic format) - for Claude models or native tool calls
+        if tool_calls and native_tool_calls:
+            logger.debug("Processing tool calls: %s", tool_calls)
             
             # Convert to list if it's not already
             if not isinstance(tool_calls, list):
                 tool_calls = [tool_calls]
                 
             for idx, tool_call in enumerate(tool_calls):
-                logger.debug(f"Processing tool call {idx}: {tool_call}")
+                logger.debug("Processing tool call %s: %s", idx, tool_call)
                 
                 # Extract function data based on whether it's a dict or object
                 if isinstance(tool_call, dict):
@@ -703,10 +1536,10 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                     try:
                         arguments = json.loads(arguments)
                     except json.JSONDecodeError:
-                        logger.warning(f"Failed to parse tool arguments as JSON: {arguments}")
+                        logger.warning("Failed to parse tool arguments as JSON: %s", arguments)
                         arguments = {"raw": arguments}
                 
-                logger.debug(f"Adding tool_use block: id={tool_id}, name={name}, input={arguments}")
+                logger.debug("Adding tool_use block: id=%s, name=%s, input=%s", tool_id, name, arguments)
                 
                 content.append({
                     "type": "tool_use",
@@ -714,9 +1547,9 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                     "name": name,
                     "input": arguments
                 })
-        elif tool_calls and not is_claude_model:
+        elif tool_calls and not native_tool_calls:
             # For non-Claude models, convert tool calls to text format
-            logger.debug(f"Converting tool calls to text for non-Claude model: {clean_model}")
+            logger.debug("Converting tool calls to text for non-Claude model: %s", clean_model)
             
             # We'll append tool info to the text content
             tool_text = "\n\nTool usage:\n"
@@ -796,10 +1629,7 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
         return anthropic_response
         
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        error_message = f"Error converting response: {str(e)}\n\nFull traceback:\n{error_traceback}"
-        logger.error(error_message)
+        logger.error("Error converting response: %s", e, exc_info=True)
         
         # In case of any error, create a fallback response
         return MessagesResponse(
@@ -811,16 +1641,965 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             usage=Usage(input_tokens=0, output_tokens=0)
         )
 
-async def handle_streaming(response_generator, original_request: MessagesRequest):
-    """Handle streaming responses from LiteLLM and convert to Anthropic format."""
+# SSE encoding - frames are built as bytes. Fixed frames are encoded once, and
+# delta frames only escape the text that changes, using the same output format
+# as json.dumps so clients see identical bytes.
+def sse_event(event_type: str, data: Dict[str, Any]) -> bytes:
+    """Encode a single SSE frame."""
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+SSE_PING = sse_event("ping", {"type": "ping"})
+SSE_MESSAGE_STOP = sse_event("message_stop", {"type": "message_stop"})
+SSE_DONE = b"data: [DONE]\n\n"
+SSE_TEXT_BLOCK_START = sse_event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+
+@functools.lru_cache(maxsize=128)
+def sse_content_block_stop(index: int) -> bytes:
+    return sse_event("content_block_stop", {"type": "content_block_stop", "index": index})
+
+@functools.lru_cache(maxsize=256)
+def _sse_delta_prefix(index: int, delta_type: str, field: str) -> bytes:
+    # Everything up to the opening quote of the changing field's value
+    return (
+        'event: content_block_delta\ndata: {"type": "content_block_delta", '
+        f'"index": {index}, "delta": {{"type": "{delta_type}", "{field}": '
+    ).encode("utf-8")
+
+def sse_text_delta(index: int, text: str) -> bytes:
+    return _sse_delta_prefix(index, "text_delta", "text") + encode_basestring_ascii(text).encode("ascii") + b"}}\n\n"
+
+def sse_input_json_delta(index: int, partial_json: str) -> bytes:
+    return _sse_delta_prefix(index, "input_json_delta", "partial_json") + encode_basestring_ascii(partial_json).encode("ascii") + b"}}\n\n"
+
+def sse_message_delta(stop_reason: str, output_tokens: int) -> bytes:
+    return sse_event("message_delta", {"type": "message_delta", "delta": {"stop_reason": stop_reason, "stop_sequence": None}, "usage": {"output_tokens": output_tokens}})
+
+def get_text_only_delta(chunk) -> Optional[str]:
+    """Return the text of a chunk that carries nothing but a text delta, otherwise None."""
+    if getattr(chunk, 'usage', None) is not None:
+        return None
+    choices = getattr(chunk, 'choices', None)
+    if not choices or len(choices) != 1:
+        return None
+    choice = choices[0]
+    if getattr(choice, 'finish_reason', None):
+        return None
+    delta = getattr(choice, 'delta', None)
+    if delta is None or getattr(delta, 'tool_calls', None):
+        return None
+    content = getattr(delta, 'content', None)
+    return content if isinstance(content, str) and content else None
+
+def make_text_chunk(text: str):
+    """Build a minimal streaming chunk carrying only a text delta."""
+    delta = SimpleNamespace(content=text, tool_calls=None)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+
+async def close_stream(stream):
+    """Close a chunk stream that may not have been read to the end, which stops the upstream call behind it.
+
+    Each wrapper around an upstream stream closes the stream it wraps, so
+    closing the outermost one reaches the provider's connection.
+    """
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+async def coalesce_text_chunks(response_generator, window_ms: float = None, max_bytes: int = None):
+    """Merge runs of small text-only chunks from upstream into larger chunks.
+
+    The first text chunk is passed through immediately. After that, text is
+    buffered until max_bytes is reached, the window elapses, or a chunk that
+    isn't plain text (tool call, finish, usage) arrives - in which case the
+    buffer is flushed first so event order is preserved.
+    """
+    window = (STREAM_COALESCE_MS if window_ms is None else window_ms) / 1000
+    max_bytes = STREAM_COALESCE_BYTES if max_bytes is None else max_bytes
+    loop = asyncio.get_running_loop()
+    iterator = response_generator.__aiter__()
+    buffer = []
+    buffered_bytes = 0
+    deadline = None
+    first_text_sent = False
+    pending = None
     try:
-        # Send message_start event
-        message_id = f"msg_{uuid.uuid4().hex[:24]}"  # Format similar to Anthropic's IDs
-        
-        message_data = {
-            'type': 'message_start',
-            'message': {
-                'id': message_id,
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                # Window elapsed while waiting on upstream - flush what we have
+                yield make_text_chunk("".join(buffer))
+                buffer, buffered_bytes, deadline = [], 0, None
+                continue
+
+            finished, pending = pending, None
+            try:
+                chunk = finished.result()
+            except StopAsyncIteration:
+                break
+
+            text = get_text_only_delta(chunk)
+            if text is None:
+                if buffer:
+                    yield make_text_chunk("".join(buffer))
+                    buffer, buffered_bytes, deadline = [], 0, None
+                yield chunk
+            elif not first_text_sent:
+                first_text_sent = True
+                yield chunk
+            else:
+                buffer.append(text)
+                buffered_bytes += len(text.encode("utf-8"))
+                if deadline is None:
+                    deadline = loop.time() + window
+                if buffered_bytes >= max_bytes or loop.time() >= deadline:
+                    yield make_text_chunk("".join(buffer))
+                    buffer, buffered_bytes, deadline = [], 0, None
+
+        if buffer:
+            yield make_text_chunk("".join(buffer))
+    finally:
+        if pending is not None:
+            # The read must be finished before the generator can be closed
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await close_stream(response_generator)
+
+def get_field(obj: Any, name: str, default: Any = None) -> Any:
+    """Read a field from a LiteLLM object or its dict form."""
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+def completion_record_from_response(litellm_response: Any) -> Dict[str, Any]:
+    """Reduce a non-streaming LiteLLM response to the parts the proxy uses."""
+    choices = get_field(litellm_response, "choices") or [{}]
+    message = get_field(choices[0], "message") or {}
+    usage = get_field(litellm_response, "usage") or {}
+    tool_calls = []
+    for tool_call in get_field(message, "tool_calls") or []:
+        function = get_field(tool_call, "function") or {}
+        tool_calls.append({
+            "id": get_field(tool_call, "id"),
+            "name": get_field(function, "name", ""),
+            "arguments": get_field(function, "arguments", ""),
+        })
+    return {
+        "text": get_field(message, "content") or "",
+        "tool_calls": tool_calls,
+        "finish_reason": get_field(choices[0], "finish_reason") or "stop",
+        "prompt_tokens": get_field(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": get_field(usage, "completion_tokens", 0) or 0,
+    }
+
+def completion_record_to_response(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Rebuild an OpenAI-style response dict, as convert_litellm_to_anthropic expects, from a record."""
+    tool_calls = [
+        {"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": call["arguments"]}}
+        for call in record["tool_calls"]
+    ]
+    return {
+        "id": f"msg_{uuid.uuid4()}",
+        "choices": [{
+            "message": {"content": record["text"] or None, "tool_calls": tool_calls or None},
+            "finish_reason": record["finish_reason"],
+        }],
+        "usage": {"prompt_tokens": record["prompt_tokens"], "completion_tokens": record["completion_tokens"]},
+    }
+
+async def replay_completion_record(record: Dict[str, Any]):
+    """Yield streaming chunks for a record, so handle_streaming can replay it as SSE."""
+    if record["text"]:
+        yield make_text_chunk(record["text"])
+    for index, call in enumerate(record["tool_calls"]):
+        tool_call = SimpleNamespace(index=index, id=call["id"], function=SimpleNamespace(name=call["name"], arguments=call["arguments"]))
+        delta = SimpleNamespace(content=None, tool_calls=[tool_call])
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+    usage = SimpleNamespace(prompt_tokens=record["prompt_tokens"], completion_tokens=record["completion_tokens"])
+    delta = SimpleNamespace(content=None, tool_calls=None)
+    yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=record["finish_reason"])], usage=usage)
+
+async def record_stream(response_generator, on_complete):
+    """Pass streaming chunks through while collecting them into a completion record.
+
+    on_complete(record) is awaited once the finish chunk and the usage have
+    both arrived, before the chunk that completes them is passed on -
+    handle_streaming stops reading after the finish chunk. Usage that
+    follows the finish chunk in its own chunk (OpenAI's include_usage) is
+    waited for, and a stream closed before it comes is recorded as it is.
+    Streams that end without a finish reason are not recorded.
+    """
+    text_parts = []
+    tool_calls = {}  # Upstream tool call index -> call
+    prompt_tokens = completion_tokens = 0
+    record = None  # Built at the finish chunk, stored once the usage is in
+    try:
+        async for chunk in response_generator:
+            finish_reason = None
+            try:
+                usage = get_field(chunk, "usage")
+                if usage is not None:
+                    prompt_tokens = get_field(usage, "prompt_tokens", prompt_tokens) or prompt_tokens
+                    completion_tokens = get_field(usage, "completion_tokens", completion_tokens) or completion_tokens
+                choices = get_field(chunk, "choices") or []
+                if choices and record is None:
+                    delta = get_field(choices[0], "delta") or {}
+                    content = get_field(delta, "content")
+                    if content:
+                        text_parts.append(content)
+                    for tool_call in get_field(delta, "tool_calls") or []:
+                        call = tool_calls.setdefault(get_field(tool_call, "index", 0), {"id": None, "name": "", "arguments": ""})
+                        function = get_field(tool_call, "function")
+                        call["id"] = get_field(tool_call, "id") or call["id"]
+                        call["name"] = get_field(function, "name") or call["name"]
+                        call["arguments"] += get_field(function, "arguments") or ""
+                    finish_reason = get_field(choices[0], "finish_reason")
+            except Exception as e:
+                logger.debug("Could not record streaming chunk: %s", e)
+                usage = finish_reason = record = None
+                on_complete = None  # Don't cache a partial record
+            if finish_reason and on_complete is not None:
+                record = {
+                    "text": "".join(text_parts),
+                    "tool_calls": [tool_calls[index] for index in sorted(tool_calls)],
+                    "finish_reason": finish_reason,
+                }
+            if record is not None and usage is not None:
+                record.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+                await on_complete(record)
+                record = on_complete = None
+            yield chunk
+    finally:
+        if record is not None:
+            # Closed or ended after the finish chunk, without usage
+            record.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            await on_complete(record)
+        await close_stream(response_generator)
+
+# Shared state for multi-worker deployments. Rate limits, the response cache
+# and metrics can keep their state in a store with a small key-value API, so
+# that uvicorn's worker processes share it. Values are bytes; incr keeps a
+# number as its decimal text, like Redis' INCRBYFLOAT.
+
+class SharedStoreError(Exception):
+    """A shared store replied with an error."""
+
+class MemorySharedStore:
+    """Store in this process only - the default, for a single worker."""
+
+    shared = False
+    blocking = False
+
+    def __init__(self):
+        self.entries = {}  # key -> (expiry time, value)
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        self.entries[key] = (time.time() + ttl if ttl else math.inf, value)
+        return True
+
+    def incr(self, key: str, amount: float, ttl: Optional[float] = None) -> float:
+        """Add amount to the number at key and return the total. A new key gets the ttl."""
+        current = self.get(key)
+        if current is None:
+            total, expiry = amount, time.time() + ttl if ttl else math.inf
+        else:
+            total, expiry = float(current) + amount, self.entries[key][0]
+        self.entries[key] = (expiry, repr(total).encode("ascii"))
+        return total
+
+    def delete(self, key: str):
+        self.entries.pop(key, None)
+
+    def keys(self, prefix: str) -> List[str]:
+        return [key for key in list(self.entries) if key.startswith(prefix) and self.get(key) is not None]
+
+    def close(self):
+        pass
+
+class SharedMemoryStore:
+    """Store in a memory-mapped file that every worker on the host maps.
+
+    The file holds a fixed table of slots, each with one key and its value in
+    at most slot_size bytes. A key lives in one of the PROBES slots after its
+    hash; when those are all in use, the entry closest to expiry is evicted.
+    An flock on the file serializes access between processes.
+    """
+
+    shared = True
+    blocking = False
+    MAGIC = b"APXSTOR1"
+    HEADER = struct.Struct("<8sII")  # magic, slots, slot size
+    SLOT = struct.Struct("<QdHI")  # key hash (0 when free), expiry, key length, value length
+    PROBES = 8
+
+    def __init__(self, path: str, slots: int, slot_size: int):
+        import fcntl
+        self.fcntl = fcntl
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.lock = threading.Lock()  # flock doesn't exclude other threads using the same file
+        size = self.HEADER.size + slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                header = os.pread(self.fd, self.HEADER.size, 0)
+                if header != self.HEADER.pack(self.MAGIC, slots, slot_size):
+                    if header.strip(b"\0"):
+                        logger.warning("Resetting shared store %s, which has a different layout", path)
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, slots, slot_size), 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.map = mmap.mmap(self.fd, size)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            self.fcntl.flock(self.fd, self.fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self.fcntl.flock(self.fd, self.fcntl.LOCK_UN)
+
+    @staticmethod
+    def hash(key: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+    def offset(self, index: int) -> int:
+        return self.HEADER.size + index * self.slot_size
+
+    def find(self, key: bytes):
+        """Return the offset of key's live slot, or None and the offset to store it at."""
+        key_hash = self.hash(key)
+        now = time.time()
+        free = evict = None
+        evict_expiry = math.inf
+        for probe in range(self.PROBES):
+            offset = self.offset((key_hash + probe) % self.slots)
+            slot_hash, expiry, key_length, _ = self.SLOT.unpack_from(self.map, offset)
+            if slot_hash == 0 or expiry <= now:
+                if free is None:
+                    free = offset
+                continue
+            if slot_hash == key_hash and self.map[offset + self.SLOT.size:offset + self.SLOT.size + key_length] == key:
+                return offset, None
+            if expiry < evict_expiry:
+                evict, evict_expiry = offset, expiry
+        return None, free if free is not None else evict
+
+    def value_at(self, offset: int) -> bytes:
+        _, _, key_length, value_length = self.SLOT.unpack_from(self.map, offset)
+        start = offset + self.SLOT.size + key_length
+        return self.map[start:start + value_length]
+
+    def write(self, offset: int, key: bytes, value: bytes, expiry: float):
+        self.SLOT.pack_into(self.map, offset, self.hash(key), expiry, len(key), len(value))
+        start = offset + self.SLOT.size
+        self.map[start:start + len(key) + len(value)] = key + value
+
+    def fits(self, key: bytes, value: bytes) -> bool:
+        return self.SLOT.size + len(key) + len(value) <= self.slot_size
+
+    def get(self, key: str) -> Optional[bytes]:
+        key = key.encode("utf-8")
+        with self.locked():
+            offset, _ = self.find(key)
+            return self.value_at(offset) if offset is not None else None
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        """Store value, unless it doesn't fit in a slot."""
+        key = key.encode("utf-8")
+        if not self.fits(key, value):
+            return False
+        with self.locked():
+            offset, free = self.find(key)
+            self.write(offset if offset is not None else free, key, value, time.time() + ttl if ttl else math.inf)
+        return True
+
+    def incr(self, key: str, amount: float, ttl: Optional[float] = None) -> float:
+        """Add amount to the number at key and return the total. A new key gets the ttl."""
+        key = key.encode("utf-8")
+        with self.locked():
+            offset, free = self.find(key)
+            if offset is None:
+                total, expiry, offset = amount, time.time() + ttl if ttl else math.inf, free
+            else:
+                total = float(self.value_at(offset)) + amount
+                expiry = self.SLOT.unpack_from(self.map, offset)[1]
+            self.write(offset, key, repr(total).encode("ascii"), expiry)
+        return total
+
+    def delete(self, key: str):
+        key = key.encode("utf-8")
+        with self.locked():
+            offset, _ = self.find(key)
+            if offset is not None:
+                self.SLOT.pack_into(self.map, offset, 0, 0.0, 0, 0)
+
+    def keys(self, prefix: str) -> List[str]:
+        prefix = prefix.encode("utf-8")
+        now = time.time()
+        keys = []
+        with self.locked():
+            for index in range(self.slots):
+                offset = self.offset(index)
+                slot_hash, expiry, key_length, _ = self.SLOT.unpack_from(self.map, offset)
+                key = self.map[offset + self.SLOT.size:offset + self.SLOT.size + key_length]
+                if slot_hash and expiry > now and key.startswith(prefix):
+                    keys.append(key.decode("utf-8"))
+        return keys
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+class RedisSharedStore:
+    """Store on a Redis-compatible server, spoken to over RESP on a blocking socket.
+
+    Each call waits for a round trip, so the server should be on the same
+    host or network. Keys are namespaced with prefix. Failures are logged and
+    read as a missing value, so the proxy keeps serving without the server.
+    """
+
+    shared = True
+    blocking = True
+
+    def __init__(self, url: str, prefix: str = "", timeout: float = 2.0):
+        parsed = urllib.parse.urlparse(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.username = parsed.username
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+
+    @staticmethod
+    def encode(*args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the shared store")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            raise SharedStoreError(payload.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            return None if length < 0 else self.reader.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(payload)
+            return None if length < 0 else [self.read_reply() for _ in range(length)]
+        raise SharedStoreError(f"Unexpected reply from the shared store: {line!r}")
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self.sock.sendall(b"".join(self.encode(*command) for command in setup))
+            for _ in setup:
+                self.read_reply()
+
+    def execute(self, *commands) -> list:
+        """Send the commands in one pipeline and return their replies, reconnecting once if the connection broke."""
+        request = b"".join(self.encode(*command) for command in commands)
+        with self.lock:
+            for attempt in range(2):
+                reused = self.sock is not None
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall(request)
+                    return [self.read_reply() for _ in commands]
+                except (OSError, SharedStoreError):
+                    self.disconnect()
+                    if attempt or not reused:
+                        raise
+
+    def call(self, default, *commands):
+        """The last command's reply, or default if the store failed."""
+        try:
+            return self.execute(*commands)[-1]
+        except (OSError, SharedStoreError) as e:
+            logger.warning("Shared store %s:%s failed: %s", *self.address, e)
+            return default
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.call(None, ("GET", self.prefix + key))
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        command = ("SET", self.prefix + key, value) + (("PX", max(1, int(ttl * 1000))) if ttl else ())
+        return self.call(None, command) is not None
+
+    def incr(self, key: str, amount: float, ttl: Optional[float] = None) -> float:
+        """Add amount to the number at key and return the total. A new key gets the ttl."""
+        key = self.prefix + key
+        create = (("SET", key, 0, "PX", max(1, int(ttl * 1000)), "NX"),) if ttl else ()
+        return float(self.call(amount, *create, ("INCRBYFLOAT", key, repr(amount))))
+
+    def delete(self, key: str):
+        self.call(None, ("DEL", self.prefix + key))
+
+    def keys(self, prefix: str) -> List[str]:
+        pattern = re.sub(r"([*?\[\]\\])", r"\\\1", self.prefix + prefix) + "*"
+        keys, cursor = [], b"0"
+        while True:
+            reply = self.call(None, ("SCAN", cursor, "MATCH", pattern, "COUNT", 1000))
+            if reply is None:
+                return keys
+            cursor, batch = reply
+            keys.extend(key.decode("utf-8")[len(self.prefix):] for key in batch)
+            if cursor == b"0":
+                return keys
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = self.reader = None
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+def create_shared_store(backend: str):
+    """Build the store selected by SHARED_STORE."""
+    if backend == "shm":
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        path = SHARED_STORE_PATH or os.path.join(directory, "anthropic-proxy.store")
+        try:
+            return SharedMemoryStore(path, SHARED_STORE_SLOTS, SHARED_STORE_SLOT_KB * 1024)
+        except (ImportError, OSError) as e:
+            logger.warning("Could not open the shared store %s, state is per worker: %s", path, e)
+            return MemorySharedStore()
+    if backend == "redis":
+        return RedisSharedStore(SHARED_STORE_URL, SHARED_STORE_PREFIX)
+    if backend != "memory":
+        logger.warning("Unknown SHARED_STORE '%s', state is per worker", backend)
+    return MemorySharedStore()
+
+shared_store = create_shared_store(SHARED_STORE)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def litellm_request_hash(litellm_request: Dict[str, Any]) -> str:
+    """Hash what a LiteLLM request asks the model for, leaving out credentials, the client and the stream flag."""
+    return content_hash({k: v for k, v in litellm_request.items() if k not in ("api_key", "client", "stream", "openai_native")})
+
+class MemoryResponseStore:
+    """In-process response store with TTL, LRU eviction and a size cap."""
+
+    blocking = False
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expiry time, encoded record)
+        self.total_bytes = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.total_bytes += len(value)
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1])
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+class DiskResponseStore:
+    """Response store with one file per entry, so cached responses survive restarts.
+
+    Each file holds the expiry time on its first line followed by the encoded
+    record. File mtimes record the last use, which orders LRU eviction when
+    the directory is reopened. Methods block, so the cache runs them in a
+    worker thread.
+    """
+
+    blocking = True
+
+    def __init__(self, directory: str, ttl: float, max_entries: int, max_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> file size, least recently used first
+        self.total_bytes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            try:
+                with open(self.path(key), "rb") as f:
+                    expiry, _, value = f.read().partition(b"\n")
+                if float(expiry) <= time.time():
+                    self.remove(key)
+                    return None
+                os.utime(self.path(key))
+            except (OSError, ValueError):
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes):
+        data = f"{time.time() + self.ttl}\n".encode("utf-8") + value
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            self.remove(key)
+            temp_path = f"{self.path(key)}.{os.getpid()}.tmp"
+            try:
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, self.path(key))
+            except OSError as e:
+                logger.warning("Could not write response cache entry: %s", e)
+                return
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key: str):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.remove(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+class SharedResponseStore:
+    """Response store on the shared store, so every worker sees the responses the others cached.
+
+    The shared store handles expiry and eviction, so only the entry count is
+    known, by listing the keys. Listing scans the whole store, so the count
+    is refreshed at most every COUNT_SECONDS, and in a worker thread when
+    the store blocks, rather than on every scrape.
+    """
+
+    PREFIX = "response:"
+    COUNT_SECONDS = 30.0
+    total_bytes = None
+    evictions = None
+
+    def __init__(self, store, ttl: float, max_bytes: int):
+        self.store = store
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.blocking = store.blocking
+        self.entries = 0  # As of the last count
+        self.counted_at = -math.inf
+        self.counting = False
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.store.get(self.PREFIX + key)
+
+    def put(self, key: str, value: bytes):
+        if len(value) <= self.max_bytes:
+            self.store.set(self.PREFIX + key, value, self.ttl)
+
+    def clear(self):
+        for key in self.store.keys(self.PREFIX):
+            self.store.delete(key)
+
+    def count(self):
+        try:
+            self.entries = len(self.store.keys(self.PREFIX))
+            self.counted_at = time.monotonic()
+        finally:
+            self.counting = False
+
+    def __len__(self):
+        """The entry count, which lags one scrape behind while a blocking store is counted."""
+        if not self.counting and time.monotonic() - self.counted_at >= self.COUNT_SECONDS:
+            self.counting = True
+            if self.blocking:
+                threading.Thread(target=self.count, name="response-cache-count", daemon=True).start()
+            else:
+                self.count()
+        return self.entries
+
+class ResponseCache:
+    """Exact cache of upstream completions for deterministic requests.
+
+    Entries are keyed by a canonical hash of the translated LiteLLM request
+    (without credentials or the stream flag) and hold a provider-neutral
+    completion record. Non-streaming hits go through convert_litellm_to_anthropic
+    and streaming hits are replayed through handle_streaming, so a hit looks
+    exactly like a live response.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.store is not None
+
+    @staticmethod
+    def cacheable(request: MessagesRequest) -> bool:
+        # Only deterministic requests produce a reusable answer
+        return request.temperature == 0
+
+    @staticmethod
+    def key_for(litellm_request: Dict[str, Any]) -> str:
+        return litellm_request_hash(litellm_request)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.store.blocking:
+            encoded = await asyncio.to_thread(self.store.get, key)
+        else:
+            encoded = self.store.get(key)
+        if encoded is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fast_json_loads(encoded)
+
+    async def put(self, key: str, record: Dict[str, Any]):
+        encoded = fast_json_dumps(record)
+        if self.store.blocking:
+            await asyncio.to_thread(self.store.put, key, encoded)
+        else:
+            self.store.put(key, encoded)
+
+    def stats(self) -> Dict[str, Any]:
+        if self.store is None:
+            return {"enabled": False}
+        return {
+            "enabled": True, "backend": type(self.store).__name__, "entries": len(self.store),
+            "bytes": self.store.total_bytes, "hits": self.hits, "misses": self.misses,
+            "evictions": self.store.evictions,
+        }
+
+def create_response_store(backend: str):
+    """Build the response store selected by RESPONSE_CACHE, or None when it's off."""
+    max_bytes = int(RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+    if backend == "memory":
+        return MemoryResponseStore(RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_ENTRIES, max_bytes)
+    if backend == "disk":
+        return DiskResponseStore(RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_ENTRIES, max_bytes)
+    if backend == "shared":
+        return SharedResponseStore(shared_store, RESPONSE_CACHE_TTL_SECONDS, max_bytes)
+    if backend not in ("off", "", "none"):
+        logger.warning("Unknown RESPONSE_CACHE '%s', response caching is off", backend)
+    return None
+
+response_cache = ResponseCache(create_response_store(RESPONSE_CACHE))
+
+class StreamFanout:
+    """One upstream stream shared by every request that joins it.
+
+    A pump task opens the stream and buffers its chunks. Each subscriber
+    replays the buffer from the start and then follows new chunks, so a
+    request that joins mid-stream still gets the whole response. Chunks are
+    shared, so consumers must not modify them. The upstream stream is
+    cancelled once every subscriber has gone away.
+    """
+
+    def __init__(self, open_stream):
+        self.chunks = []
+        self.done = False
+        self.closed = False  # Abandoned by all subscribers - don't join it
+        self.error = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.opened = asyncio.get_running_loop().create_future()
+        # Nobody may await a failed open if every waiter has disconnected
+        self.opened.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.task = asyncio.create_task(self.pump(open_stream))
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def pump(self, open_stream):
+        response_generator = None
+        try:
+            response_generator = await open_stream()
+            self.opened.set_result(None)
+            async for chunk in response_generator:
+                self.chunks.append(chunk)
+                self.notify()
+        except asyncio.CancelledError:
+            self.opened.cancel()
+            raise
+        except Exception as e:
+            if not self.opened.done():
+                self.opened.set_exception(e)
+            self.error = e
+        finally:
+            self.done = True
+            self.notify()
+            await close_stream(response_generator)
+
+    def subscribe(self):
+        """Return a chunk generator for one more consumer of the stream."""
+        self.subscribers += 1
+        return self.follow()
+
+    async def follow(self):
+        index = 0
+        try:
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.closed = True
+                self.task.cancel()
+
+class SingleFlight:
+    """Joins concurrent identical calls onto one execution.
+
+    The first caller for a key starts the work and later callers with the
+    same key wait for its result until it finishes. Results are shared, not
+    copied. Callers that disconnect don't cancel the shared call.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Any, Any] = {}  # key -> task or StreamFanout
+        self.started = 0
+        self.joined = 0
+
+    def forget(self, key: Any, call: Any):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    async def do(self, key: Any, fn):
+        """Return the result of await fn(), shared with identical concurrent calls."""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            # Retrieve the exception even when every caller has gone away
+            task.add_done_callback(lambda t: (self.forget(key, t), t.cancelled() or t.exception()))
+            self.started += 1
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    async def stream(self, key: Any, open_stream):
+        """Return a chunk generator for await open_stream(), fanned out to identical concurrent streams."""
+        fanout = self.calls.get(key)
+        if fanout is None or fanout.closed:
+            fanout = StreamFanout(open_stream)
+            self.calls[key] = fanout
+            fanout.task.add_done_callback(lambda _: self.forget(key, fanout))
+            self.started += 1
+        else:
+            self.joined += 1
+        await asyncio.shield(fanout.opened)
+        return fanout.subscribe()
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self.calls), "started": self.started, "joined": self.joined}
+
+single_flight = SingleFlight()
+
+async def handle_streaming(response_generator, original_request: MessagesRequest):
+    """Handle streaming responses from LiteLLM and convert to Anthropic format."""
+    try:
+        # Send message_start event
+        message_id = f"msg_{uuid.uuid4().hex[:24]}"  # Format similar to Anthropic's IDs
+        
+        message_data = {
+            'type': 'message_start',
+            'message': {
+                'id': message_id,
                 'type': 'message',
                 'role': 'assistant',
                 'model': original_request.model,
@@ -835,13 +2614,13 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                 }
             }
         }
-        yield f"event: message_start\ndata: {json.dumps(message_data)}\n\n"
+        yield sse_event("message_start", message_data)
         
         # Content block index for the first text block
-        yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
+        yield SSE_TEXT_BLOCK_START
         
         # Send a ping to keep the connection alive (Anthropic does this)
-        yield f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n"
+        yield SSE_PING
         
         tool_index = None
         current_tool_call = None
@@ -896,7 +2675,7 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                         # Always emit text deltas if no tool calls started
                         if tool_index is None and not text_block_closed:
                             text_sent = True
-                            yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta_content}})}\n\n"
+                            yield sse_text_delta(0, delta_content)
                     
                     # Process tool calls
                     delta_tool_calls = None
@@ -914,20 +2693,20 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             # If we've been streaming text, close that text block
                             if text_sent and not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield sse_content_block_stop(0)
                             # If we've accumulated text but not sent it, we need to emit it now
                             # This handles the case where the first delta has both text and a tool call
                             elif accumulated_text and not text_sent and not text_block_closed:
                                 # Send the accumulated text
                                 text_sent = True
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield sse_text_delta(0, accumulated_text)
                                 # Close the text block
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield sse_content_block_stop(0)
                             # Close text block even if we haven't sent anything - models sometimes emit empty text blocks
                             elif not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield sse_content_block_stop(0)
                                 
                         # Convert to list if it's not already
                         if not isinstance(delta_tool_calls, list):
@@ -961,7 +2740,7 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                                     tool_id = getattr(tool_call, 'id', f"toolu_{uuid.uuid4().hex[:24]}")
                                 
                                 # Start a new tool_use block
-                                yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})}\n\n"
+                                yield sse_event("content_block_start", {'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})
                                 current_tool_call = tool_call
                                 tool_content = ""
                             
@@ -993,7 +2772,7 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                                 tool_content += args_json if isinstance(args_json, str) else ""
                                 
                                 # Send the update
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': anthropic_tool_index, 'delta': {'type': 'input_json_delta', 'partial_json': args_json}})}\n\n"
+                                yield sse_input_json_delta(anthropic_tool_index, args_json)
                     
                     # Process finish_reason - end the streaming response
                     if finish_reason and not has_sent_stop_reason:
@@ -1002,15 +2781,15 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                         # Close any open tool call blocks
                         if tool_index is not None:
                             for i in range(1, last_tool_index + 1):
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                                yield sse_content_block_stop(i)
                         
                         # If we accumulated text but never sent or closed text block, do it now
                         if not text_block_closed:
                             if accumulated_text and not text_sent:
                                 # Send the accumulated text
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield sse_text_delta(0, accumulated_text)
                             # Close the text block
-                            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                            yield sse_content_block_stop(0)
                         
                         # Map OpenAI finish_reason to Anthropic stop_reason
                         stop_reason = "end_turn"
@@ -1022,19 +2801,17 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             stop_reason = "end_turn"
                         
                         # Send message_delta with stop reason and usage
-                        usage = {"output_tokens": output_tokens}
-                        
-                        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})}\n\n"
+                        yield sse_message_delta(stop_reason, output_tokens)
                         
                         # Send message_stop event
-                        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+                        yield SSE_MESSAGE_STOP
                         
                         # Send final [DONE] marker to match Anthropic's behavior
-                        yield "data: [DONE]\n\n"
+                        yield SSE_DONE
                         return
             except Exception as e:
                 # Log error but continue processing other chunks
-                logger.error(f"Error processing chunk: {str(e)}")
+                logger.error("Error processing chunk: %s", e)
                 continue
         
         # If we didn't get a finish reason, close any open blocks
@@ -1042,218 +2819,2117 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
             # Close any open tool call blocks
             if tool_index is not None:
                 for i in range(1, last_tool_index + 1):
-                    yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                    yield sse_content_block_stop(i)
             
             # Close the text content block
-            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+            yield sse_content_block_stop(0)
             
             # Send final message_delta with usage
-            usage = {"output_tokens": output_tokens}
-            
-            yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': usage})}\n\n"
+            yield sse_message_delta("end_turn", output_tokens)
             
             # Send message_stop event
-            yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+            yield SSE_MESSAGE_STOP
             
             # Send final [DONE] marker to match Anthropic's behavior
-            yield "data: [DONE]\n\n"
+            yield SSE_DONE
     
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        error_message = f"Error in streaming: {str(e)}\n\nFull traceback:\n{error_traceback}"
-        logger.error(error_message)
+        logger.error("Error in streaming: %s", e, exc_info=True)
         
         # Send error message_delta
-        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'error', 'stop_sequence': None}, 'usage': {'output_tokens': 0}})}\n\n"
+        yield sse_message_delta("error", 0)
         
         # Send message_stop event
-        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+        yield SSE_MESSAGE_STOP
         
         # Send final [DONE] marker
-        yield "data: [DONE]\n\n"
+        yield SSE_DONE
+    finally:
+        await close_stream(response_generator)
 
-@app.post("/v1/messages")
-async def create_message(
-    request: MessagesRequest,
-    raw_request: Request
-):
+class UpstreamClients:
+    """Long-lived pooled HTTP clients, one per upstream provider.
+
+    Each provider gets its own httpx.AsyncClient, so connections and TLS
+    sessions are reused across requests instead of being set up on the
+    request path. The clients are handed to LiteLLM in the shape each of its
+    providers accepts: an AsyncOpenAI client for OpenAI, and an
+    AsyncHTTPHandler for Gemini and Anthropic.
+    """
+
+    PROVIDERS = ("openai", "gemini", "anthropic")
+
+    def __init__(self, enabled=True, max_connections=100, max_keepalive=20, keepalive_expiry=60.0,
+                 http2=False, timeout=600.0):
+        self.enabled = enabled
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 10.0))
+        self.http_clients: Dict[str, httpx.AsyncClient] = {}
+        self.litellm_clients: Dict[str, Any] = {}
+
+    def create_http_client(self) -> httpx.AsyncClient:
+        if not self.http2:
+            # LiteLLM's aiohttp-backed transport is faster than httpx's own for
+            # HTTP/1.1, but has no HTTP/2 support
+            try:
+                import aiohttp
+                from litellm.llms.custom_httpx.aiohttp_transport import LiteLLMAiohttpTransport
+            except ImportError:
+                pass
+            else:
+                def session_factory():
+                    connector = aiohttp.TCPConnector(
+                        limit=self.limits.max_connections or 0,
+                        keepalive_timeout=self.limits.keepalive_expiry,
+                    )
+                    return aiohttp.ClientSession(connector=connector)
+                return httpx.AsyncClient(transport=LiteLLMAiohttpTransport(client=session_factory), timeout=self.timeout)
+        return httpx.AsyncClient(limits=self.limits, http2=self.http2, timeout=self.timeout)
+
+    async def start(self):
+        """Create the clients. Called at app startup."""
+        if not self.enabled or self.http_clients:
+            return
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("UPSTREAM_HTTP2 needs the h2 package (pip install 'httpx[http2]') - using HTTP/1.1")
+                self.http2 = False
+
+        from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler
+
+        for provider in self.PROVIDERS:
+            http_client = self.create_http_client()
+            if provider == "openai":
+                if not OPENAI_API_KEY:
+                    # AsyncOpenAI can't be created without a key; LiteLLM's own client is used instead
+                    await http_client.aclose()
+                    continue
+                from openai import AsyncOpenAI
+                litellm_client = AsyncOpenAI(
+                    api_key=OPENAI_API_KEY,
+                    base_url=os.environ.get("OPENAI_API_BASE"),  # None falls back to OPENAI_BASE_URL
+                    http_client=http_client,
+                    max_retries=0,  # LiteLLM handles retries
+                )
+            else:
+                litellm_client = AsyncHTTPHandler(timeout=self.timeout)
+                await litellm_client.close()  # Drop the client it creates for itself
+                litellm_client.client = http_client
+            self.http_clients[provider] = http_client
+            self.litellm_clients[provider] = litellm_client
+        logger.debug("Created pooled upstream clients for: %s", ', '.join(self.http_clients))
+
+    async def aclose(self):
+        """Close the clients. Called at app shutdown."""
+        http_clients = list(self.http_clients.values())
+        self.http_clients.clear()
+        self.litellm_clients.clear()
+        for http_client in http_clients:
+            await http_client.aclose()
+
+    def get(self, model: str) -> Optional[Any]:
+        """Return the LiteLLM client for a provider/model name, if there is one."""
+        return self.litellm_clients.get(model.split("/", 1)[0])
+
+    def http_client(self, provider: str) -> httpx.AsyncClient:
+        """Return a provider's pooled HTTP client, for requests the proxy sends itself.
+
+        Without the pool, the client is created on first use and still closed at shutdown.
+        """
+        http_client = self.http_clients.get(provider)
+        if http_client is None:
+            http_client = self.http_clients[provider] = self.create_http_client()
+        return http_client
+
+upstream_clients = UpstreamClients(
+    enabled=UPSTREAM_CONNECTION_POOL,
+    max_connections=UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+    keepalive_expiry=UPSTREAM_KEEPALIVE_SECONDS,
+    http2=UPSTREAM_HTTP2,
+    timeout=UPSTREAM_TIMEOUT_SECONDS,
+)
+
+class UpstreamHTTPError(Exception):
+    """An error status from a provider's API, on a request the proxy sent itself rather than through LiteLLM."""
+
+    def __init__(self, api: str, response: httpx.Response):
+        super().__init__(f"{api} API returned HTTP {response.status_code}")
+        self.status_code = response.status_code
+        self.response = response  # Its Retry-After is honored like LiteLLM errors'
+        self.message = response.text
+
+class SSEUsage:
+    """The usage of an Anthropic SSE byte stream, read without parsing its other events.
+
+    Only complete frames that contain "usage" (message_start and
+    message_delta) are decoded, so any other chunk costs a substring search.
+    The counts are cumulative, so later frames replace earlier ones.
+    """
+
+    __slots__ = ("partial", "tokens")
+
+    def __init__(self):
+        self.partial = b""  # A frame split across chunks
+        self.tokens: Dict[str, int] = {}
+
+    def feed(self, chunk: bytes) -> bool:
+        """Scan the next chunk of the stream, returning True if it updated the usage."""
+        data = self.partial + chunk if self.partial else chunk
+        end = data.rfind(b"\n\n")
+        if end < 0:
+            self.partial = data
+            return False
+        self.partial = data[end + 2:]
+        if data.find(b'"usage"', 0, end) < 0:
+            return False
+        updated = False
+        for frame in data[:end].split(b"\n\n"):
+            if b'"usage"' in frame:
+                updated = self.read(frame) or updated
+        return updated
+
+    def read(self, frame: bytes) -> bool:
+        for line in frame.split(b"\n"):
+            if not line.startswith(b"data:"):
+                continue
+            try:
+                event = fast_json_loads(line[5:])
+            except ValueError:
+                return False
+            if not isinstance(event, dict):
+                return False
+            # message_delta carries its usage at the top, message_start in its message
+            return self.update(event.get("usage") or (event.get("message") or {}).get("usage"))
+        return False
+
+    def update(self, usage: Any) -> bool:
+        if not isinstance(usage, dict):
+            return False
+        self.tokens.update((name, count) for name, count in usage.items() if isinstance(count, int))
+        return True
+
+    @property
+    def input_tokens(self) -> int:
+        return self.tokens.get("input_tokens", 0)
+
+    @property
+    def output_tokens(self) -> int:
+        return self.tokens.get("output_tokens", 0)
+
+class AnthropicPassthrough:
+    """Sends anthropic/ models' requests to the Anthropic API as they are, and relays its responses unchanged.
+
+    Through LiteLLM, Anthropic's SSE is parsed into OpenAI-style chunks that
+    handle_streaming turns back into Anthropic SSE, dropping what the OpenAI
+    format has no place for, such as thinking blocks and cache token counts.
+    The passthrough forwards the client's body with only the model name
+    replaced, over the pooled Anthropic client, and reads nothing from the
+    response but its usage. Its requests still go through the admission
+    limits, retries, failover and circuit breakers: build_request marks the
+    request so that upstream_attempt calls send instead of LiteLLM.
+    """
+
+    FORWARDED_HEADERS = ("anthropic-version", "anthropic-beta")
+    DEFAULT_VERSION = "2023-06-01"
+
+    def __init__(self, enabled: bool = False, api_base: str = "https://api.anthropic.com", api_key: Optional[str] = None):
+        self.enabled = enabled
+        api_base = api_base.rstrip("/")
+        self.url = api_base if api_base.endswith("/v1/messages") else api_base + "/v1/messages"
+        self.api_key = api_key
+        self.requests = 0
+
+    def handles(self, model: str) -> bool:
+        return self.enabled and model.startswith("anthropic/")
+
+    @classmethod
+    def client_headers(cls, headers) -> Dict[str, str]:
+        """The client's Anthropic API headers, such as the betas it asked for, to send along."""
+        return {name: headers[name] for name in cls.FORWARDED_HEADERS if name in headers}
+
+    def build_request(self, request: MessagesRequest) -> Dict[str, Any]:
+        """The request body as the client sent it, with the mapped model, marked for send."""
+        body = request._raw_body
+        if body is None:
+            body = request.model_dump(exclude_none=True)
+        passthrough_request = {key: value for key, value in body.items() if key != "original_model"}
+        passthrough_request["model"] = request.model
+        passthrough_request["passthrough"] = True
+        if request._anthropic_headers:
+            passthrough_request["extra_headers"] = dict(request._anthropic_headers)
+        return passthrough_request
+
+    async def send(self, passthrough_request: Dict[str, Any]):
+        """POST a request from build_request, returning the JSON response's bytes, or a generator of a stream's SSE bytes."""
+        body = {key: value for key, value in passthrough_request.items() if key not in ("passthrough", "extra_headers")}
+        body["model"] = body["model"].split("/", 1)[1]
+        headers = {
+            "x-api-key": self.api_key or "",
+            "anthropic-version": self.DEFAULT_VERSION,
+            "content-type": "application/json",
+            "accept-encoding": "identity",  # Relayed as is, so don't have it compressed
+            **(passthrough_request.get("extra_headers") or {}),
+        }
+        http_client = upstream_clients.http_client("anthropic")
+        response = await http_client.send(
+            http_client.build_request("POST", self.url, content=fast_json_dumps(body), headers=headers), stream=True
+        )
+        self.requests += 1
+        if response.status_code >= 400 or not body.get("stream"):
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            if response.status_code >= 400:
+                raise UpstreamHTTPError("Anthropic", response)
+            return response.content
+        return self.stream_bytes(response)
+
+    @staticmethod
+    async def stream_bytes(response: httpx.Response):
+        try:
+            async for chunk in response.aiter_bytes():
+                yield chunk
+        finally:
+            await response.aclose()
+
+    @staticmethod
+    def response_usage(content: bytes) -> Dict[str, int]:
+        """The usage of a non-streaming response's JSON."""
+        usage = SSEUsage()
+        try:
+            message = fast_json_loads(content)
+        except ValueError:
+            return usage.tokens
+        if isinstance(message, dict):
+            usage.update(message.get("usage"))
+        return usage.tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "requests": self.requests}
+
+anthropic_passthrough = AnthropicPassthrough(ANTHROPIC_PASSTHROUGH, ANTHROPIC_API_BASE, ANTHROPIC_API_KEY)
+
+class OpenAIStreamAdapter:
+    """Streams openai/ models' responses from the OpenAI SSE bytes, without LiteLLM's chunk objects.
+
+    LiteLLM builds pydantic objects for every streamed delta, and
+    handle_streaming then probes each one with hasattr and isinstance for
+    both object and dict shapes. The adapter sends the translated request
+    over the pooled OpenAI client itself, decodes each data: line into a
+    plain dict with the fast JSON decoder, and openai_events_to_sse turns
+    the dicts into Anthropic events with a small state machine. Like the
+    Anthropic passthrough, its requests are marked by build_litellm_request
+    and sent by upstream_attempt. Non-streaming requests still use LiteLLM,
+    and so do the o-series reasoning models, whose parameters LiteLLM
+    rewrites (max_completion_tokens, no temperature).
+    """
+
+    # Keys of the LiteLLM request that aren't part of the OpenAI body
+    LITELLM_KEYS = ("model", "api_key", "client", "extra_headers", "openai_native")
+    UNSUPPORTED = ("top_k",)  # LiteLLM drops these for OpenAI
+    REASONING_MODELS = ("o1", "o3", "o4")
+    # Anthropic's "any" tool_choice, as convert_tool_choice_to_openai leaves it for LiteLLM
+    TOOL_CHOICES = {"any": "required"}
+
+    def __init__(self, enabled: bool = False, api_base: str = "https://api.openai.com/v1"):
+        self.enabled = enabled
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.requests = 0
+
+    def handles(self, request: MessagesRequest) -> bool:
+        if not (self.enabled and request.stream and request.model.startswith("openai/")):
+            return False
+        return not request.model[len("openai/"):].startswith(self.REASONING_MODELS)
+
+    def body(self, litellm_request: Dict[str, Any]) -> Dict[str, Any]:
+        """The Chat Completions body for a LiteLLM request, with the parameter fixes LiteLLM would make."""
+        skipped = self.LITELLM_KEYS + self.UNSUPPORTED
+        body = {key: value for key, value in litellm_request.items() if key not in skipped}
+        body["model"] = litellm_request["model"].split("/", 1)[1]
+        tool_choice = body.get("tool_choice")
+        if isinstance(tool_choice, str):
+            body["tool_choice"] = self.TOOL_CHOICES.get(tool_choice, tool_choice)
+        # Usage comes in a last chunk of its own
+        body["stream_options"] = {"include_usage": True}
+        return body
+
+    async def send(self, litellm_request: Dict[str, Any]):
+        """POST a streaming LiteLLM request, returning a generator of its decoded events."""
+        body = self.body(litellm_request)
+        headers = {
+            "authorization": f"Bearer {litellm_request.get('api_key') or ''}",
+            "content-type": "application/json",
+            **(litellm_request.get("extra_headers") or {}),
+        }
+        http_client = upstream_clients.http_client("openai")
+        response = await http_client.send(
+            http_client.build_request("POST", self.url, content=fast_json_dumps(body), headers=headers), stream=True
+        )
+        self.requests += 1
+        if response.status_code >= 400:
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            raise UpstreamHTTPError("OpenAI", response)
+        return self.events(response)
+
+    @staticmethod
+    async def events(response: httpx.Response):
+        """Decode the data: lines of an SSE response, up to [DONE]."""
+        partial = b""  # A line split across chunks
+        try:
+            async for chunk in response.aiter_bytes():
+                lines = (partial + chunk if partial else chunk).split(b"\n")
+                partial = lines.pop()
+                for line in lines:
+                    if line[:5] != b"data:":
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        return
+                    yield fast_json_loads(data)
+        finally:
+            await response.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "requests": self.requests}
+
+openai_stream_adapter = OpenAIStreamAdapter(OPENAI_NATIVE_STREAMING, OPENAI_API_BASE)
+
+def send_upstream(litellm_request: Dict[str, Any]):
+    """Start an upstream call: through the Anthropic passthrough or the OpenAI adapter for requests they built, otherwise through LiteLLM."""
+    if litellm_request.get("passthrough"):
+        return anthropic_passthrough.send(litellm_request)
+    if litellm_request.get("openai_native"):
+        return openai_stream_adapter.send(litellm_request)
+    return litellm.acompletion(**litellm_request)
+
+FINISH_REASON_TO_STOP_REASON = {"stop": "end_turn", "length": "max_tokens", "tool_calls": "tool_use"}
+
+async def openai_events_to_sse(events, original_request: MessagesRequest, timer, stream_span=None):
+    """Convert decoded OpenAI stream events to Anthropic SSE frames.
+
+    Emits the same events as handle_streaming: text goes to block 0 until
+    the first tool call closes it, text after that is dropped, and each new
+    upstream tool call index opens the next tool_use block. The tool blocks
+    are closed at the finish reason, and message_delta waits for the usage
+    chunk that follows it.
+    """
+    message_data = {
+        'type': 'message_start',
+        'message': {
+            'id': f"msg_{uuid.uuid4().hex[:24]}", 'type': 'message', 'role': 'assistant', 'model': original_request.model,
+            'content': [], 'stop_reason': None, 'stop_sequence': None,
+            'usage': {'input_tokens': 0, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0, 'output_tokens': 0},
+        },
+    }
+    yield sse_event("message_start", message_data)
+    yield SSE_TEXT_BLOCK_START
+    yield SSE_PING
+
+    text_open = True  # Block 0 takes text until the first tool call
+    tool_index = None  # Upstream index of the current tool call
+    block = 0  # Anthropic index of the last tool_use block
+    stop_reason = None
+    output_tokens = 0
     try:
-        # print the body here
-        body = await raw_request.body()
-    
-        # Parse the raw body as JSON since it's bytes
-        body_json = json.loads(body.decode('utf-8'))
-        original_model = body_json.get("model", "unknown")
-        
-        # Get the display name for logging, just the model name without provider prefix
-        display_model = original_model
-        if "/" in display_model:
-            display_model = display_model.split("/")[-1]
-        
-        # Clean model name for capability check
-        clean_model = request.model
-        if clean_model.startswith("anthropic/"):
-            clean_model = clean_model[len("anthropic/"):]
-        elif clean_model.startswith("openai/"):
-            clean_model = clean_model[len("openai/"):]
-        
-        logger.debug(f"📊 PROCESSING REQUEST: Model={request.model}, Stream={request.stream}")
-        
-        # Convert Anthropic request to LiteLLM format
-        litellm_request = convert_anthropic_to_litellm(request)
-        
-        # Determine which API key to use based on the model
-        if request.model.startswith("openai/"):
-            litellm_request["api_key"] = OPENAI_API_KEY
-            logger.debug(f"Using OpenAI API key for model: {request.model}")
-        elif request.model.startswith("gemini/"):
-            litellm_request["api_key"] = GEMINI_API_KEY
-            logger.debug(f"Using Gemini API key for model: {request.model}")
-        else:
-            litellm_request["api_key"] = ANTHROPIC_API_KEY
-            logger.debug(f"Using Anthropic API key for model: {request.model}")
-        
-        # For OpenAI models - modify request format to work with limitations
-        if "openai" in litellm_request["model"] and "messages" in litellm_request:
-            logger.debug(f"Processing OpenAI model request: {litellm_request['model']}")
-            
-            # For OpenAI models, we need to convert content blocks to simple strings
-            # and handle other requirements
-            for i, msg in enumerate(litellm_request["messages"]):
-                # Special case - handle message content directly when it's a list of tool_result
-                # This is a specific case we're seeing in the error
-                if "content" in msg and isinstance(msg["content"], list):
-                    is_only_tool_result = True
-                    for block in msg["content"]:
-                        if not isinstance(block, dict) or block.get("type") != "tool_result":
-                            is_only_tool_result = False
-                            break
-                    
-                    if is_only_tool_result and len(msg["content"]) > 0:
-                        logger.warning(f"Found message with only tool_result content - special handling required")
-                        # Extract the content from all tool_result blocks
-                        all_text = ""
-                        for block in msg["content"]:
-                            all_text += "Tool Result:\n"
-                            result_content = block.get("content", [])
-                            
-                            # Handle different formats of content
-                            if isinstance(result_content, list):
-                                for item in result_content:
-                                    if isinstance(item, dict) and item.get("type") == "text":
-                                        all_text += item.get("text", "") + "\n"
-                                    elif isinstance(item, dict):
-                                        # Fall back to string representation of any dict
-                                        try:
-                                            item_text = item.get("text", json.dumps(item))
-                                            all_text += item_text + "\n"
-                                        except:
-                                            all_text += str(item) + "\n"
-                            elif isinstance(result_content, str):
-                                all_text += result_content + "\n"
-                            else:
-                                try:
-                                    all_text += json.dumps(result_content) + "\n"
-                                except:
-                                    all_text += str(result_content) + "\n"
-                        
-                        # Replace the list with extracted text
-                        litellm_request["messages"][i]["content"] = all_text.strip() or "..."
-                        logger.warning(f"Converted tool_result to plain text: {all_text.strip()[:200]}...")
-                        continue  # Skip normal processing for this message
-                
-                # 1. Handle content field - normal case
-                if "content" in msg:
-                    # Check if content is a list (content blocks)
-                    if isinstance(msg["content"], list):
-                        # Convert complex content blocks to simple string
-                        text_content = ""
-                        for block in msg["content"]:
-                            if isinstance(block, dict):
-                                # Handle different content block types
-                                if block.get("type") == "text":
-                                    text_content += block.get("text", "") + "\n"
-                                
-                                # Handle tool_result content blocks - extract nested text
-                                elif block.get("type") == "tool_result":
-                                    tool_id = block.get("tool_use_id", "unknown")
-                                    text_content += f"[Tool Result ID: {tool_id}]\n"
-                                    
-                                    # Extract text from the tool_result content
-                                    result_content = block.get("content", [])
-                                    if isinstance(result_content, list):
-                                        for item in result_content:
-                                            if isinstance(item, dict) and item.get("type") == "text":
-                                                text_content += item.get("text", "") + "\n"
-                                            elif isinstance(item, dict):
-                                                # Handle any dict by trying to extract text or convert to JSON
-                                                if "text" in item:
-                                                    text_content += item.get("text", "") + "\n"
-                                                else:
-                                                    try:
-                                                        text_content += json.dumps(item) + "\n"
-                                                    except:
-                                                        text_content += str(item) + "\n"
-                                    elif isinstance(result_content, dict):
-                                        # Handle dictionary content
-                                        if result_content.get("type") == "text":
-                                            text_content += result_content.get("text", "") + "\n"
-                                        else:
-                                            try:
-                                                text_content += json.dumps(result_content) + "\n"
-                                            except:
-                                                text_content += str(result_content) + "\n"
-                                    elif isinstance(result_content, str):
-                                        text_content += result_content + "\n"
-                                    else:
-                                        try:
-                                            text_content += json.dumps(result_content) + "\n"
-                                        except:
-                                            text_content += str(result_content) + "\n"
-                                
-                                # Handle tool_use content blocks
-                                elif block.get("type") == "tool_use":
-                                    tool_name = block.get("name", "unknown")
-                                    tool_id = block.get("id", "unknown")
-                                    tool_input = json.dumps(block.get("input", {}))
-                                    text_content += f"[Tool: {tool_name} (ID: {tool_id})]\nInput: {tool_input}\n\n"
-                                
-                                # Handle image content blocks
-                                elif block.get("type") == "image":
-                                    text_content += "[Image content - not displayed in text format]\n"
-                        
-                        # Make sure content is never empty for OpenAI models
-                        if not text_content.strip():
-                            text_content = "..."
-                        
-                        litellm_request["messages"][i]["content"] = text_content.strip()
-                    # Also check for None or empty string content
-                    elif msg["content"] is None:
-                        litellm_request["messages"][i]["content"] = "..." # Empty content not allowed
-                
-                # 2. Remove any fields OpenAI doesn't support in messages
-                for key in list(msg.keys()):
-                    if key not in ["role", "content", "name", "tool_call_id", "tool_calls"]:
-                        logger.warning(f"Removing unsupported field from message: {key}")
-                        del msg[key]
-            
-            # 3. Final validation - check for any remaining invalid values and dump full message details
-            for i, msg in enumerate(litellm_request["messages"]):
-                # Log the message format for debugging
-                logger.debug(f"Message {i} format check - role: {msg.get('role')}, content type: {type(msg.get('content'))}")
-                
-                # If content is still a list or None, replace with placeholder
-                if isinstance(msg.get("content"), list):
-                    logger.warning(f"CRITICAL: Message {i} still has list content after processing: {json.dumps(msg.get('content'))}")
-                    # Last resort - stringify the entire content as JSON
-                    litellm_request["messages"][i]["content"] = f"Content as JSON: {json.dumps(msg.get('content'))}"
-                elif msg.get("content") is None:
-                    logger.warning(f"Message {i} has None content - replacing with placeholder")
-                    litellm_request["messages"][i]["content"] = "..." # Fallback placeholder
+        async for event in events:
+            usage = event.get("usage")
+            if usage:
+                output_tokens = usage.get("completion_tokens") or output_tokens
+                timer.completion_tokens = output_tokens
+                if stream_span is not None:
+                    stream_span.prompt_tokens, stream_span.completion_tokens = usage.get("prompt_tokens"), output_tokens
+            choices = event.get("choices")
+            if not choices:
+                if "error" in event:
+                    raise ValueError(f"Upstream stream error: {event['error']}")
+                continue
+            choice = choices[0]
+            delta = choice.get("delta")
+            if delta:
+                content = delta.get("content")
+                if content and tool_index is None:
+                    yield sse_text_delta(0, content)
+                tool_calls = delta.get("tool_calls")
+                if tool_calls:
+                    if text_open:
+                        text_open = False
+                        yield sse_content_block_stop(0)
+                    for tool_call in tool_calls:
+                        function = tool_call.get("function") or {}
+                        index = tool_call.get("index", 0)
+                        if index != tool_index:
+                            tool_index = index
+                            block += 1
+                            tool_id = tool_call.get("id") or f"toolu_{uuid.uuid4().hex[:24]}"
+                            content_block = {'type': 'tool_use', 'id': tool_id, 'name': function.get("name") or "", 'input': {}}
+                            yield sse_event("content_block_start", {'type': 'content_block_start', 'index': block, 'content_block': content_block})
+                        arguments = function.get("arguments")
+                        if arguments:
+                            yield sse_input_json_delta(block, arguments)
+            finish_reason = choice.get("finish_reason")
+            if finish_reason and stop_reason is None:
+                stop_reason = FINISH_REASON_TO_STOP_REASON.get(finish_reason, "end_turn")
+                for index in range(1, block + 1):
+                    yield sse_content_block_stop(index)
+                block = 0
+                if text_open:
+                    text_open = False
+                    yield sse_content_block_stop(0)
+    except Exception as e:
+        logger.error("Error in streaming: %s", e, exc_info=True)
+        yield sse_message_delta("error", 0)
+        yield SSE_MESSAGE_STOP
+        yield SSE_DONE
+        return
+    finally:
+        await close_stream(events)
+
+    # A stream that ended without a finish reason still closes its blocks
+    for index in range(1, block + 1):
+        yield sse_content_block_stop(index)
+    if text_open:
+        yield sse_content_block_stop(0)
+    yield sse_message_delta(stop_reason or "end_turn", output_tokens)
+    yield SSE_MESSAGE_STOP
+    yield SSE_DONE
+
+async def relay_passthrough(chunks, timer, stream_span=None):
+    """Relay a passthrough stream's SSE bytes unchanged, reading only their usage.
+
+    The usage goes to the stream's timer and span as it arrives, and to the
+    passthrough token counters at the end.
+    """
+    usage = SSEUsage()
+    try:
+        async for chunk in chunks:
+            if usage.feed(chunk):
+                timer.completion_tokens = usage.output_tokens
+                if stream_span is not None:
+                    stream_span.prompt_tokens, stream_span.completion_tokens = usage.input_tokens, usage.output_tokens
+            yield chunk
+    finally:
+        observe_passthrough_usage(timer.labels, usage.tokens)
+        await close_stream(chunks)
+
+async def stream_to_sse(response_generator, request: MessagesRequest, timer, stream_span=None):
+    """Anthropic SSE frames for an upstream stream, converted according to what it yields.
+
+    Failover can move a request to another provider's model, so the first
+    chunk decides: bytes from the Anthropic passthrough are relayed as they
+    are, dicts from the OpenAI adapter go through openai_events_to_sse, and
+    LiteLLM chunks through handle_streaming.
+    """
+    chunks = response_generator
+    try:
+        try:
+            first_chunk = await response_generator.__anext__()
+        except StopAsyncIteration:
+            first_chunk = None
+        else:
+            chunks = prepend_chunk(first_chunk, response_generator)
+        if isinstance(first_chunk, bytes):
+            frames = relay_passthrough(chunks, timer, stream_span)
+        elif isinstance(first_chunk, dict):
+            frames = openai_events_to_sse(chunks, request, timer, stream_span)
+        else:
+            frames = handle_streaming(chunks, request)
+        async for frame in frames:
+            yield frame
+    finally:
+        await close_stream(chunks)
+        await close_stream(response_generator)  # In case chunks never started
+
+class AdmissionRejected(Exception):
+    """Raised when a request can't be admitted upstream: the queue is full or the wait timed out."""
+
+    http_status = 429
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream model whose circuit breaker is open."""
+
+    http_status = 503
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Rate limit of rate_per_minute units, refilled continuously and holding at most a minute's worth."""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.refill_per_second = rate_per_minute / 60
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount units are available. Amounts over the capacity wait for a full bucket."""
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.refill_per_second if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        # May go negative for amounts over the capacity, which delays later requests
+        self.refill()
+        self.level -= amount
+
+    def try_take(self, amount: float) -> float:
+        """Take amount units if they are available and return 0, or else the seconds until they are."""
+        delay = self.delay(amount)
+        if delay == 0:
+            self.take(amount)
+        return delay
+
+    def refund(self, amount: float):
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+class SharedTokenBucket:
+    """Rate limit of rate_per_minute units that every worker draws on, kept in the shared store.
+
+    Units are counted per one-minute window. The limit applies to a sliding
+    minute, estimated from the current window and the part of the previous
+    one that it still overlaps. Amounts over the capacity wait for an empty
+    window, like TokenBucket's wait for a full bucket. try_take adds the
+    units before checking the limit and gives them back if it's exceeded,
+    so workers admitting at the same moment can't all pass the same check.
+    """
+
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self, store, key: str, rate_per_minute: float):
+        self.store = store
+        self.key = key
+        self.capacity = rate_per_minute
+
+    def window(self):
+        """The current window's number, and how far through it we are (0 to 1)."""
+        position = time.time() / self.WINDOW_SECONDS
+        return int(position), position - int(position)
+
+    def wait(self, current: float, previous: float, elapsed: float, amount: float) -> float:
+        """Seconds until amount more units fit, with current and previous taken in this window and the last."""
+        amount = min(amount, self.capacity)
+        if current + previous * (1 - elapsed) + amount <= self.capacity:
+            return 0.0
+        if current + amount > self.capacity or previous <= 0:
+            return (1 - elapsed) * self.WINDOW_SECONDS + 0.001  # Check again in the next window
+        # The previous window's share shrinks as the sliding minute moves past it
+        needed = 1 - (self.capacity - current - amount) / previous
+        return max(needed - elapsed, 0) * self.WINDOW_SECONDS + 0.001
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount units are available, given what the workers have taken."""
+        number, elapsed = self.window()
+        current = float(self.store.get(f"{self.key}:{number}") or 0)
+        previous = float(self.store.get(f"{self.key}:{number - 1}") or 0)
+        return self.wait(current, previous, elapsed, amount)
+
+    def try_take(self, amount: float) -> float:
+        """Take amount units if the limit allows and return 0, or else the seconds until it does."""
+        number, elapsed = self.window()
+        # Kept for two windows, since the next window reads it as the previous one
+        total = self.store.incr(f"{self.key}:{number}", amount, ttl=2 * self.WINDOW_SECONDS + 1)
+        previous = float(self.store.get(f"{self.key}:{number - 1}") or 0)
+        delay = self.wait(total - amount, previous, elapsed, amount)
+        if delay > 0:
+            self.store.incr(f"{self.key}:{number}", -amount)
+        return delay
+
+    def refund(self, amount: float):
+        number, _ = self.window()
+        self.store.incr(f"{self.key}:{number}", -amount)
+
+class ProviderLimiter:
+    """Admission control for one upstream provider.
+
+    Requests hold a slot while they are upstream - until the response
+    arrives, or the stream ends. Requests that would exceed the concurrency
+    cap or the request/token rate limits wait in a bounded queue, ordered
+    by priority (lower first) and then by arrival. Only the head of the
+    queue is admitted, so a large request can't be starved by small ones.
+    With a shared store the rate limits cover every worker, while the
+    concurrency cap and the queue are per worker. A blocking store is
+    only called from worker threads, and the queue is admitted from a
+    task, so the event loop never waits on the store.
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 0, rpm: float = 0, tpm: float = 0,
+                 max_queue: int = 100, queue_timeout: float = 30.0, store=None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.store = store
+        self.requests = self.bucket("requests", rpm) if rpm > 0 else None
+        self.tokens = self.bucket("tokens", tpm) if tpm > 0 else None
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.queue = []  # Heap of (priority, sequence, future, tokens)
+        self.sequence = itertools.count()
+        self.timer = None  # Wakes the queue when the rate limits allow the head
+        self.blocking = store is not None and store.blocking
+        self.dispatcher = None  # The task admitting queued requests
+        self.dispatch_again = False
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_queue_depth = 0
+        self.wait_seconds = 0.0
+
+    def bucket(self, kind: str, rate_per_minute: float):
+        """A rate limit shared with the other workers when the store is, or else this process's own."""
+        if self.store is not None and self.store.shared:
+            return SharedTokenBucket(self.store, f"limit:{self.name}:{kind}", rate_per_minute)
+        return TokenBucket(rate_per_minute)
+
+    @property
+    def limited(self) -> bool:
+        return bool(self.max_concurrency or self.requests or self.tokens)
+
+    async def call_bucket(self, method, amount: float) -> float:
+        """Call a bucket method, in a worker thread if the store blocks."""
+        if self.blocking:
+            return await asyncio.to_thread(method, amount)
+        return method(amount)
+
+    async def try_admit(self, tokens: int) -> Optional[float]:
+        """Admit a request for tokens and return 0, or else the seconds until the rate limits allow it, or None while all slots are taken."""
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return None
+        self.active += 1  # Held while the buckets are consulted
+        delay = 0.0
+        if self.requests is not None:
+            delay = await self.call_bucket(self.requests.try_take, 1)
+        if not delay and self.tokens is not None and tokens:
+            delay = await self.call_bucket(self.tokens.try_take, tokens)
+            if delay and self.requests is not None:
+                await self.call_bucket(self.requests.refund, 1)
+        if delay:
+            self.active -= 1
+            return delay
+        self.admitted += 1
+        return 0.0
+
+    async def retry_after(self) -> float:
+        """A hint for clients on when to try again, in seconds."""
+        delay = await self.call_bucket(self.requests.delay, 1) if self.requests is not None else 0.0
+        return max(1.0, delay)
+
+    async def acquire(self, priority: int = 1, tokens: int = 0):
+        """Wait for a slot. Raises AdmissionRejected if the queue is full or the wait times out."""
+        if not self.queue and await self.try_admit(tokens) == 0:
+            return
+        if len(self.queue) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"Too many requests queued for {self.name}", await self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.sequence), future, tokens)
+        heapq.heappush(self.queue, entry)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        start = time.monotonic()
+        self.dispatch()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout if self.queue_timeout > 0 else None)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            self.discard(entry)
+            raise AdmissionRejected(
+                f"Timed out after {self.queue_timeout:g}s waiting for {self.name}", await self.retry_after()
+            ) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Admitted, but the caller has gone away
+            else:
+                self.discard(entry)
+            raise
+        finally:
+            self.wait_seconds += time.monotonic() - start
+
+    def release(self):
+        self.active -= 1
+        self.dispatch()
+
+    def discard(self, entry):
+        if entry in self.queue:
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            self.dispatch()
+
+    def dispatch(self):
+        """Start admitting queued requests, or have the running dispatcher look again."""
+        if self.dispatcher is not None and not self.dispatcher.done():
+            self.dispatch_again = True
+            return
+        if self.queue:
+            self.dispatcher = asyncio.ensure_future(self.admit_queued())
+
+    async def admit_queued(self):
+        """Admit queued requests from the head while the limits allow."""
+        self.dispatch_again = True
+        while self.dispatch_again:
+            self.dispatch_again = False
+            while self.queue:
+                entry = self.queue[0]
+                future, tokens = entry[2], entry[3]
+                if future.done():
+                    heapq.heappop(self.queue)
+                    continue
+                delay = await self.try_admit(tokens)
+                if delay is None:
+                    break  # Woken by the next release
+                if delay > 0:
+                    self.wake_after(delay)
+                    break
+                # Requests may have been queued ahead of it, or it may have left, meanwhile
+                if entry in self.queue:
+                    self.queue.remove(entry)
+                    heapq.heapify(self.queue)
+                if future.done():
+                    self.active -= 1  # Timed out or cancelled while being admitted
+                else:
+                    future.set_result(None)
+
+    def wake_after(self, delay: float):
+        loop = asyncio.get_running_loop()
+        if self.timer is not None:
+            if self.timer.when() <= loop.time() + delay:
+                return
+            self.timer.cancel()
+        self.timer = loop.call_later(delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    async def release_after(self, response_generator):
+        """Pass a stream through, releasing its slot when the stream finishes."""
+        released = False
+        try:
+            async for chunk in response_generator:
+                if not released and getattr(chunk, "choices", None) and chunk.choices[0].finish_reason:
+                    released = True
+                    self.release()
+                yield chunk
+        finally:
+            if not released:
+                self.release()
+            await close_stream(response_generator)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active, "queued": len(self.queue), "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted, "rejected": self.rejected, "timed_out": self.timed_out,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+def is_small_model_request(request: MessagesRequest) -> bool:
+    """Whether a request is for the small model, i.e. one of Claude Code's quick haiku calls."""
+    original_model = (request.original_model or request.model).lower()
+    return "haiku" in original_model or request.model == model_router.small_target
+
+class AdmissionScheduler:
+    """Per-provider limiters, chosen by the openai/, gemini/ or anthropic/ model prefix."""
+
+    PROVIDERS = ("openai", "gemini", "anthropic")
+
+    def __init__(self, limits: Dict[str, Dict[str, Any]], max_queue: int = 100, queue_timeout: float = 30.0,
+                 small_model_first: bool = True, store=None):
+        self.limiters = {
+            provider: ProviderLimiter(provider, **limits.get(provider, {}), max_queue=max_queue, queue_timeout=queue_timeout,
+                                      store=store)
+            for provider in self.PROVIDERS
+        }
+        self.small_model_first = small_model_first
+
+    def limiter_for(self, model: str) -> Optional[ProviderLimiter]:
+        """Return the limiter for a provider/model name, or None if its provider is unlimited."""
+        limiter = self.limiters[provider_for(model)]
+        return limiter if limiter.limited else None
+
+    def priority_for(self, request: MessagesRequest) -> int:
+        """0 for small model (haiku) requests when they go first, 1 for everything else."""
+        return 0 if self.small_model_first and is_small_model_request(request) else 1
+
+    @staticmethod
+    def estimate_tokens(litellm_request: Dict[str, Any]) -> int:
+        """Rough token cost of a request for the TPM limit: ~4 bytes of JSON per prompt token, plus max_tokens."""
+        prompt_bytes = len(fast_json_dumps(litellm_request.get("messages", [])))
+        return prompt_bytes // 4 + int(litellm_request.get("max_tokens") or 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {provider: limiter.stats() for provider, limiter in self.limiters.items() if limiter.limited}
+
+admission_scheduler = AdmissionScheduler(
+    PROVIDER_LIMITS,
+    max_queue=ADMISSION_QUEUE_SIZE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    small_model_first=ADMISSION_SMALL_MODEL_FIRST,
+    store=shared_store,
+)
+
+class RetryPolicy:
+    """Decides which upstream failures are retried or failed over, and how long to back off.
+
+    Timeouts, connection errors and the configured status codes are retried
+    with full-jitter exponential backoff. A Retry-After from the provider is
+    a lower bound on the wait; if it is longer than max_backoff, the request
+    fails over instead of waiting. Authentication, permission and not found
+    errors are specific to a provider, so they fail over without a retry.
+    Other errors, such as invalid requests, would fail everywhere and are
+    raised as is.
+    """
+
+    FAILOVER_STATUS_CODES = frozenset({401, 403, 404})
+
+    def __init__(self, max_retries: int = 0, backoff: float = 0.5, max_backoff: float = 8.0,
+                 status_codes: frozenset = frozenset(), attempt_timeout: float = 0.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.status_codes = status_codes
+        self.attempt_timeout = attempt_timeout
+        self.retries = 0
+        self.failovers = 0
+
+    @staticmethod
+    def parse_status_codes(value: str) -> frozenset:
+        return frozenset(int(code) for code in value.split(",") if code.strip())
+
+    def is_retryable(self, error: BaseException) -> bool:
+        if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+            return True
+        return getattr(error, "status_code", None) in self.status_codes
+
+    def can_fail_over(self, error: BaseException) -> bool:
+        return (isinstance(error, (AdmissionRejected, CircuitOpenError)) or self.is_retryable(error)
+                or getattr(error, "status_code", None) in self.FAILOVER_STATUS_CODES)
+
+    @staticmethod
+    def retry_after(error: BaseException) -> Optional[float]:
+        """Seconds the provider asked us to wait, from the error's Retry-After header."""
+        headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "litellm_response_headers", None)
+        if not headers:
+            return None
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after") is not None:
+                return float(headers["retry-after"])
+        except (TypeError, ValueError):
+            pass  # HTTP dates aren't worth parsing here
+        return None
+
+    def retry_delay(self, error: BaseException, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying after attempt (0-based) failed, or None to stop retrying."""
+        if attempt >= self.max_retries or not self.is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+    def stats(self) -> Dict[str, int]:
+        return {"retries": self.retries, "failovers": self.failovers}
+
+class FallbackChains:
+    """Ordered fallback models, parsed from chains like "openai/gpt-4.1>gemini/gemini-2.5-pro"."""
+
+    def __init__(self, chains: str = ""):
+        self.fallbacks: Dict[str, List[str]] = {}
+        for chain in chains.split(","):
+            models = [model.strip() for model in chain.split(">") if model.strip()]
+            for index, model in enumerate(models):
+                # The first chain listing a model wins
+                self.fallbacks.setdefault(model, models[index + 1:])
+
+    def candidates_for(self, model: str) -> List[str]:
+        """The model followed by its fallbacks, in the order to try them."""
+        return [model] + self.fallbacks.get(model, [])
+
+retry_policy = RetryPolicy(
+    max_retries=UPSTREAM_MAX_RETRIES,
+    backoff=RETRY_BACKOFF_SECONDS,
+    max_backoff=RETRY_MAX_BACKOFF_SECONDS,
+    status_codes=RetryPolicy.parse_status_codes(RETRY_STATUS_CODES),
+    attempt_timeout=UPSTREAM_ATTEMPT_TIMEOUT_SECONDS,
+)
+fallback_chains = FallbackChains(FALLBACK_CHAINS)
+
+class CircuitBreaker:
+    """Circuit breaker for one upstream model.
+
+    Closed, it records call outcomes over a sliding time window and opens
+    when the error rate reaches the threshold (given enough calls). Open, it
+    rejects calls until open_seconds have passed, then half-opens: a limited
+    number of probe calls go through, and the first probe result closes it
+    again or reopens it.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window: float = 60.0, min_requests: int = 10, error_rate: float = 0.5,
+                 slow_call: float = 0.0, open_seconds: float = 30.0, half_open_probes: int = 1):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.calls = deque()  # (time, failed) for the calls in the window
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0  # Probe calls in flight while half open
+        self.times_opened = 0
+        self.rejected = 0
+
+    def trim(self, now: float):
+        while self.calls and self.calls[0][0] < now - self.window:
+            _, failed = self.calls.popleft()
+            self.failures -= failed
+
+    def retry_after(self) -> float:
+        return max(1.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now. Calls that are allowed must be recorded."""
+        if self.state == self.OPEN:
+            if time.monotonic() < self.opened_at + self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self.probes = 0
+        if self.state == self.HALF_OPEN:
+            if self.probes >= self.half_open_probes:
+                self.rejected += 1
+                return False
+            self.probes += 1
+        return True
+
+    def record(self, failed: Optional[bool], seconds: float = 0.0):
+        """Record an allowed call's outcome: failed, succeeded, or None if it ended without a verdict."""
+        if failed is not None and self.slow_call and seconds > self.slow_call:
+            failed = True
+        if self.state == self.HALF_OPEN:
+            self.probes = max(0, self.probes - 1)
+            if failed is None:
+                return
+            if failed:
+                self.open()
+            else:
+                self.state = self.CLOSED
+                self.calls.clear()
+                self.failures = 0
+            return
+        if self.state == self.OPEN or failed is None:
+            return  # Calls that started before the breaker opened
+        now = time.monotonic()
+        self.calls.append((now, failed))
+        self.failures += failed
+        self.trim(now)
+        if len(self.calls) >= self.min_requests and self.failures >= self.error_rate * len(self.calls):
+            self.open()
+
+    def open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+
+    def stats(self) -> Dict[str, Any]:
+        self.trim(time.monotonic())
+        stats = {
+            "state": self.state, "calls": len(self.calls), "failures": self.failures,
+            "times_opened": self.times_opened, "rejected": self.rejected,
+        }
+        if self.state == self.OPEN:
+            stats["retry_after"] = round(self.retry_after(), 1)
+        return stats
+
+class CircuitBreakers:
+    """One CircuitBreaker per upstream model, created on first use."""
+
+    def __init__(self, enabled: bool = False, **settings):
+        self.enabled = enabled
+        self.settings = settings
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, model: str) -> Optional[CircuitBreaker]:
+        if not self.enabled:
+            return None
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(**self.settings)
+        return breaker
+
+    def stats(self) -> Dict[str, Any]:
+        return {model: breaker.stats() for model, breaker in self.breakers.items()}
+
+circuit_breakers = CircuitBreakers(
+    enabled=CIRCUIT_BREAKER,
+    window=CIRCUIT_BREAKER_WINDOW_SECONDS,
+    min_requests=CIRCUIT_BREAKER_MIN_REQUESTS,
+    error_rate=CIRCUIT_BREAKER_ERROR_RATE,
+    slow_call=CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+    open_seconds=CIRCUIT_BREAKER_OPEN_SECONDS,
+    half_open_probes=CIRCUIT_BREAKER_HALF_OPEN_PROBES,
+)
+
+def build_litellm_request(request: MessagesRequest) -> Dict[str, Any]:
+    """Translate request for LiteLLM, with the API key and pooled client of its provider.
+
+    Requests the Anthropic passthrough handles aren't translated; they are
+    built for anthropic_passthrough.send instead. Streams the OpenAI adapter
+    handles are marked for openai_stream_adapter.send.
+    """
+    if anthropic_passthrough.handles(request.model):
+        return anthropic_passthrough.build_request(request)
+    # OpenAI models need content blocks converted to simple strings
+    litellm_request = convert_anthropic_to_litellm(request, flatten_for_openai="openai" in request.model)
+    
+    # Determine which API key to use based on the model
+    if request.model.startswith("openai/"):
+        litellm_request["api_key"] = OPENAI_API_KEY
+        logger.debug("Using OpenAI API key for model: %s", request.model)
+    elif request.model.startswith("gemini/"):
+        litellm_request["api_key"] = GEMINI_API_KEY
+        logger.debug("Using Gemini API key for model: %s", request.model)
+    else:
+        litellm_request["api_key"] = ANTHROPIC_API_KEY
+        logger.debug("Using Anthropic API key for model: %s", request.model)
+
+    # Reuse the provider's pooled connections
+    upstream_client = upstream_clients.get(request.model)
+    if upstream_client is not None:
+        litellm_request["client"] = upstream_client
+    if openai_stream_adapter.handles(request):
+        # Sent by the OpenAI adapter instead of LiteLLM
+        litellm_request["openai_native"] = True
+    return litellm_request
+
+class LatencyHistogram:
+    """Upstream latencies in log-spaced buckets, from 10 ms to about 5 minutes.
+
+    Counts are halved whenever they reach twice the window, so percentiles
+    follow recent behavior rather than the whole history.
+    """
+
+    BOUNDS = tuple(0.01 * 1.25 ** i for i in range(47))  # Bucket upper bounds, in seconds
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+        if self.total >= 2 * self.window:
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """The upper bound of the bucket holding the pct-th percentile, or None with no samples."""
+        if not self.total:
+            return None
+        target = self.total * pct / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+class UpstreamLatency:
+    """Per-model time to first byte - the whole response, or a stream's first chunk.
+
+    The histograms drive the hedging delay for each model.
+    """
+
+    def __init__(self, percentile: float = 95, default_delay: float = 2.0, min_delay: float = 0.1, min_samples: int = 20):
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def observe(self, model: str, seconds: float):
+        histogram = self.histograms.get(model)
+        if histogram is None:
+            histogram = self.histograms[model] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def hedge_delay(self, model: str) -> float:
+        """Seconds to wait for model before sending a hedged request."""
+        histogram = self.histograms.get(model)
+        if histogram is None or histogram.total < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, histogram.percentile(self.percentile))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+            "models": {
+                model: {"samples": histogram.total, "p50": histogram.percentile(50), "p95": histogram.percentile(95), "p99": histogram.percentile(99)}
+                for model, histogram in self.histograms.items()
+            },
+        }
+
+upstream_latency = UpstreamLatency(
+    percentile=HEDGE_PERCENTILE,
+    default_delay=HEDGE_DELAY_SECONDS,
+    min_delay=HEDGE_MIN_DELAY_SECONDS,
+    min_samples=HEDGE_MIN_SAMPLES,
+)
+
+async def prepend_chunk(first_chunk, response_generator):
+    try:
+        yield first_chunk
+        async for chunk in response_generator:
+            yield chunk
+    finally:
+        await close_stream(response_generator)
+
+async def upstream_attempt(request: MessagesRequest, litellm_request: Dict[str, Any], priority: int, peek: bool):
+    """Make one upstream call through the provider's limiter.
+
+    With peek, a stream's first chunk is awaited before returning, so a
+    stream that fails before producing anything can still be retried.
+    """
+    breaker = circuit_breakers.get(request.model)
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpenError(f"Circuit breaker for {request.model} is open", breaker.retry_after())
+    limiter = admission_scheduler.limiter_for(request.model)
+    if limiter is not None:
+        tokens = admission_scheduler.estimate_tokens(litellm_request) if limiter.tokens is not None else 0
+        try:
+            with tracing.span("admission_queue", **{"proxy.provider": provider_for(request.model)}):
+                await limiter.acquire(priority, tokens)
+        except BaseException:
+            if breaker is not None:
+                breaker.record(None)
+            raise
+    timeout = retry_policy.attempt_timeout or None
+    span = tracing.start_span("upstream", attributes={"gen_ai.request.model": request.model, "proxy.stream": bool(request.stream)})
+    if tracing.enabled:
+        # Pass the trace on to the provider, as this attempt's span
+        extra_headers = {**(litellm_request.get("extra_headers") or {}), **tracing.headers(span)}
+        litellm_request = {**litellm_request, "extra_headers": extra_headers}
+    start = time.monotonic()
+    try:
+        response = await asyncio.wait_for(send_upstream(litellm_request), timeout)
+        if request.stream and peek:
+            try:
+                first_chunk = await asyncio.wait_for(response.__anext__(), timeout)
+            except StopAsyncIteration:
+                first_chunk = None
+            except BaseException:
+                await close_stream(response)
+                raise
+            if first_chunk is not None:
+                response = prepend_chunk(first_chunk, response)
+    except BaseException as e:
+        if limiter is not None:
+            limiter.release()
+        if breaker is not None:
+            # Only provider failures count against it, not invalid requests or cancellation
+            breaker.record(retry_policy.can_fail_over(e) if isinstance(e, Exception) else None)
+        tracing.fail(span, e, getattr(e, "status_code", None))
+        span.end()
+        raise
+    span.end()
+    elapsed = time.monotonic() - start
+    upstream_latency.observe(request.model, elapsed)
+    if breaker is not None:
+        breaker.record(False, elapsed)
+    if limiter is not None:
+        if request.stream:
+            # The slot is held until the stream ends
+            return limiter.release_after(response)
+        limiter.release()
+    return response
+
+async def close_unused_response(response):
+    """Release a response nobody will read, along with its stream's limiter slot."""
+    if hasattr(response, "__anext__"):
+        try:
+            # The slot is released when the stream finishes, so start it before closing it
+            await response.__anext__()
+        except Exception:
+            pass
+        await response.aclose()
+
+def discard_attempt(task: asyncio.Future):
+    """Cancel an upstream attempt whose result isn't needed, closing the result if it arrives anyway."""
+    def close_result(task):
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(close_unused_response(task.result()))
+    task.cancel()
+    task.add_done_callback(close_result)
+
+async def hedged_attempt(request: MessagesRequest, litellm_request: Dict[str, Any], priority: int):
+    """Like upstream_attempt, but if the first byte is late, race a duplicate request against it.
+
+    The duplicate goes to HEDGE_MODEL, or the same model, after the model's
+    hedge delay. The first successful response wins and the other call is
+    cancelled. An error only counts once both calls have failed.
+    """
+    start = time.monotonic()
+    primary = asyncio.ensure_future(upstream_attempt(request, litellm_request, priority, True))
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=upstream_latency.hedge_delay(request.model))
+        if done:
+            return primary.result()
+
+        hedge_request = request.model_copy(update={"model": HEDGE_MODEL}) if HEDGE_MODEL else request
+        hedge_litellm_request = build_litellm_request(hedge_request) if HEDGE_MODEL else litellm_request
+        hedge = asyncio.ensure_future(upstream_attempt(hedge_request, hedge_litellm_request, priority, True))
+        upstream_latency.hedges += 1
+        logger.debug("Hedging %s with %s after %.2fs", request.model, hedge_request.model, time.monotonic() - start)
+        pending.add(hedge)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in (primary, hedge) if task in done and task.exception() is None]
+            if winners:
+                if winners[0] is hedge:
+                    upstream_latency.hedge_wins += 1
+                pending.update(winners[1:])
+                return winners[0].result()
+        raise primary.exception()
+    finally:
+        if primary in pending and not primary.done():
+            # The stalled call never finished - its wait so far is a lower bound on its latency
+            upstream_latency.observe(request.model, time.monotonic() - start)
+        for task in pending:
+            discard_attempt(task)
+
+async def call_upstream(request: MessagesRequest, litellm_request: Dict[str, Any], priority: int = 1):
+    """Call upstream with retries and failover, returning (response, model that served it).
+
+    Each model in the request's fallback chain is tried in turn, with
+    retries per retry_policy. Streams are only retried or failed over before
+    their first chunk, so nothing has been sent to the client yet.
+    """
+    candidates = fallback_chains.candidates_for(request.model)
+    # Streams are peeked only when a failure could be retried
+    peek = len(candidates) > 1 or retry_policy.max_retries > 0 or bool(retry_policy.attempt_timeout)
+    # Latency-sensitive small model calls can race a duplicate request
+    hedge = HEDGE_REQUESTS and is_small_model_request(request)
+    for index, model in enumerate(candidates):
+        if index > 0:
+            request = request.model_copy(update={"model": model})
+            litellm_request = build_litellm_request(request)
+        attempt = 0
+        while True:
+            try:
+                if hedge:
+                    return await hedged_attempt(request, litellm_request, priority), model
+                return await upstream_attempt(request, litellm_request, priority, peek), model
+            except Exception as e:
+                delay = retry_policy.retry_delay(e, attempt)
+                if delay is not None:
+                    retry_policy.retries += 1
+                    attempt += 1
+                    logger.warning("Upstream %s failed (%s: %s), retry %s in %.2fs", model, type(e).__name__, e, attempt, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                if index + 1 < len(candidates) and retry_policy.can_fail_over(e):
+                    retry_policy.failovers += 1
+                    logger.warning("Upstream %s failed (%s: %s), failing over to %s", model, type(e).__name__, e, candidates[index + 1])
+                    break
+                raise
+
+# Prometheus metrics, in the text exposition format. Hot-path updates are a
+# dict lookup and an add; subsystem stats are read when /metrics is scraped.
+
+def escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """A Prometheus counter. Label values are passed as a tuple, in labelnames order."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+class Gauge(Counter):
+    """A Prometheus gauge."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), merge: str = "sum"):
+        super().__init__(name, help, labelnames)
+        self.merge = merge  # How workers' values combine: "sum", or "max" for values they all share
+
+    def set(self, labels: tuple, value: float):
+        self.values[labels] = value
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+class Histogram:
+    """A Prometheus histogram. Buckets are kept uncumulated and summed when rendered."""
+
+    kind = "histogram"
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values: Dict[tuple, list] = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, labels: tuple, value: float):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                bucket_labels = format_labels(self.labelnames, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+class MetricsRegistry:
+    """Holds the proxy's metrics, plus collectors that read other components' stats at scrape time."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Register fn, which returns metrics to render with their current values."""
+        self.collectors.append(fn)
+        return fn
+
+    def collect(self) -> list:
+        metrics = list(self.metrics)
+        for collect in self.collectors:
+            try:
+                metrics.extend(collect())
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", collect.__name__, e)
+        return metrics
+
+    def render(self, metrics: Optional[list] = None) -> str:
+        lines = []
+        for metric in self.collect() if metrics is None else metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    # With several workers, each one publishes a snapshot of its metrics to
+    # the shared store, and whichever worker is scraped renders their sum.
+
+    def snapshot(self) -> bytes:
+        """This process's metrics and their values, compressed for the shared store."""
+        return zlib.compress(fast_json_dumps([
+            {
+                "name": metric.name, "kind": metric.kind, "help": metric.help, "labelnames": metric.labelnames,
+                "buckets": getattr(metric, "buckets", None), "merge": getattr(metric, "merge", None),
+                "values": list(metric.values.items()),
+            }
+            for metric in self.collect()
+        ]), 1)
+
+    @staticmethod
+    def merge(snapshots) -> list:
+        """Combine workers' snapshots: counters and histograms add up, gauges add up or take the max."""
+        merged = {}
+        for snapshot in snapshots:
+            for family in fast_json_loads(zlib.decompress(snapshot)):
+                metric = merged.get(family["name"])
+                if metric is None:
+                    labelnames = tuple(family["labelnames"])
+                    if family["kind"] == "histogram":
+                        metric = Histogram(family["name"], family["help"], labelnames, tuple(family["buckets"]))
+                    elif family["kind"] == "gauge":
+                        metric = Gauge(family["name"], family["help"], labelnames, family["merge"])
+                    else:
+                        metric = Counter(family["name"], family["help"], labelnames)
+                    merged[family["name"]] = metric
+                for labels, value in family["values"]:
+                    labels = tuple(labels)
+                    current = metric.values.get(labels)
+                    if current is None:
+                        metric.values[labels] = value
+                    elif metric.kind == "histogram":
+                        metric.values[labels] = [a + b for a, b in zip(current, value)]
+                    elif metric.kind == "gauge" and metric.merge == "max":
+                        metric.values[labels] = max(current, value)
+                    else:
+                        metric.values[labels] = current + value
+        return list(merged.values())
+
+    async def publish(self, store, ttl: float) -> bool:
+        snapshot = self.snapshot()
+        key = f"metrics:{WORKER_ID}"
+        if store.blocking:
+            return await asyncio.to_thread(store.set, key, snapshot, ttl)
+        return store.set(key, snapshot, ttl)
+
+    async def render_workers(self, store) -> str:
+        """Render the metrics of every worker that has published them, this one up to date."""
+        await self.publish(store, 3 * METRICS_PUBLISH_SECONDS)
+        def read():
+            return [store.get(key) for key in store.keys("metrics:")]
+        snapshots = await asyncio.to_thread(read) if store.blocking else read()
+        return self.render(self.merge(snapshot for snapshot in snapshots if snapshot is not None))
+
+    async def publish_periodically(self, store, interval: float):
+        """Keep this worker's snapshot fresh, so it's included whichever worker is scraped."""
+        warned = False
+        while True:
+            try:
+                if not await self.publish(store, 3 * interval) and not warned:
+                    warned = True
+                    logger.warning("This worker's metrics don't fit in the shared store; raise SHARED_STORE_SLOT_KB")
+            except Exception as e:
+                logger.warning("Could not publish metrics: %s", e)
+            await asyncio.sleep(interval)
+
+REQUEST_LABELS = ("original_model", "mapped_model", "provider")
+
+metrics = MetricsRegistry()
+requests_total = metrics.add(Counter("proxy_requests_total", "Requests handled, by route and HTTP status.", ("route",) + REQUEST_LABELS + ("status",)))
+request_duration = metrics.add(Histogram("proxy_request_duration_seconds", "Time to send the response, or to start a stream.", ("route",) + REQUEST_LABELS))
+upstream_first_byte = metrics.add(Histogram("proxy_upstream_first_byte_seconds", "Time from the request arriving to the first upstream byte: the response, or a stream's first chunk.", REQUEST_LABELS))
+first_sse_byte = metrics.add(Histogram("proxy_first_sse_byte_seconds", "Time from the request arriving to the first SSE bytes sent to the client.", REQUEST_LABELS))
+stream_duration = metrics.add(Histogram("proxy_stream_duration_seconds", "Time from the request arriving to the end of its stream.", REQUEST_LABELS))
+output_tokens_per_second = metrics.add(Histogram(
+    "proxy_output_tokens_per_second", "Output tokens per second after the first upstream byte.", REQUEST_LABELS,
+    buckets=(5, 10, 25, 50, 75, 100, 150, 200, 300, 500, 1000),
+))
+translation_duration = metrics.add(Histogram(
+    "proxy_translation_seconds", "Time translating requests to LiteLLM and responses back to Anthropic.", ("direction",) + REQUEST_LABELS,
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+))
+streams_in_flight = metrics.add(Gauge("proxy_streams_in_flight", "Streams currently being sent to clients.", REQUEST_LABELS))
+streams_cancelled = metrics.add(Counter(
+    "proxy_streams_cancelled_total", "Streams closed upstream before they finished, because the client disconnected or fell behind.",
+    REQUEST_LABELS + ("reason",),
+))
+stream_tokens_avoided = metrics.add(Counter(
+    "proxy_stream_tokens_avoided_total", "Estimated output tokens not generated because cancelled streams were closed upstream.", REQUEST_LABELS,
+))
+stream_buffer_full = metrics.add(Counter(
+    "proxy_stream_buffer_full_total", "Times a stream's buffer was full, so reading upstream waited for the client.", REQUEST_LABELS,
+))
+passthrough_tokens = metrics.add(Counter(
+    "proxy_passthrough_tokens_total", "Tokens the Anthropic API reported for passthrough requests, by type: input, output, cache_read_input and cache_creation_input.",
+    REQUEST_LABELS + ("type",),
+))
+
+def provider_for(model: str) -> str:
+    """The upstream provider of a provider/model name. Unprefixed models use the Anthropic API key."""
+    provider = model.split("/", 1)[0]
+    return provider if provider in AdmissionScheduler.PROVIDERS else "anthropic"
+
+def request_labels(request: BaseModel) -> tuple:
+    return (request.original_model or request.model, request.model, provider_for(request.model))
+
+def observe_request(route: str, labels: tuple, status: int, started: float):
+    requests_total.inc((route,) + labels + (str(status),))
+    request_duration.observe((route,) + labels, time.perf_counter() - started)
+
+def observe_completion(labels: tuple, started: float, upstream_started: float, completion_tokens: int):
+    """Record upstream timing and throughput for a non-streaming response."""
+    now = time.perf_counter()
+    upstream_first_byte.observe(labels, now - started)
+    if completion_tokens and now > upstream_started:
+        output_tokens_per_second.observe(labels, completion_tokens / (now - upstream_started))
+
+def observe_passthrough_usage(labels: tuple, tokens: Dict[str, int]):
+    """Count the tokens in a passthrough response's usage."""
+    for kind in ("input", "output", "cache_read_input", "cache_creation_input"):
+        count = tokens.get(kind + "_tokens")
+        if count:
+            passthrough_tokens.inc(labels + (kind,), count)
+
+class StreamLengths:
+    """Running averages of finished streams' output tokens and upstream chunks, per mapped model.
+
+    A stream cancelled after n chunks would likely have run to the average
+    length, so the rest of the average estimates what cancelling it saved.
+    """
+
+    SMOOTHING = 0.1
+
+    def __init__(self):
+        self.averages: Dict[str, list] = {}  # model -> [output tokens, upstream chunks]
+
+    def finished(self, model: str, tokens: int, chunks: int):
+        if not tokens or not chunks:
+            return
+        average = self.averages.get(model)
+        if average is None:
+            self.averages[model] = [tokens, chunks]
+        else:
+            average[0] += (tokens - average[0]) * self.SMOOTHING
+            average[1] += (chunks - average[1]) * self.SMOOTHING
+
+    def remaining_tokens(self, model: str, chunks: int) -> float:
+        """Estimated output tokens a stream of model had left after chunks upstream chunks."""
+        average = self.averages.get(model)
+        if average is None:
+            return 0.0
+        tokens, average_chunks = average
+        return max(0.0, tokens - chunks * tokens / average_chunks)
+
+stream_lengths = StreamLengths()
+
+class StreamTimer:
+    """Times one streamed response: the upstream chunks going in and the SSE frames going out."""
+
+    __slots__ = ("labels", "started", "first_chunk", "completion_tokens", "chunks", "finished")
+
+    def __init__(self, labels: tuple, started: float):
+        self.labels = labels
+        self.started = started
+        self.first_chunk = None
+        self.completion_tokens = 0
+        self.chunks = 0
+        self.finished = False
+
+    async def upstream(self, response_generator):
+        try:
+            async for chunk in response_generator:
+                self.chunks += 1
+                if self.first_chunk is None:
+                    self.first_chunk = time.perf_counter()
+                    upstream_first_byte.observe(self.labels, self.first_chunk - self.started)
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    self.completion_tokens = getattr(usage, "completion_tokens", 0) or self.completion_tokens
+                yield chunk
+        finally:
+            await close_stream(response_generator)
+
+    async def client(self, sse_generator):
+        streams_in_flight.inc(self.labels)
+        first = True
+        try:
+            async for frame in sse_generator:
+                if first:
+                    first = False
+                    first_sse_byte.observe(self.labels, time.perf_counter() - self.started)
+                yield frame
+            self.finished = True
+        finally:
+            streams_in_flight.dec(self.labels)
+            now = time.perf_counter()
+            stream_duration.observe(self.labels, now - self.started)
+            if self.completion_tokens and self.first_chunk is not None and now > self.first_chunk:
+                output_tokens_per_second.observe(self.labels, self.completion_tokens / (now - self.first_chunk))
+            if self.finished:
+                stream_lengths.finished(self.labels[1], self.completion_tokens, self.chunks)
+            await close_stream(sse_generator)
+
+    def cancelled(self, reason: str):
+        """Count a stream closed early, with an estimate of the output tokens that saved."""
+        streams_cancelled.inc(self.labels + (reason,))
+        avoided = stream_lengths.remaining_tokens(self.labels[1], self.chunks)
+        if avoided:
+            stream_tokens_avoided.inc(self.labels, avoided)
+
+@metrics.collector
+def collect_component_metrics():
+    """Read the caches, queues and breakers' own counters."""
+    collected = []
+    def add(metric, values):
+        for labels, value in values:
+            if value is not None:
+                metric.values[labels] = value
+        collected.append(metric)
+
+    cache = response_cache.stats()
+    if cache["enabled"]:
+        add(Counter("proxy_response_cache_hits_total", "Response cache hits."), [((), cache["hits"])])
+        add(Counter("proxy_response_cache_misses_total", "Response cache misses."), [((), cache["misses"])])
+        shared = isinstance(response_cache.store, SharedResponseStore)
+        add(Gauge("proxy_response_cache_entries", "Responses in the response cache.", merge="max" if shared else "sum"), [((), cache["entries"])])
+        add(Gauge("proxy_response_cache_bytes", "Size of the cached responses."), [((), cache["bytes"])])
+    counts = prompt_token_counter.stats()
+    add(Counter("proxy_token_count_cache_hits_total", "count_tokens message cache hits."), [((), counts["messages"]["hits"])])
+    add(Counter("proxy_token_count_cache_misses_total", "count_tokens message cache misses."), [((), counts["messages"]["misses"])])
+    flights = single_flight.stats()
+    add(Counter("proxy_single_flight_joined_total", "Requests that joined an identical request in flight."), [((), flights["joined"])])
+
+    admission = admission_scheduler.stats()
+    for name, kind, help in (
+        ("active", Gauge, "Upstream requests holding an admission slot."),
+        ("queued", Gauge, "Requests waiting in the admission queue."),
+        ("admitted", Counter, "Requests admitted upstream."),
+        ("rejected", Counter, "Requests rejected because the admission queue was full."),
+        ("timed_out", Counter, "Requests that timed out in the admission queue."),
+    ):
+        metric_name = f"proxy_admission_{name}" + ("_total" if kind is Counter else "")
+        add(kind(metric_name, help, ("provider",)), [((provider,), stats[name]) for provider, stats in admission.items()])
+
+    retries = retry_policy.stats()
+    add(Counter("proxy_upstream_retries_total", "Upstream attempts retried."), [((), retries["retries"])])
+    add(Counter("proxy_upstream_failovers_total", "Requests failed over to a fallback model."), [((), retries["failovers"])])
+    hedging = upstream_latency.stats()
+    add(Counter("proxy_hedged_requests_total", "Hedged duplicate requests sent."), [((), hedging["hedges"])])
+    add(Counter("proxy_hedge_wins_total", "Hedged duplicates that answered first."), [((), hedging["hedge_wins"])])
+    passthrough = anthropic_passthrough.stats()
+    if passthrough["enabled"]:
+        add(Counter("proxy_passthrough_requests_total", "Requests sent to the Anthropic API by the passthrough."), [((), passthrough["requests"])])
+    native = openai_stream_adapter.stats()
+    if native["enabled"]:
+        add(Counter("proxy_openai_native_streams_total", "Streams sent to the OpenAI API by the native adapter."), [((), native["requests"])])
+    states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 0.5, CircuitBreaker.OPEN: 1}
+    add(Gauge("proxy_circuit_breaker_state", "Circuit breaker state per upstream model: 0 closed, 0.5 half open, 1 open.", ("model",), "max"),
+        [((model, ), states[stats["state"]]) for model, stats in circuit_breakers.stats().items()])
+    return collected
+
+# OpenTelemetry tracing. Each request gets a span with children for its
+# stages; with tracing off, every span is NOOP_SPAN and costs nothing.
+
+class NoopSpan:
+    """Stands in for a span when tracing is off."""
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        pass
+
+    def record_exception(self, exception: BaseException):
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+    def end(self, end_time: Optional[int] = None):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+class Tracing:
+    """OpenTelemetry spans for the request pipeline, exported by a batch processor.
+
+    A request's span starts when its route receives it, with children for
+    validate_request (body parsing and validation), translate_request and its
+    translate_messages loop, admission_queue, each upstream attempt,
+    handle_streaming or translate_response. The upstream call carries the
+    W3C traceparent of its span, and an incoming traceparent is continued.
+    """
+
+    def __init__(self, exporter: str = "off", file_path: str = "traces.jsonl", service_name: str = "anthropic-proxy"):
+        self.enabled = False
+        self.provider = None
+        self.tracer = None
+        self.file = None
+        if exporter in ("off", "", "none"):
+            return
+        if otel_trace is None:
+            logger.warning("TRACING_EXPORTER is set but opentelemetry isn't installed, tracing is off")
+            return
+        try:
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+        except ImportError:
+            logger.warning("TRACING_EXPORTER is set but opentelemetry-sdk isn't installed, tracing is off")
+            return
+        if exporter == "otlp":
+            try:
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            except ImportError:
+                logger.warning("TRACING_EXPORTER is otlp but opentelemetry-exporter-otlp-proto-http isn't installed, tracing is off")
+                return
+            span_exporter = OTLPSpanExporter()
+        elif exporter == "file":
+            self.file = open(file_path, "a", encoding="utf-8")
+            span_exporter = ConsoleSpanExporter(out=self.file, formatter=lambda span: span.to_json(indent=None) + "\n")
+        else:
+            logger.warning("Unknown TRACING_EXPORTER '%s', tracing is off", exporter)
+            return
+        self.provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        self.provider.add_span_processor(BatchSpanProcessor(span_exporter))
+        self.tracer = self.provider.get_tracer("anthropic-proxy")
+        self.enabled = True
+
+    def start_span(self, name: str, parent: Any = None, attributes: Optional[Dict[str, Any]] = None,
+                   start_time: Optional[int] = None, context: Any = None, kind: Any = None):
+        """Start a span under parent, or else under context or the current span. The caller ends it."""
+        if not self.enabled:
+            return NOOP_SPAN
+        if parent is not None:
+            context = otel_trace.set_span_in_context(parent)
+        return self.tracer.start_span(name, context=context, kind=kind or otel_trace.SpanKind.INTERNAL,
+                                      attributes=attributes, start_time=start_time)
+
+    def span(self, name: str, **attributes):
+        """Context manager for a span under the current one, which is current inside it."""
+        if not self.enabled:
+            return contextlib.nullcontext(NOOP_SPAN)
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+    def start_request_span(self, name: str, raw_request: Request, attributes: Dict[str, Any]):
+        """Start the span for a whole request, continuing the client's trace if it sent a traceparent.
+
+        It starts when the route received the request, and the time until now
+        is recorded as its validate_request child.
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        received = raw_request.scope.get("received_ns")
+        span = self.start_span(name, attributes=attributes, start_time=received,
+                               context=otel_propagate.extract(raw_request.headers), kind=otel_trace.SpanKind.SERVER)
+        self.start_span("validate_request", parent=span, start_time=received).end()
+        return span
+
+    def activate(self, span):
+        """Make span the current span, returning a token for deactivate."""
+        if not self.enabled:
+            return None
+        return otel_context.attach(otel_trace.set_span_in_context(span))
+
+    def deactivate(self, token):
+        if token is not None:
+            otel_context.detach(token)
+
+    def headers(self, span) -> Dict[str, str]:
+        """W3C trace-context headers that make span the parent of a downstream call."""
+        carrier = {}
+        otel_propagate.inject(carrier, context=otel_trace.set_span_in_context(span))
+        return carrier
+
+    def fail(self, span, exception: BaseException, status_code: Optional[int] = None):
+        """Mark span as failed by exception."""
+        if not span.is_recording():
+            return
+        span.record_exception(exception)
+        span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, f"{type(exception).__name__}: {exception}"))
+        if status_code is not None:
+            span.set_attribute("http.response.status_code", status_code)
+
+    def flush(self):
+        if self.provider is not None:
+            self.provider.force_flush()
+
+    def shutdown(self):
+        """Export any spans still queued. Called at app shutdown."""
+        if self.provider is not None:
+            self.provider.shutdown()
+            self.provider = None
+            self.enabled = False
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+tracing = Tracing(TRACING_EXPORTER, TRACING_FILE, TRACING_SERVICE_NAME)
+
+def request_attributes(request: BaseModel) -> Dict[str, Any]:
+    """Span attributes describing an Anthropic request."""
+    return {
+        "gen_ai.request.model": request.model,
+        "proxy.original_model": request.original_model or request.model,
+        "proxy.messages": len(request.messages),
+        "proxy.tools": len(request.tools) if request.tools else 0,
+    }
+
+def usage_attributes(prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> Dict[str, Any]:
+    attributes = {}
+    if prompt_tokens is not None:
+        attributes["gen_ai.usage.input_tokens"] = prompt_tokens
+    if completion_tokens is not None:
+        attributes["gen_ai.usage.output_tokens"] = completion_tokens
+    return attributes
+
+class StreamSpan:
+    """Traces a stream as handle_streaming's span, splitting its time into upstream waits and the rest.
+
+    Time spent producing SSE frames that wasn't spent waiting for upstream
+    chunks is handle_streaming's own re-encoding work. Ends the request span
+    when the stream does.
+    """
+
+    def __init__(self, request_span):
+        self.request_span = request_span
+        self.span = tracing.start_span("handle_streaming", parent=request_span)
+        self.upstream_seconds = 0.0
+        self.chunks = 0
+        self.prompt_tokens = None
+        self.completion_tokens = None
+
+    async def upstream(self, response_generator):
+        clock = time.perf_counter
+        resumed = clock()
+        try:
+            async for chunk in response_generator:
+                self.upstream_seconds += clock() - resumed
+                self.chunks += 1
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    self.prompt_tokens = getattr(usage, "prompt_tokens", None) or self.prompt_tokens
+                    self.completion_tokens = getattr(usage, "completion_tokens", None) or self.completion_tokens
+                yield chunk
+                resumed = clock()
+        finally:
+            await close_stream(response_generator)
+
+    async def client(self, sse_generator):
+        clock = time.perf_counter
+        producing = 0.0
+        frames = 0
+        try:
+            resumed = clock()
+            async for frame in sse_generator:
+                producing += clock() - resumed
+                frames += 1
+                yield frame
+                resumed = clock()
+        except Exception as e:
+            tracing.fail(self.span, e)
+            tracing.fail(self.request_span, e)
+            raise
+        finally:
+            self.span.set_attributes({
+                "proxy.upstream_chunks": self.chunks,
+                "proxy.sse_frames": frames,
+                "proxy.upstream_wait_seconds": self.upstream_seconds,
+                "proxy.encode_seconds": max(producing - self.upstream_seconds, 0.0),
+            })
+            self.span.end()
+            self.request_span.set_attributes(usage_attributes(self.prompt_tokens, self.completion_tokens))
+            self.request_span.end()
+            await close_stream(sse_generator)
+
+class ClientStreamingResponse(StreamingResponse):
+    """A streaming response that closes its stream, and the upstream call behind it, once the client is gone.
+
+    A producer task reads SSE frames into a buffer of up to buffer_frames
+    while the response sends them, so upstream bursts and client stalls don't
+    hold each other up. With the buffer full, the "wait" policy stops reading
+    upstream until the client catches up, leaving TCP flow control to slow
+    the provider down. The "disconnect" policy ends the stream instead if the
+    client hasn't caught up within slow_client_timeout. The client's
+    connection is watched throughout, and on_cancel(reason) is called when the
+    stream is cut short.
+    """
+
+    def __init__(self, content, on_cancel=None, labels: tuple = (), buffer_frames: Optional[int] = None,
+                 policy: Optional[str] = None, slow_client_timeout: Optional[float] = None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_cancel = on_cancel
+        self.labels = labels
+        self.buffer_frames = STREAM_BUFFER_FRAMES if buffer_frames is None else buffer_frames
+        self.policy = policy or STREAM_BUFFER_POLICY
+        self.slow_client_timeout = STREAM_SLOW_CLIENT_TIMEOUT_SECONDS if slow_client_timeout is None else slow_client_timeout
+        self.cancel_reason = None
+
+    async def __call__(self, scope, receive, send):
+        task = asyncio.current_task()
+        sending = True
+
+        def cancel(reason: str):
+            # Once the stream has ended, a cancel would only land in the cleanup below
+            if self.cancel_reason is None and sending:
+                self.cancel_reason = reason
+                task.cancel()
+
+        async def watch_client():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            cancel("client_disconnect")
+
+        watcher = asyncio.create_task(watch_client())
+        producer = None
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if self.buffer_frames > 0:
+                buffer = asyncio.Queue(self.buffer_frames)
+                producer = asyncio.create_task(self.produce(buffer, cancel))
+                frames = self.drain(buffer)
+            else:
+                frames = self.body_iterator
+            async for frame in frames:
+                await send({"type": "http.response.body", "body": frame, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except asyncio.CancelledError:
+            if self.cancel_reason is None:
+                raise
+            # Withdraw our own cancel request (Python 3.11+), so an enclosing
+            # timeout or task group still sees any cancel of its own
+            uncancel = getattr(task, "uncancel", None)
+            if uncancel is not None and uncancel() > 0:
+                raise
+        except OSError:
+            self.cancel_reason = "client_disconnect"
+        finally:
+            sending = False
+            watcher.cancel()
+            if producer is not None:
+                producer.cancel()
+                await asyncio.gather(producer, return_exceptions=True)
+            await close_stream(self.body_iterator)
+            if self.cancel_reason is not None and self.on_cancel is not None:
+                self.on_cancel(self.cancel_reason)
+        if self.background is not None:
+            await self.background()
+
+    async def produce(self, buffer: asyncio.Queue, cancel):
+        """Read frames into the buffer, ending with None, or the exception that ended the stream."""
+        try:
+            async for frame in self.body_iterator:
+                if not buffer.full():
+                    buffer.put_nowait(frame)
+                    continue
+                stream_buffer_full.inc(self.labels)
+                if self.policy == "disconnect":
+                    try:
+                        await asyncio.wait_for(buffer.put(frame), self.slow_client_timeout)
+                    except asyncio.TimeoutError:
+                        cancel("slow_client")
+                        return
+                else:
+                    await buffer.put(frame)
+        except Exception as e:
+            await buffer.put(e)
+            return
+        await buffer.put(None)
+
+    @staticmethod
+    async def drain(buffer: asyncio.Queue):
+        while True:
+            frame = await buffer.get()
+            if frame is None:
+                return
+            if isinstance(frame, Exception):
+                raise frame
+            yield frame
+
+@app.post("/v1/messages")
+async def create_message(
+    request: MessagesRequest,
+    raw_request: Request,
+    response: Response
+):
+    started = time.perf_counter()
+    labels = request_labels(request)
+    request_span = tracing.start_request_span("POST /v1/messages", raw_request, {**request_attributes(request), "proxy.stream": bool(request.stream)})
+    # Spans started while handling the request are its children
+    trace_token = tracing.activate(request_span)
+    streaming = False
+    try:
+        # The body has already been parsed into the request model - don't decode it again
+        original_model = request.original_model or request.model
+        
+        # Get the display name for logging, just the model name without provider prefix
+        display_model = original_model
+        if "/" in display_model:
+            display_model = display_model.split("/")[-1]
+        
+        # Clean model name for capability check
+        clean_model = request.model
+        if clean_model.startswith("anthropic/"):
+            clean_model = clean_model[len("anthropic/"):]
+        elif clean_model.startswith("openai/"):
+            clean_model = clean_model[len("openai/"):]
+        
+        logger.debug("📊 PROCESSING REQUEST: Model=%s, Stream=%s", request.model, request.stream)
+        
+        # anthropic/ models can skip LiteLLM and go to the Anthropic API as they are,
+        # and openai/ streams can be read without LiteLLM's chunk objects
+        passthrough = anthropic_passthrough.handles(request.model)
+        if passthrough:
+            request._anthropic_headers = anthropic_passthrough.client_headers(raw_request.headers)
+        native = openai_stream_adapter.handles(request)
+        
+        # Convert Anthropic request to LiteLLM format, with the provider's API key and client
+        translation_started = time.perf_counter()
+        with tracing.span("translate_request"):
+            litellm_request = build_litellm_request(request)
+        translation_duration.observe(("request",) + labels, time.perf_counter() - translation_started)
         
         # Only log basic info about the request, not the full details
-        logger.debug(f"Request for model: {litellm_request.get('model')}, stream: {litellm_request.get('stream', False)}")
+        logger.debug("Request for model: %s, stream: %s", litellm_request.get('model'), litellm_request.get('stream', False))
+        
+        # Deterministic requests can be answered from the response cache. Passthrough
+        # responses aren't translated into its records, so they skip it.
+        cache_key = None
+        if response_cache.enabled and response_cache.cacheable(request) and not passthrough:
+            cache_key = response_cache.key_for(litellm_request)
+            record = await response_cache.get(cache_key)
+            if record is not None:
+                logger.debug("Response cache hit for model: %s", request.model)
+                observe_request("messages", labels, 200, started)
+                request_span.set_attribute("proxy.cache", "hit")
+                if request.stream:
+                    return ClientStreamingResponse(
+                        handle_streaming(replay_completion_record(record), request),
+                        labels=labels,
+                        media_type="text/event-stream",
+                        headers={"X-Cache": "HIT"}
+                    )
+                response.headers["X-Cache"] = "HIT"
+                return convert_litellm_to_anthropic(completion_record_to_response(record), request)
+        
+        # Queued requests for the small model go first
+        priority = admission_scheduler.priority_for(request)
+        
+        flight_key = None
+        if "messages" in SINGLE_FLIGHT_ROUTES:
+            flight_key = ("messages", bool(request.stream), cache_key or litellm_request_hash(litellm_request))
         
         # Handle streaming mode
         if request.stream:
@@ -1269,12 +4945,46 @@ async def create_message(
                 num_tools,
                 200  # Assuming success at this point
             )
-            # Ensure we use the async version for streaming
-            response_generator = await litellm.acompletion(**litellm_request)
+            async def open_stream():
+                # Retried and failed over until the stream starts
+                response_generator, _ = await call_upstream(request, litellm_request, priority)
+                if cache_key is not None:
+                    async def store_record(record):
+                        await response_cache.put(cache_key, record)
+                    response_generator = record_stream(response_generator, store_record)
+                # Passthrough bytes and the OpenAI adapter's events aren't coalesced
+                if STREAM_COALESCE_MS > 0 and not (passthrough or native):
+                    response_generator = coalesce_text_chunks(response_generator)
+                return response_generator
+
+            if flight_key is not None:
+                # Identical concurrent streams share one upstream stream
+                response_generator = await single_flight.stream(flight_key, open_stream)
+            else:
+                response_generator = await open_stream()
             
-            return StreamingResponse(
-                handle_streaming(response_generator, request),
-                media_type="text/event-stream"
+            observe_request("messages", labels, 200, started)
+            timer = StreamTimer(labels, started)
+            stream_span = None
+            if tracing.enabled:
+                stream_span = StreamSpan(request_span)
+                response_generator = stream_span.upstream(response_generator)
+            if anthropic_passthrough.enabled or openai_stream_adapter.enabled:
+                # Relayed, or converted from OpenAI events without LiteLLM. A failover or
+                # hedge can reach either adapter from any model, so the chunks decide.
+                sse_generator = timer.client(stream_to_sse(timer.upstream(response_generator), request, timer, stream_span))
+            else:
+                sse_generator = timer.client(handle_streaming(timer.upstream(response_generator), request))
+            if tracing.enabled:
+                # The request span ends with the stream
+                sse_generator = stream_span.client(sse_generator)
+                streaming = True
+            return ClientStreamingResponse(
+                sse_generator,
+                on_cancel=timer.cancelled,
+                labels=labels,
+                media_type="text/event-stream",
+                headers={"X-Cache": "MISS"} if cache_key is not None else None
             )
         else:
             # Use LiteLLM for regular completion
@@ -1290,13 +5000,52 @@ async def create_message(
                 200  # Assuming success at this point
             )
             start_time = time.time()
-            litellm_response = litellm.completion(**litellm_request)
-            logger.debug(f"✅ RESPONSE RECEIVED: Model={litellm_request.get('model')}, Time={time.time() - start_time:.2f}s")
+            upstream_started = time.perf_counter()
+            async def complete():
+                # Retried and failed over per the retry policy and fallback chains
+                litellm_response, served_model = await call_upstream(request, litellm_request, priority)
+                # A passthrough response, from a failover or hedge, has no record to cache
+                if cache_key is not None and not isinstance(litellm_response, bytes):
+                    await response_cache.put(cache_key, completion_record_from_response(litellm_response))
+                return litellm_response, served_model
+
+            if flight_key is not None:
+                # Identical concurrent requests share one upstream call
+                litellm_response, served_model = await single_flight.do(flight_key, complete)
+            else:
+                litellm_response, served_model = await complete()
+            logger.debug("✅ RESPONSE RECEIVED: Model=%s, Time=%.2fs", served_model, time.time() - start_time)
+            if isinstance(litellm_response, bytes):
+                # A passthrough response is already the Anthropic API's JSON
+                usage = anthropic_passthrough.response_usage(litellm_response)
+                observe_completion(labels, started, upstream_started, usage.get("output_tokens", 0))
+                observe_passthrough_usage(labels, usage)
+                request_span.set_attributes(usage_attributes(usage.get("input_tokens"), usage.get("output_tokens")))
+                observe_request("messages", labels, 200, started)
+                return Response(content=litellm_response, media_type="application/json")
+            usage = get_field(litellm_response, "usage")
+            observe_completion(labels, started, upstream_started, get_field(usage, "completion_tokens", 0) if usage is not None else 0)
+            if cache_key is not None:
+                response.headers["X-Cache"] = "MISS"
             
-            # Convert LiteLLM response to Anthropic format
-            anthropic_response = convert_litellm_to_anthropic(litellm_response, request)
+            # Convert LiteLLM response to Anthropic format, as the model that served it
+            if served_model != request.model:
+                request = request.model_copy(update={"model": served_model})
+            translation_started = time.perf_counter()
+            with tracing.span("translate_response"):
+                anthropic_response = convert_litellm_to_anthropic(litellm_response, request)
+            translation_duration.observe(("response",) + labels, time.perf_counter() - translation_started)
+            request_span.set_attributes(usage_attributes(anthropic_response.usage.input_tokens, anthropic_response.usage.output_tokens))
             
+            observe_request("messages", labels, 200, started)
             return anthropic_response
+    
+    except (AdmissionRejected, CircuitOpenError) as e:
+        # Over the provider's limits or its breaker is open - ask the client to back off
+        logger.warning("Request for %s not sent upstream: %s", request.model, e)
+        observe_request("messages", labels, e.http_status, started)
+        tracing.fail(request_span, e, e.http_status)
+        raise HTTPException(status_code=e.http_status, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
                 
     except Exception as e:
         import traceback
@@ -1321,7 +5070,7 @@ async def create_message(
                     error_details[key] = str(value)
         
         # Log all error details
-        logger.error(f"Error processing request: {json.dumps(error_details, indent=2)}")
+        logger.error("Error processing request: %s", LazyJSON(error_details))
         
         # Format error for response
         error_message = f"Error: {str(e)}"
@@ -1332,13 +5081,23 @@ async def create_message(
         
         # Return detailed error
         status_code = error_details.get('status_code', 500)
+        observe_request("messages", labels, status_code, started)
+        tracing.fail(request_span, e, status_code)
         raise HTTPException(status_code=status_code, detail=error_message)
+    finally:
+        tracing.deactivate(trace_token)
+        if not streaming:
+            request_span.end()
 
 @app.post("/v1/messages/count_tokens")
 async def count_tokens(
     request: TokenCountRequest,
     raw_request: Request
 ):
+    started = time.perf_counter()
+    labels = request_labels(request)
+    request_span = tracing.start_request_span("POST /v1/messages/count_tokens", raw_request, request_attributes(request))
+    trace_token = tracing.activate(request_span)
     try:
         # Log the incoming token count request
         original_model = request.original_model or request.model
@@ -1355,56 +5114,52 @@ async def count_tokens(
         elif clean_model.startswith("openai/"):
             clean_model = clean_model[len("openai/"):]
         
-        # Convert the messages to a format LiteLLM can understand
-        converted_request = convert_anthropic_to_litellm(
-            MessagesRequest(
-                model=request.model,
-                max_tokens=100,  # Arbitrary value not used for token counting
-                messages=request.messages,
-                system=request.system,
-                tools=request.tools,
-                tool_choice=request.tool_choice,
-                thinking=request.thinking
-            )
+        # Log the request beautifully
+        num_tools = len(request.tools) if request.tools else 0
+        num_messages = len(request.messages) + (1 if convert_system_to_litellm(request.system) else 0)
+        
+        log_request_beautifully(
+            "POST",
+            raw_request.url.path,
+            display_model,
+            request.model,
+            num_messages,
+            num_tools,
+            200  # Assuming success at this point
         )
         
-        # Use LiteLLM's token_counter function
-        try:
-            # Import token_counter function
-            from litellm import token_counter
-            
-            # Log the request beautifully
-            num_tools = len(request.tools) if request.tools else 0
-            
-            log_request_beautifully(
-                "POST",
-                raw_request.url.path,
-                display_model,
-                converted_request.get('model'),
-                len(converted_request['messages']),
-                num_tools,
-                200  # Assuming success at this point
-            )
-            
-            # Count tokens
-            token_count = token_counter(
-                model=converted_request["model"],
-                messages=converted_request["messages"],
-            )
-            
-            # Return Anthropic-style response
-            return TokenCountResponse(input_tokens=token_count)
-            
-        except ImportError:
-            logger.error("Could not import token_counter from litellm")
-            # Fallback to a simple approximation
-            return TokenCountResponse(input_tokens=1000)  # Default fallback
+        # Count with the cached counting engine, so only new messages are tokenized
+        if "count_tokens" in SINGLE_FLIGHT_ROUTES:
+            # Identical concurrent counts share one count, off the event loop
+            flight_key = ("count_tokens", request.model, hashlib.sha256(await raw_request.body()).digest())
+            token_count = await single_flight.do(flight_key, lambda: prompt_token_counter.count_in_thread(request))
+        else:
+            token_count = prompt_token_counter.count(request)
+        
+        # Return Anthropic-style response
+        observe_request("count_tokens", labels, 200, started)
+        request_span.set_attributes(usage_attributes(token_count, None))
+        return TokenCountResponse(input_tokens=token_count)
             
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        logger.error(f"Error counting tokens: {str(e)}\n{error_traceback}")
+        logger.error("Error counting tokens: %s", e, exc_info=True)
+        observe_request("count_tokens", labels, 500, started)
+        tracing.fail(request_span, e, 500)
         raise HTTPException(status_code=500, detail=f"Error counting tokens: {str(e)}")
+    finally:
+        tracing.deactivate(trace_token)
+        request_span.end()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Metrics in the Prometheus text exposition format, summed over the workers when they share a store."""
+    content = await metrics.render_workers(shared_store) if shared_store.shared else metrics.render()
+    return Response(content=content, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/admin/circuit-breakers")
+async def circuit_breaker_states():
+    """Circuit breaker state for each upstream model that has been called."""
+    return {"enabled": circuit_breakers.enabled, "breakers": circuit_breakers.stats()}
 
 @app.get("/")
 async def root():
@@ -1423,43 +5178,41 @@ class Colors:
     UNDERLINE = "\033[4m"
     DIM = "\033[2m"
 def log_request_beautifully(method, path, claude_model, openai_model, num_messages, num_tools, status_code):
-    """Log requests in a beautiful, twitter-friendly format showing Claude to OpenAI mapping."""
-    # Format the Claude model name nicely
-    claude_display = f"{Colors.CYAN}{claude_model}{Colors.RESET}"
-    
-    # Extract endpoint name
-    endpoint = path
-    if "?" in endpoint:
-        endpoint = endpoint.split("?")[0]
-    
-    # Extract just the OpenAI model name without provider prefix
-    openai_display = openai_model
-    if "/" in openai_display:
-        openai_display = openai_display.split("/")[-1]
-    openai_display = f"{Colors.GREEN}{openai_display}{Colors.RESET}"
-    
-    # Format tools and messages
-    tools_str = f"{Colors.MAGENTA}{num_tools} tools{Colors.RESET}"
-    messages_str = f"{Colors.BLUE}{num_messages} messages{Colors.RESET}"
-    
-    # Format status code
-    status_str = f"{Colors.GREEN}✓ {status_code} OK{Colors.RESET}" if status_code == 200 else f"{Colors.RED}✗ {status_code}{Colors.RESET}"
-    
+    """Log requests in a beautiful, twitter-friendly format showing Claude to OpenAI mapping.
 
-    # Put it all together in a clear, beautiful format
-    log_line = f"{Colors.BOLD}{method} {endpoint}{Colors.RESET} {status_str}"
-    model_line = f"{claude_display} → {openai_display} {tools_str} {messages_str}"
-    
-    # Print to console
-    print(log_line)
-    print(model_line)
-    sys.stdout.flush()
+    Only the fields are logged here; RequestLineFormatter lays them out on the
+    log writer's thread.
+    """
+    if not request_logger.isEnabledFor(logging.INFO):
+        return
+    request_logger.info("%s %s %s", method, path, status_code, extra={
+        "method": method,
+        "path": path,
+        "original_model": claude_model,
+        "mapped_model": openai_model,
+        "messages": num_messages,
+        "tools": num_tools,
+        "status_code": status_code,
+    })
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) > 1 and sys.argv[1] == "--help":
-        print("Run with: uvicorn server:app --reload --host 0.0.0.0 --port 8082")
-        sys.exit(0)
-    
+    import argparse
+    parser = argparse.ArgumentParser(description="Anthropic API proxy for OpenAI and Gemini models, via LiteLLM.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="worker processes, 0 for one per CPU (default: WORKERS, or 1)")
+    args = parser.parse_args()
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+
     # Configure uvicorn to run with minimal logs
-    uvicorn.run(app, host="0.0.0.0", port=8082, log_level="error")
\ No newline at end of file
+    if workers == 1:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="error")
+    else:
+        if not shared_store.shared:
+            logger.warning("SHARED_STORE is memory, so each of the %d workers has its own rate limits, "
+                           "response cache and metrics", workers)
+        # uvicorn's supervisor binds the socket once, starts the workers - which
+        # import the app by name - and restarts any that die
+        uvicorn.run("server:app", host=args.host, port=args.port, log_level="error", workers=workers,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
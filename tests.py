@@ -11,6 +11,7 @@ Usage:
   python tests.py --no-streaming     # Skip streaming tests
   python tests.py --simple           # Run only simple tests
   python tests.py --tools            # Run tool-related tests only
+  python tests.py --offline          # Run offline tests (no API keys or network)
 """
 
 import os
@@ -629,6 +630,1990 @@ async def test_streaming(test_name, request_data):
         traceback.print_exc()
         return False
 
+# ================= OFFLINE TESTS =================
+#
+# These tests import the proxy directly and swap LiteLLM for a fake backend,
+# so they need neither network access nor API keys.
+
+from types import SimpleNamespace
+
+def make_fake_chunk(content=None, tool_calls=None, finish_reason=None, usage=None):
+    """Build an object shaped like a LiteLLM streaming chunk."""
+    delta = SimpleNamespace(content=content, tool_calls=tool_calls)
+    choice = SimpleNamespace(delta=delta, finish_reason=finish_reason)
+    return SimpleNamespace(choices=[choice], usage=usage)
+
+def make_fake_tool_call(index, tool_id=None, name=None, arguments=""):
+    """Build an object shaped like a LiteLLM streaming tool call delta."""
+    return SimpleNamespace(index=index, id=tool_id, function=SimpleNamespace(name=name, arguments=arguments))
+
+def make_fake_response(text, prompt_tokens=10, completion_tokens=5):
+    """Build a dict shaped like a non-streaming LiteLLM response."""
+    return {
+        "id": "chatcmpl-fake",
+        "choices": [{"message": {"content": text, "tool_calls": None}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+    }
+
+class FakeBackend:
+    """Stand-in for litellm.acompletion with configurable latency."""
+
+    def __init__(self, completion_delay=1.0, chunk_delay=0.05, chunks=None):
+        self.completion_delay = completion_delay
+        self.chunk_delay = chunk_delay
+        self.chunks = chunks or ["Hello", ", ", "world", "!"]
+        self.calls = []
+
+    async def acompletion(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("stream"):
+            return self._stream()
+        await asyncio.sleep(self.completion_delay)
+        return make_fake_response("".join(self.chunks))
+
+    def completion(self, **kwargs):
+        # Blocking variant, so a regression to litellm.completion shows up as stalled streams
+        self.calls.append(kwargs)
+        time.sleep(self.completion_delay)
+        return make_fake_response("".join(self.chunks))
+
+    async def _stream(self):
+        for i in range(20):
+            await asyncio.sleep(self.chunk_delay)
+            yield make_fake_chunk(content=self.chunks[i % len(self.chunks)])
+        yield make_fake_chunk(finish_reason="stop")
+
+class LocalProxy:
+    """Run the proxy app with uvicorn on a random local port inside the current event loop."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.server = None
+        self.task = None
+        self.url = None
+
+    async def __aenter__(self):
+        import server as proxy
+        import uvicorn
+        self._original = (proxy.litellm.acompletion, proxy.litellm.completion)
+        proxy.litellm.acompletion = self.backend.acompletion
+        proxy.litellm.completion = self.backend.completion
+        config = uvicorn.Config(proxy.app, host="127.0.0.1", port=0, log_level="error")
+        self.server = uvicorn.Server(config)
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        import server as proxy
+        self.server.should_exit = True
+        await self.task
+        proxy.litellm.acompletion, proxy.litellm.completion = self._original
+
+def parse_sse_events(raw_text):
+    """Split an SSE body into a list of decoded JSON event payloads."""
+    events = []
+    for event_text in raw_text.split("\n\n"):
+        for line in event_text.split("\n"):
+            if line.startswith("data: ") and line != "data: [DONE]":
+                events.append(json.loads(line[len("data: "):]))
+    return events
+
+async def fake_chunk_stream(chunks, delays=None):
+    """Yield chunks like a LiteLLM stream, optionally sleeping before each one."""
+    for i, chunk in enumerate(chunks):
+        if delays:
+            await asyncio.sleep(delays[i])
+        yield chunk
+
+async def collect_stream(chunks, request_data=None):
+    """Run handle_streaming over a list of chunks (or an async generator) and return the frames it yields."""
+    import server as proxy
+    generator = fake_chunk_stream(chunks) if isinstance(chunks, list) else chunks
+    request = proxy.MessagesRequest.model_validate(request_data or TEST_SCENARIOS["simple_stream"])
+    return [frame async for frame in proxy.handle_streaming(generator, request)]
+
+def collapse_text_deltas(events):
+    """Merge consecutive text_delta events so streams with different chunking can be compared."""
+    collapsed = []
+    for event in events:
+        if (event["type"] == "content_block_delta" and event["delta"]["type"] == "text_delta"
+                and collapsed and collapsed[-1]["type"] == "content_block_delta"
+                and collapsed[-1]["delta"]["type"] == "text_delta"
+                and collapsed[-1]["index"] == event["index"]):
+            collapsed[-1] = {**collapsed[-1], "delta": {"type": "text_delta", "text": collapsed[-1]["delta"]["text"] + event["delta"]["text"]}}
+        else:
+            collapsed.append(event)
+    return collapsed
+
+async def test_offline_nonstreaming_does_not_block_streams():
+    """A slow non-streaming request must not stall concurrent SSE streams."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: nonstreaming_does_not_block_streams {'='*20}")
+    backend = FakeBackend(completion_delay=1.0, chunk_delay=0.05)
+    try:
+        async with LocalProxy(backend) as proxy:
+            async with httpx.AsyncClient(base_url=proxy.url, timeout=30) as client:
+                slow_data = {**TEST_SCENARIOS["simple"], "stream": False}
+                stream_data = {**TEST_SCENARIOS["simple_stream"]}
+
+                async def read_stream():
+                    gaps = []
+                    last = time.monotonic()
+                    async with client.stream("POST", "/v1/messages", json=stream_data) as response:
+                        async for _ in response.aiter_bytes():
+                            now = time.monotonic()
+                            gaps.append(now - last)
+                            last = now
+                    return gaps
+
+                stream_tasks = [asyncio.create_task(read_stream()) for _ in range(3)]
+                await asyncio.sleep(0.2)  # Let the streams start flowing first
+                slow_response = await client.post("/v1/messages", json=slow_data)
+                stream_gaps = await asyncio.gather(*stream_tasks)
+
+        assert slow_response.status_code == 200, f"Slow request failed: {slow_response.text}"
+        max_gap = max(max(gaps[1:] or [0]) for gaps in stream_gaps)
+        print(f"Largest gap between stream chunks: {max_gap:.3f}s")
+        assert max_gap < 0.5, f"Streams stalled for {max_gap:.2f}s while a non-stream request was pending"
+        print("\n✅ Test nonstreaming_does_not_block_streams passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test nonstreaming_does_not_block_streams: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_request_parsing():
+    """The original model name survives mapping, and bad JSON is still rejected."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: request_parsing {'='*20}")
+    backend = FakeBackend(completion_delay=0)
+    try:
+        import server as proxy
+        request = proxy.MessagesRequest.model_validate(TEST_SCENARIOS["simple"])
+        assert request.original_model == MODEL, f"original_model is {request.original_model!r}"
+        assert request.model != MODEL, "Model was not mapped"
+
+        async with LocalProxy(backend) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                assert response.status_code == 200, f"Request failed: {response.text}"
+                assert backend.calls[-1]["model"] == request.model
+
+                response = await client.post(
+                    "/v1/messages", content=b'{"model": ', headers={"content-type": "application/json"}
+                )
+                assert response.status_code == 422, f"Malformed JSON returned {response.status_code}"
+        print("\n✅ Test request_parsing passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test request_parsing: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_sse_encoding():
+    """Pre-encoded SSE frames match json.dumps output and stream as bytes."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: sse_encoding {'='*20}")
+    try:
+        import server as proxy
+        samples = ["", "plain", 'quote " and \\ backslash', "line\nbreak\ttab", "héllo ☃ 😀", "\u0000\u001f"]
+        for text in samples:
+            expected = f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}})}\n\n"
+            assert proxy.sse_text_delta(0, text) == expected.encode(), f"text_delta mismatch for {text!r}"
+            expected = f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 3, 'delta': {'type': 'input_json_delta', 'partial_json': text}})}\n\n"
+            assert proxy.sse_input_json_delta(3, text) == expected.encode(), f"input_json_delta mismatch for {text!r}"
+        assert proxy.sse_content_block_stop(2) == f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 2})}\n\n".encode()
+        assert proxy.SSE_PING == f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n".encode()
+
+        frames = await collect_stream([
+            make_fake_chunk(content="Let me "),
+            make_fake_chunk(content="check ☃"),
+            make_fake_chunk(tool_calls=[make_fake_tool_call(0, "call_1", "calculator", '{"expression"')]),
+            make_fake_chunk(tool_calls=[make_fake_tool_call(0, arguments=': "2+2"}')]),
+            make_fake_chunk(finish_reason="tool_calls"),
+        ])
+        assert all(isinstance(frame, bytes) for frame in frames), "Frames must be bytes"
+        events = parse_sse_events(b"".join(frames).decode("utf-8"))
+        assert [e["type"] for e in events] == [
+            "message_start", "content_block_start", "ping",
+            "content_block_delta", "content_block_delta", "content_block_stop",
+            "content_block_start", "content_block_delta", "content_block_delta", "content_block_stop",
+            "message_delta", "message_stop",
+        ], [e["type"] for e in events]
+        assert "".join(e["delta"].get("text", "") for e in events if e["type"] == "content_block_delta") == "Let me check ☃"
+        assert "".join(e["delta"].get("partial_json", "") for e in events if e["type"] == "content_block_delta") == '{"expression": "2+2"}'
+        assert events[-2]["delta"]["stop_reason"] == "tool_use"
+        print("\n✅ Test sse_encoding passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test sse_encoding: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_delta_coalescing():
+    """Coalesced streams carry the same text and event order in fewer frames."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: delta_coalescing {'='*20}")
+    try:
+        import server as proxy
+        chunks = [make_fake_chunk(content=c) for c in ["H", "el", "lo", " w", "or", "ld", "é", "☃"]]
+        chunks += [
+            make_fake_chunk(tool_calls=[make_fake_tool_call(0, "call_1", "calculator", '{"expr')]),
+            make_fake_chunk(tool_calls=[make_fake_tool_call(0, arguments='ession": "1"}')]),
+            make_fake_chunk(content="ignored after tool"),
+            make_fake_chunk(finish_reason="tool_calls", usage=SimpleNamespace(prompt_tokens=5, completion_tokens=9)),
+        ]
+        plain = parse_sse_events(b"".join(await collect_stream(chunks)).decode("utf-8"))
+        coalesced_frames = await collect_stream(proxy.coalesce_text_chunks(fake_chunk_stream(chunks), window_ms=1000, max_bytes=1024))
+        coalesced = parse_sse_events(b"".join(coalesced_frames).decode("utf-8"))
+        for events in (plain, coalesced):
+            events[0]["message"]["id"] = "msg"
+        assert collapse_text_deltas(plain) == collapse_text_deltas(coalesced), "Coalescing changed the stream"
+        assert len(coalesced) < len(plain), f"Expected fewer events ({len(coalesced)} vs {len(plain)})"
+
+        # Byte cap splits the buffer
+        capped = parse_sse_events(b"".join(await collect_stream(
+            proxy.coalesce_text_chunks(fake_chunk_stream(chunks), window_ms=1000, max_bytes=4)
+        )).decode("utf-8"))
+        capped[0]["message"]["id"] = "msg"
+        assert collapse_text_deltas(capped) == collapse_text_deltas(plain)
+        assert len(plain) > len(capped) > len(coalesced)
+
+        # The first token goes out immediately, and a stall flushes the buffer after the window
+        timed_chunks = [make_fake_chunk(content=c) for c in ["A", "B", "C", "D"]] + [make_fake_chunk(finish_reason="stop")]
+        delays = [0, 0.001, 0.001, 0.3, 0]
+        start = time.monotonic()
+        arrivals = []
+        async for chunk in proxy.coalesce_text_chunks(fake_chunk_stream(timed_chunks, delays), window_ms=20, max_bytes=1024):
+            arrivals.append((time.monotonic() - start, proxy.get_text_only_delta(chunk)))
+        assert arrivals[0][1] == "A" and arrivals[0][0] < 0.05, f"First token delayed: {arrivals[0]}"
+        assert arrivals[1][1] == "BC" and arrivals[1][0] < 0.2, f"Buffered text not flushed during stall: {arrivals[1]}"
+        assert [text for _, text in arrivals] == ["A", "BC", "D", None]
+
+        # Closing a coalesced stream mid-read waits for the read, then closes upstream
+        closed = []
+        async def stalled_stream():
+            try:
+                for text in ("A", "B", "C"):
+                    yield make_fake_chunk(content=text)
+                await asyncio.sleep(30)
+            finally:
+                closed.append(True)
+        # A client disconnect cancels the task reading the stream
+        stream = proxy.coalesce_text_chunks(stalled_stream(), window_ms=1000, max_bytes=1024)
+        await stream.__anext__()
+        reader = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.05)
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        await stream.aclose()
+        assert closed == [True], "Upstream stream wasn't closed after a cancelled read"
+        # An early aclose() while the buffer's window flush leaves a read in flight
+        closed.clear()
+        stream = proxy.coalesce_text_chunks(stalled_stream(), window_ms=20, max_bytes=1024)
+        assert [proxy.get_text_only_delta(await stream.__anext__()) for _ in range(2)] == ["A", "BC"]
+        await stream.aclose()
+        assert closed == [True], "Upstream stream wasn't closed by aclose()"
+        print("\n✅ Test delta_coalescing passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test delta_coalescing: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_model_routing():
+    """Built-in mappings, routes-file rules, hot reload and caching in ModelRouter."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: model_routing {'='*20}")
+    import tempfile
+    try:
+        import server as proxy
+        router = proxy.ModelRouter()
+        assert router.resolve("claude-3-haiku-20240307") == router.small_target
+        assert router.resolve("anthropic/claude-3-5-Sonnet") == router.big_target
+        assert router.resolve("gpt-4o") == "openai/gpt-4o"
+        assert router.resolve("gemini-2.0-flash") == "gemini/gemini-2.0-flash"
+        assert router.resolve("anthropic/claude-3-opus") == "anthropic/claude-3-opus"
+        router.resolve("gpt-4o")
+        assert router._resolve_cached.cache_info().hits >= 1, "Resolved names are not cached"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            routes_path = os.path.join(tmp, "routes.json")
+            with open(routes_path, "w") as f:
+                json.dump({"routes": [
+                    {"pattern": "claude-3-opus*", "provider": "gemini", "model": "gemini-2.5-pro-preview-03-25"},
+                    {"regex": "^claude-.*-haiku", "model": "openai/gpt-4o-mini"},
+                ]}, f)
+            router = proxy.ModelRouter(routes_path, reload_seconds=0)
+            assert router.resolve("claude-3-opus-20240229") == "gemini/gemini-2.5-pro-preview-03-25"
+            assert router.resolve("CLAUDE-3-5-HAIKU-latest") == "openai/gpt-4o-mini"
+            assert router.resolve("claude-3-sonnet") == router.big_target, "Built-in rules must still apply"
+
+            # Rewrite the file - the next resolve picks the change up without a restart
+            with open(routes_path, "w") as f:
+                json.dump({"routes": [{"pattern": "claude-3-opus*", "model": "openai/o1"}]}, f)
+            os.utime(routes_path, ns=(time.time_ns(), time.time_ns() + 10**9))
+            assert router.resolve("claude-3-opus-20240229") == "openai/o1", "Routes file was not reloaded"
+            assert router.resolve("claude-3-haiku") == router.small_target
+
+            # A broken file keeps the previous rules
+            with open(routes_path, "w") as f:
+                f.write("{not json")
+            os.utime(routes_path, ns=(time.time_ns(), time.time_ns() + 2 * 10**9))
+            assert router.resolve("claude-3-opus-20240229") == "openai/o1"
+        print("\n✅ Test model_routing passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test model_routing: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_tool_cache():
+    """Converted tools are cached by content, returned as fresh copies, and evicted LRU-first."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: tool_cache {'='*20}")
+    try:
+        import server as proxy
+        schema = {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {"url": {"type": "string", "format": "uri", "default": "x"}},
+        }
+        tool = {"name": "fetch", "description": "Fetch a URL", "input_schema": schema}
+        original_schema = json.loads(json.dumps(schema))
+        cache = proxy.LRUCache(2)
+        saved_cache, proxy.tool_cache = proxy.tool_cache, cache
+        try:
+            first = proxy.get_openai_tool(tool, is_gemini_model=True)
+            assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 0
+            assert first["function"]["parameters"] == {"type": "object", "properties": {"url": {"type": "string"}}}
+            assert schema == original_schema, "Cleaning for Gemini modified the request's schema"
+
+            first["function"]["parameters"]["properties"].clear()  # Like LiteLLM rewriting it in place
+            second = proxy.get_openai_tool(tool, is_gemini_model=True)
+            assert cache.hits == 1, "Identical tool definition missed the cache"
+            assert second["function"]["parameters"]["properties"] == {"url": {"type": "string"}}, "Cached tool was shared"
+
+            openai_tool = proxy.get_openai_tool(tool, is_gemini_model=False)
+            assert openai_tool["function"]["parameters"] == original_schema, "OpenAI tools must not be cleaned"
+            assert cache.stats()["misses"] == 1 and len(cache) == 1, "OpenAI tools don't need caching"
+
+            proxy.get_openai_tool({**tool, "description": "v2"}, is_gemini_model=True)
+            proxy.get_openai_tool({**tool, "description": "v3"}, is_gemini_model=True)
+            assert len(cache) == 2 and cache.misses == 3, "Cache exceeded its size"
+            proxy.get_openai_tool(tool, is_gemini_model=True)
+            assert cache.misses == 4, "Least recently used entry was not evicted"
+
+            # Token counting threads share the cache with the event loop
+            from concurrent.futures import ThreadPoolExecutor
+            def churn(worker):
+                for i in range(2000):
+                    proxy.get_openai_tool({**tool, "description": f"{worker}-{i % 5}"}, is_gemini_model=True)
+            with ThreadPoolExecutor(4) as pool:
+                for future in [pool.submit(churn, worker) for worker in range(4)]:
+                    future.result()
+            assert len(cache) == 2
+        finally:
+            proxy.tool_cache = saved_cache
+        print("\n✅ Test tool_cache passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test tool_cache: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+# Golden translation fixture: an edge-case conversation and the messages the
+# proxy has always sent upstream for it. The translators must keep matching this.
+GOLDEN_MESSAGES = [
+    {"role": "user", "content": "plain"},
+    {"role": "user", "content": ""},
+    {"role": "assistant", "content": []},
+    {"role": "assistant", "content": [
+        {"type": "text", "text": "Let me check."},
+        {"type": "tool_use", "id": "toolu_1", "name": "read", "input": {"path": "a.py", "n": [1, 2]}},
+    ]},
+    {"role": "user", "content": [
+        {"type": "text", "text": "Here you go"},
+        {"type": "tool_result", "tool_use_id": "toolu_1", "content": [
+            {"type": "text", "text": "line 1"}, {"text": "no type"}, {"kind": "meta", "n": 1}, "bare string",
+        ]},
+        {"type": "tool_result", "tool_use_id": "toolu_2", "content": "string result"},
+        {"type": "tool_result", "tool_use_id": "toolu_3", "content": {"type": "text", "text": "dict text"}},
+        {"type": "tool_result", "tool_use_id": "toolu_4", "content": {"status": "ok"}},
+        {"type": "tool_result", "tool_use_id": "toolu_5", "content": 42},
+        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "AAAA"}},
+    ]},
+    {"role": "user", "content": [
+        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "AAAA"}},
+        {"type": "text", "text": "What is this?"},
+    ]},
+    {"role": "assistant", "content": [
+        {"type": "tool_result", "tool_use_id": "toolu_6", "content": [{"type": "text", "text": "only"}, {"kind": "meta"}, {"text": "t"}]},
+        {"type": "tool_result", "tool_use_id": "toolu_7", "content": "s"},
+        {"type": "tool_result", "tool_use_id": "toolu_8", "content": {"a": 1}},
+    ]},
+    {"role": "assistant", "content": [
+        {"type": "tool_result", "tool_use_id": "toolu_9", "content": []},
+    ]},
+    {"role": "assistant", "content": [
+        {"type": "text", "text": "  "},
+        {"type": "tool_result", "tool_use_id": "toolu_10", "content": [{"kind": "meta"}, {"text": "t"}]},
+        {"type": "image", "source": {"type": "url", "url": "http://x"}},
+    ]},
+    {"role": "user", "content": [{"type": "text", "text": "  padded  "}]},
+]
+
+GOLDEN_SYSTEM = [{"type": "text", "text": "sys a"}, {"type": "text", "text": "sys b"}]
+
+GOLDEN_TRANSLATIONS = {
+    "openai": [
+        {"role": "system", "content": "sys a\n\nsys b"},
+        {"role": "user", "content": "plain"},
+        {"role": "user", "content": ""},
+        {"role": "assistant", "content": "..."},
+        {"role": "assistant", "content": "Let me check.\n[Tool: read (ID: toolu_1)]\nInput: {\"path\": \"a.py\", \"n\": [1, 2]}"},
+        {"role": "user", "content": "Here you go\nTool result for toolu_1:\nline 1\nno type\n{\"kind\": \"meta\", \"n\": 1}\n\nTool result for toolu_2:\nstring result\nTool result for toolu_3:\ndict text\nTool result for toolu_4:\n{\"status\": \"ok\"}\nTool result for toolu_5:\n42"},
+        {"role": "user", "content": "[Image content - not displayed in text format]\nWhat is this?"},
+        {"role": "assistant", "content": "Tool Result:\nonly\n{\"kind\": \"meta\"}\nt\nTool Result:\ns\nTool Result:\n{'a': 1}"},
+        {"role": "assistant", "content": "Tool Result:"},
+        {"role": "assistant", "content": "[Tool Result ID: toolu_10]\n{\"kind\": \"meta\"}\nt\n[Image content - not displayed in text format]"},
+        {"role": "user", "content": "padded"},
+    ],
+    "litellm": [
+        {"role": "system", "content": "sys a\n\nsys b"},
+        {"role": "user", "content": "plain"},
+        {"role": "user", "content": ""},
+        {"role": "assistant", "content": []},
+        {"role": "assistant", "content": [{"type": "text", "text": "Let me check."}, {"type": "tool_use", "id": "toolu_1", "name": "read", "input": {"path": "a.py", "n": [1, 2]}}]},
+        {"role": "user", "content": "Here you go\nTool result for toolu_1:\nline 1\nno type\n{\"kind\": \"meta\", \"n\": 1}\n\nTool result for toolu_2:\nstring result\nTool result for toolu_3:\ndict text\nTool result for toolu_4:\n{\"status\": \"ok\"}\nTool result for toolu_5:\n42"},
+        {"role": "user", "content": [{"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "AAAA"}}, {"type": "text", "text": "What is this?"}]},
+        {"role": "assistant", "content": [{"type": "tool_result", "tool_use_id": "toolu_6", "content": [{"type": "text", "text": "only"}, {"kind": "meta"}, {"text": "t"}]}, {"type": "tool_result", "tool_use_id": "toolu_7", "content": [{"type": "text", "text": "s"}]}, {"type": "tool_result", "tool_use_id": "toolu_8", "content": [{"type": "text", "text": "{'a': 1}"}]}]},
+        {"role": "assistant", "content": [{"type": "tool_result", "tool_use_id": "toolu_9", "content": []}]},
+        {"role": "assistant", "content": [{"type": "text", "text": "  "}, {"type": "tool_result", "tool_use_id": "toolu_10", "content": [{"kind": "meta"}, {"text": "t"}]}, {"type": "image", "source": {"type": "url", "url": "http://x"}}]},
+        {"role": "user", "content": [{"type": "text", "text": "  padded  "}]},
+    ],
+}
+
+def make_session_messages(num_turns):
+    """Build an agentic tool-use conversation with num_turns tool round trips."""
+    messages = [{"role": "user", "content": "Read the config files and summarize them."}]
+    for i in range(num_turns):
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"Reading file {i}."},
+            {"type": "tool_use", "id": f"toolu_{i}", "name": "read_file", "input": {"path": f"config_{i}.json"}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{i}", "content": [{"type": "text", "text": f"setting_{i} = {i}"}, {"kind": "meta"}]},
+        ]})
+    return messages
+
+async def test_offline_conversation_cache():
+    """Cached incremental translation matches a fresh translation exactly."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: conversation_cache {'='*20}")
+    try:
+        import server as proxy
+        session = make_session_messages(6)
+        saved_cache = proxy.conversation_cache
+        try:
+            for model in ("openai/gpt-4.1", "gemini/gemini-2.0-flash"):
+                flatten = "openai" in model
+                proxy.conversation_cache = proxy.ConversationCache(16, 10 * 1024 * 1024)
+                for turn in range(1, len(session) + 1, 2):
+                    request = proxy.MessagesRequest.model_validate({"model": model, "max_tokens": 100, "messages": session[:turn]})
+                    proxy.conversation_cache.max_entries = 0
+                    fresh = proxy.convert_anthropic_to_litellm(request, flatten_for_openai=flatten)
+                    proxy.conversation_cache.max_entries = 16
+                    cached = proxy.convert_anthropic_to_litellm(request, flatten_for_openai=flatten)
+                    assert cached == fresh, f"{model} turn {turn}: cached translation differs"
+                stats = proxy.conversation_cache.stats()
+                # Every turn after the first reuses all but the two new messages
+                assert stats["misses"] == len(session), f"{model}: translated {stats['misses']} messages"
+                assert stats["hits"] > 0
+
+            # Each request gets its own copy of the cached messages
+            request = proxy.MessagesRequest.model_validate({"model": "openai/gpt-4.1", "max_tokens": 100, "messages": session})
+            first = proxy.convert_anthropic_to_litellm(request, flatten_for_openai=True)
+            first["messages"][1]["content"] = "modified"
+            second = proxy.convert_anthropic_to_litellm(request, flatten_for_openai=True)
+            assert second["messages"][1]["content"] != "modified", "Cached messages were shared"
+
+            # Editing an earlier message only reuses the prefix before it
+            cache = proxy.conversation_cache = proxy.ConversationCache(16, 10 * 1024 * 1024)
+            translate = proxy.translate_message_for_openai
+            messages = proxy.MessagesRequest.model_validate({"model": "gpt-4.1", "max_tokens": 1, "messages": session}).messages
+            cache.translate(messages, translate, "openai")
+            edited = messages[:3] + [proxy.Message(role="user", content="edited")] + messages[4:]
+            assert cache.translate(edited, translate, "openai")[3]["content"] == "edited"
+            assert cache.hits == 0, "A conversation with an edited message must not reuse the full entry"
+            assert cache.translate(edited[:4], translate, "openai") == [translate(m) for m in edited[:4]]
+            assert cache.hits == 0, "Only full conversations are cached, so a prefix alone can't hit"
+            cache.translate(edited + messages[-2:], translate, "openai")
+            assert cache.hits == len(edited)
+
+            # Entry and byte limits evict the least recently used conversations
+            cache = proxy.ConversationCache(2, 10 * 1024 * 1024)
+            for n in (1, 3, 5):
+                cache.translate(messages[:n], translate, "openai")
+            assert len(cache.entries) == 2
+            one_entry = cache.total_bytes // 2
+            cache = proxy.ConversationCache(10, one_entry)
+            cache.translate(messages[:5], translate, "openai")
+            cache.translate(messages[:7], translate, "openai")
+            assert cache.total_bytes <= one_entry and len(cache.entries) <= 1, cache.stats()
+        finally:
+            proxy.conversation_cache = saved_cache
+        print("\n✅ Test conversation_cache passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test conversation_cache: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_golden_translation():
+    """Translated messages match the golden output for every target."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: golden_translation {'='*20}")
+    try:
+        import server as proxy
+        saved_cache = proxy.conversation_cache
+        proxy.conversation_cache = proxy.ConversationCache(0, 0)
+        try:
+            request = proxy.MessagesRequest.model_validate({
+                "model": "openai/gpt-4.1", "max_tokens": 100, "messages": GOLDEN_MESSAGES, "system": GOLDEN_SYSTEM,
+            })
+            for flavor, expected in GOLDEN_TRANSLATIONS.items():
+                messages = proxy.convert_anthropic_to_litellm(request, flatten_for_openai=flavor == "openai")["messages"]
+                for i, (actual, golden) in enumerate(zip(messages, expected)):
+                    assert actual == golden, f"{flavor} message {i}:\n{actual!r}\n!=\n{golden!r}"
+                assert len(messages) == len(expected), f"{flavor}: {len(messages)} messages, expected {len(expected)}"
+        finally:
+            proxy.conversation_cache = saved_cache
+        print("\n✅ Test golden_translation passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test golden_translation: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_native_tool_calls():
+    """Native mode maps tool blocks to OpenAI tool calls and back."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: native_tool_calls {'='*20}")
+    try:
+        import server as proxy
+        saved_cache = proxy.conversation_cache
+        proxy.conversation_cache = proxy.ConversationCache(0, 0)
+        try:
+            request = proxy.MessagesRequest.model_validate({
+                "model": "openai/gpt-4.1", "max_tokens": 100, "messages": GOLDEN_MESSAGES[:6],
+            })
+            messages = proxy.convert_anthropic_to_litellm(request, True, tool_message_format="native")["messages"]
+            expected = [
+                {"role": "user", "content": "plain"},
+                {"role": "user", "content": ""},
+                {"role": "assistant", "content": "..."},
+                {"role": "assistant", "content": "Let me check.", "tool_calls": [{
+                    "id": "toolu_1", "type": "function",
+                    "function": {"name": "read", "arguments": '{"path": "a.py", "n": [1, 2]}'},
+                }]},
+                {"role": "tool", "tool_call_id": "toolu_1", "content": 'line 1\nno type\n{"kind": "meta", "n": 1}'},
+                {"role": "tool", "tool_call_id": "toolu_2", "content": "string result"},
+                {"role": "tool", "tool_call_id": "toolu_3", "content": "dict text"},
+                {"role": "tool", "tool_call_id": "toolu_4", "content": '{"status": "ok"}'},
+                {"role": "tool", "tool_call_id": "toolu_5", "content": "42"},
+                {"role": "user", "content": [
+                    {"type": "text", "text": "Here you go"},
+                    {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+                ]},
+                {"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+                    {"type": "text", "text": "What is this?"},
+                ]},
+            ]
+            for i, (actual, wanted) in enumerate(zip(messages, expected)):
+                assert actual == wanted, f"message {i}:\n{actual!r}\n!=\n{wanted!r}"
+            assert len(messages) == len(expected), f"{len(messages)} messages, expected {len(expected)}"
+
+            # The text mode is still selectable per call
+            text_messages = proxy.convert_anthropic_to_litellm(request, True, tool_message_format="text")["messages"]
+            assert text_messages == GOLDEN_TRANSLATIONS["openai"][1:7], "text mode output changed"
+        finally:
+            proxy.conversation_cache = saved_cache
+
+        # Tool calls in responses come back as tool_use blocks, so their ids round-trip
+        response = make_fake_response(None)
+        response["choices"][0]["message"]["tool_calls"] = [
+            {"id": "call_1", "function": {"name": "read", "arguments": '{"path": "b.py"}'}},
+        ]
+        response["choices"][0]["finish_reason"] = "tool_calls"
+        native = proxy.convert_litellm_to_anthropic(response, request, tool_message_format="native")
+        assert [block.type for block in native.content] == ["tool_use"], native.content
+        assert native.content[0].id == "call_1" and native.content[0].input == {"path": "b.py"}
+        assert native.stop_reason == "tool_use"
+        text = proxy.convert_litellm_to_anthropic(response, request, tool_message_format="text")
+        assert [block.type for block in text.content] == ["text"], text.content
+
+        print("\n✅ Test native_tool_calls passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test native_tool_calls: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_upstream_clients():
+    """Pooled upstream clients are created at startup, passed to LiteLLM, and closed at shutdown."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: upstream_clients {'='*20}")
+    backend = FakeBackend(completion_delay=0)
+    try:
+        import server as proxy
+        saved = (proxy.upstream_clients, proxy.OPENAI_API_KEY)
+        proxy.upstream_clients = proxy.UpstreamClients(max_connections=10, keepalive_expiry=30)
+        proxy.OPENAI_API_KEY = "sk-offline"
+        try:
+            async with LocalProxy(backend) as local:
+                http_clients = dict(proxy.upstream_clients.http_clients)
+                assert sorted(http_clients) == ["anthropic", "gemini", "openai"], f"Clients: {sorted(http_clients)}"
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    for model in ("openai/gpt-4.1", "gemini/gemini-2.0-flash"):
+                        response = await client.post("/v1/messages", json={**TEST_SCENARIOS["simple"], "model": model})
+                        assert response.status_code == 200, f"Request failed: {response.text}"
+                        pooled = proxy.upstream_clients.get(backend.calls[-1]["model"])
+                        assert pooled is not None and backend.calls[-1]["client"] is pooled, f"No pooled client for {model}"
+            assert not proxy.upstream_clients.http_clients, "Clients not released at shutdown"
+            assert all(c.is_closed for c in http_clients.values()), "Clients not closed at shutdown"
+
+            # Disabled, LiteLLM keeps managing its own clients
+            proxy.upstream_clients = proxy.UpstreamClients(enabled=False)
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                    assert response.status_code == 200, f"Request failed: {response.text}"
+                    assert "client" not in backend.calls[-1], "Client passed while the pool is disabled"
+        finally:
+            proxy.upstream_clients, proxy.OPENAI_API_KEY = saved
+        print("\n✅ Test upstream_clients passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test upstream_clients: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_token_counting():
+    """The count_tokens engine matches litellm.token_counter, cached or not."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: token_counting {'='*20}")
+    backend = FakeBackend(completion_delay=0)
+    try:
+        import server as proxy
+        from litellm import token_counter
+        tools = [
+            {"name": "read", "description": "Read a file", "input_schema": {
+                "type": "object", "properties": {"path": {"type": "string", "format": "uri"}}, "required": ["path"]}},
+            {"name": "calc", "input_schema": {"type": "object", "properties": {"expression": {"type": "string"}}}},
+        ]
+        # LiteLLM can't count the untyped blocks in the later golden messages
+        golden_messages = GOLDEN_MESSAGES[:6]
+        variants = [
+            {"messages": golden_messages},
+            {"messages": golden_messages, "system": GOLDEN_SYSTEM, "tools": tools},
+            {"messages": golden_messages[:5], "system": "Be brief.", "tools": tools, "tool_choice": {"type": "tool", "name": "calc"}},
+            {"messages": make_session_messages(6), "tools": tools, "tool_choice": {"type": "auto"}},
+        ]
+        engine = proxy.TokenCounter(1024)
+        for model in ("openai/gpt-4.1", "gemini/gemini-2.0-flash", "anthropic/claude-3-haiku-20240307"):
+            for variant in variants:
+                data = {"model": model, **variant}
+                converted = proxy.convert_anthropic_to_litellm(proxy.MessagesRequest.model_validate({**data, "max_tokens": 100}))
+                expected = token_counter(
+                    model=converted["model"], messages=converted["messages"],
+                    tools=converted.get("tools"), tool_choice=converted.get("tool_choice"),
+                )
+                for attempt in ("cold", "cached"):
+                    actual = engine.count(proxy.TokenCountRequest.model_validate(data))
+                    assert actual == expected, f"{model} {attempt}: counted {actual}, expected {expected} for {sorted(variant)}"
+        assert engine.message_counts.hits > 0, "Message counts were never reused"
+
+        # A growing session only tokenizes the new messages
+        engine = proxy.TokenCounter(1024)
+        session = make_session_messages(10)
+        for n in range(1, len(session) + 1, 2):
+            engine.count(proxy.TokenCountRequest.model_validate({"model": "openai/gpt-4.1", "messages": session[:n]}))
+        assert engine.message_counts.misses == len(session), f"Tokenized {engine.message_counts.misses} messages for {len(session)}"
+
+        async with LocalProxy(backend) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                data = {"model": MODEL, "messages": golden_messages, "system": GOLDEN_SYSTEM, "tools": tools}
+                response = await client.post("/v1/messages/count_tokens", json=data)
+                assert response.status_code == 200, f"Request failed: {response.text}"
+                expected = engine.count(proxy.TokenCountRequest.model_validate(data))
+                assert response.json() == {"input_tokens": expected}, f"Endpoint returned {response.json()}, expected {expected}"
+        print("\n✅ Test token_counting passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test token_counting: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def normalize_stream_events(events):
+    """Drop message ids and merge split text and tool argument deltas, so replayed and live streams compare equal."""
+    normalized = []
+    for event in collapse_text_deltas(events):
+        if event["type"] == "message_start":
+            event = {**event, "message": {**event["message"], "id": "msg"}}
+        if (event["type"] == "content_block_delta" and event["delta"]["type"] == "input_json_delta"
+                and normalized and normalized[-1]["type"] == "content_block_delta"
+                and normalized[-1]["index"] == event["index"]):
+            previous = normalized[-1]["delta"]["partial_json"]
+            event = {**event, "delta": {"type": "input_json_delta", "partial_json": previous + event["delta"]["partial_json"]}}
+            normalized[-1] = event
+            continue
+        normalized.append(event)
+    return normalized
+
+async def test_offline_response_cache():
+    """Deterministic requests are answered from the response cache, streamed or not."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: response_cache {'='*20}")
+    backend = FakeBackend(completion_delay=0, chunk_delay=0)
+    try:
+        import server as proxy
+        import tempfile
+
+        # A recorded stream replays as the same events, tool calls included
+        chunks = [
+            make_fake_chunk(content="Let me "), make_fake_chunk(content="check."),
+            make_fake_chunk(tool_calls=[make_fake_tool_call(0, "toolu_a", "calculator", '{"expr')]),
+            make_fake_chunk(tool_calls=[make_fake_tool_call(0, None, None, 'ession": "2+2"}')]),
+            make_fake_chunk(tool_calls=[make_fake_tool_call(1, "toolu_b", "calculator", '{"expression": "3"}')]),
+            make_fake_chunk(finish_reason="tool_calls", usage=SimpleNamespace(prompt_tokens=12, completion_tokens=7)),
+        ]
+        records = []
+        async def store(record):
+            records.append(record)
+        live = await collect_stream(proxy.record_stream(fake_chunk_stream(chunks), store))
+        assert len(records) == 1, f"Recorded {len(records)} records"
+        assert records[0]["tool_calls"][0] == {"id": "toolu_a", "name": "calculator", "arguments": '{"expression": "2+2"}'}
+        replayed = await collect_stream(proxy.replay_completion_record(records[0]))
+        live_events = normalize_stream_events(parse_sse_events(b"".join(live).decode()))
+        replayed_events = normalize_stream_events(parse_sse_events(b"".join(replayed).decode()))
+        assert replayed_events == live_events, f"Replay differs:\n{replayed_events}\n!=\n{live_events}"
+
+        # Usage sent after the finish chunk, in a chunk of its own, is recorded too
+        trailing = chunks[:-1] + [
+            make_fake_chunk(finish_reason="tool_calls"),
+            SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=12, completion_tokens=7)),
+        ]
+        del records[:]
+        passed = [chunk async for chunk in proxy.record_stream(fake_chunk_stream(trailing), store)]
+        assert len(passed) == len(trailing) and len(records) == 1, f"Recorded {len(records)} records"
+        assert (records[0]["prompt_tokens"], records[0]["completion_tokens"]) == (12, 7), f"Record: {records[0]}"
+        replayed = parse_sse_events(b"".join(await collect_stream(proxy.replay_completion_record(records[0]))).decode())
+        delta = next(e for e in replayed if e["type"] == "message_delta")
+        assert delta["usage"]["output_tokens"] == 7, f"Replayed usage: {delta}"
+        # A stream closed after its finish chunk, before the usage, is still recorded
+        del records[:]
+        await collect_stream(proxy.record_stream(fake_chunk_stream(trailing), store))
+        assert len(records) == 1 and records[0]["text"] == "Let me check.", f"Records: {records}"
+
+        saved_cache = proxy.response_cache
+        proxy.response_cache = proxy.ResponseCache(proxy.MemoryResponseStore(ttl=60, max_entries=10, max_bytes=1 << 20))
+        try:
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    data = {**TEST_SCENARIOS["simple"], "temperature": 0}
+                    first = await client.post("/v1/messages", json=data)
+                    second = await client.post("/v1/messages", json=data)
+                    assert first.headers.get("x-cache") == "MISS", f"First request: {first.headers.get('x-cache')}"
+                    assert second.headers.get("x-cache") == "HIT", f"Second request: {second.headers.get('x-cache')}"
+                    assert len(backend.calls) == 1, f"Upstream called {len(backend.calls)} times"
+                    assert {**first.json(), "id": None} == {**second.json(), "id": None}, "Cached response differs"
+
+                    # Streaming hits are replayed from the same entry
+                    stream = await client.post("/v1/messages", json={**data, "stream": True})
+                    assert stream.headers.get("x-cache") == "HIT", f"Stream: {stream.headers.get('x-cache')}"
+                    events = collapse_text_deltas(parse_sse_events(stream.text))
+                    text = "".join(e["delta"]["text"] for e in events if e["type"] == "content_block_delta")
+                    assert text == first.json()["content"][0]["text"], f"Replayed text {text!r}"
+                    assert len(backend.calls) == 1, "Streaming hit called upstream"
+
+                    # Streaming misses fill the cache for later requests
+                    other = {**data, "messages": [{"role": "user", "content": "Something else"}]}
+                    stream = await client.post("/v1/messages", json={**other, "stream": True})
+                    assert stream.headers.get("x-cache") == "MISS", f"Stream: {stream.headers.get('x-cache')}"
+                    response = await client.post("/v1/messages", json=other)
+                    assert response.headers.get("x-cache") == "HIT", f"After stream: {response.headers.get('x-cache')}"
+                    assert len(backend.calls) == 2, f"Upstream called {len(backend.calls)} times"
+
+                    # Sampled requests bypass the cache
+                    response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                    assert "x-cache" not in response.headers, "Sampled request used the cache"
+                    assert len(backend.calls) == 3
+            stats = proxy.response_cache.stats()
+            assert (stats["hits"], stats["misses"]) == (3, 2), f"Stats: {stats}"
+        finally:
+            proxy.response_cache = saved_cache
+
+        # Both stores expire entries and evict the least recently used
+        with tempfile.TemporaryDirectory() as directory:
+            for make_store in (
+                lambda ttl: proxy.MemoryResponseStore(ttl, max_entries=2, max_bytes=1 << 20),
+                lambda ttl: proxy.DiskResponseStore(directory, ttl, max_entries=2, max_bytes=1 << 20),
+            ):
+                store = make_store(60)
+                store.put("a", b"1"), store.put("b", b"2")
+                assert store.get("a") == b"1"
+                store.put("c", b"3")
+                assert (store.get("a"), store.get("b"), store.get("c")) == (b"1", None, b"3"), "LRU eviction failed"
+                expired = make_store(-1)
+                expired.put("d", b"4")
+                assert expired.get("d") is None, "Expired entry returned"
+                store.clear()
+            store = proxy.DiskResponseStore(directory, 60, max_entries=2, max_bytes=1 << 20)
+            store.put("e", b"5")
+            assert proxy.DiskResponseStore(directory, 60, 2, 1 << 20).get("e") == b"5", "Disk entry lost on reopen"
+
+        print("\n✅ Test response_cache passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test response_cache: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_single_flight():
+    """Concurrent identical requests share one upstream call, and one upstream stream."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: single_flight {'='*20}")
+    backend = FakeBackend(completion_delay=0.2, chunk_delay=0.01)
+    try:
+        import server as proxy
+
+        # Shared calls return one result and raise one error to every caller
+        flight = proxy.SingleFlight()
+        runs = []
+        async def work():
+            runs.append(1)
+            await asyncio.sleep(0.05)
+            return len(runs)
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(5)))
+        assert results == [1] * 5 and len(runs) == 1, f"Results {results}, runs {len(runs)}"
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream failed")
+        results = await asyncio.gather(flight.do("bad", fail), flight.do("bad", fail), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results), f"Errors: {results}"
+        assert flight.stats() == {"in_flight": 0, "started": 2, "joined": 5}, f"Stats: {flight.stats()}"
+
+        # A stream is cancelled upstream once every subscriber has left
+        upstream_closed = asyncio.Event()
+        async def endless():
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield make_fake_chunk(content="x")
+            finally:
+                upstream_closed.set()
+        async def open_endless():
+            return endless()
+        first = await flight.stream("stream", open_endless)
+        second = await flight.stream("stream", open_endless)
+        await first.__anext__(), await second.__anext__()
+        await first.aclose()
+        assert not upstream_closed.is_set(), "Upstream closed while a subscriber remains"
+        await second.aclose()
+        await asyncio.wait_for(upstream_closed.wait(), 1)
+        await asyncio.sleep(0)
+        assert "stream" not in flight.calls, "Abandoned stream still joinable"
+
+        saved_routes = proxy.SINGLE_FLIGHT_ROUTES
+        proxy.SINGLE_FLIGHT_ROUTES = {"messages", "count_tokens"}
+        try:
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    data = TEST_SCENARIOS["simple"]
+                    responses = await asyncio.gather(*(client.post("/v1/messages", json=data) for _ in range(5)))
+                    assert all(r.status_code == 200 for r in responses), [r.text for r in responses]
+                    assert len(backend.calls) == 1, f"Upstream called {len(backend.calls)} times"
+                    assert len({r.json()["content"][0]["text"] for r in responses}) == 1
+
+                    # Every stream gets the whole response, even when it joins late
+                    stream_data = TEST_SCENARIOS["simple_stream"]
+                    async def stream(delay):
+                        await asyncio.sleep(delay)
+                        response = await client.post("/v1/messages", json=stream_data)
+                        events = collapse_text_deltas(parse_sse_events(response.text))
+                        return "".join(e["delta"]["text"] for e in events if e["type"] == "content_block_delta")
+                    texts = await asyncio.gather(*(stream(0.02 * i) for i in range(5)))
+                    expected = "".join(backend.chunks[i % len(backend.chunks)] for i in range(20))
+                    assert texts == [expected] * 5, f"Stream texts: {texts}"
+                    assert len(backend.calls) == 2, f"Upstream called {len(backend.calls)} times"
+
+                    # Different requests still go upstream separately
+                    other = {**data, "messages": [{"role": "user", "content": "Something else"}]}
+                    await asyncio.gather(client.post("/v1/messages", json=data), client.post("/v1/messages", json=other))
+                    assert len(backend.calls) == 4, f"Upstream called {len(backend.calls)} times"
+
+                    count_data = {"model": data["model"], "messages": data["messages"]}
+                    expected_count = proxy.prompt_token_counter.count(proxy.TokenCountRequest.model_validate(count_data))
+                    responses = await asyncio.gather(*(client.post("/v1/messages/count_tokens", json=count_data) for _ in range(5)))
+                    counts = [r.json()["input_tokens"] for r in responses]
+                    assert counts == [expected_count] * 5, f"Counts {counts} != {expected_count}"
+            assert not proxy.single_flight.calls, f"Calls left in flight: {proxy.single_flight.calls}"
+        finally:
+            proxy.SINGLE_FLIGHT_ROUTES = saved_routes
+
+        print("\n✅ Test single_flight passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test single_flight: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_admission_control():
+    """Provider limiters queue requests by priority, enforce rate limits and reject overflow with 429."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: admission_control {'='*20}")
+    backend = FakeBackend(completion_delay=0.2, chunk_delay=0.01)
+    try:
+        import server as proxy
+
+        # Small model requests jump ahead of queued big model requests
+        limiter = proxy.ProviderLimiter("openai", max_concurrency=1, max_queue=2, queue_timeout=5)
+        order = []
+        async def request(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+            await asyncio.sleep(0.02)
+            limiter.release()
+        await limiter.acquire()
+        tasks = [asyncio.create_task(request("big", 1)), asyncio.create_task(request("small", 0))]
+        await asyncio.sleep(0.01)
+        try:
+            await limiter.acquire()
+            assert False, "Acquired with a full queue"
+        except proxy.AdmissionRejected:
+            pass
+        limiter.release()
+        await asyncio.gather(*tasks)
+        assert order == ["small", "big"], f"Admission order: {order}"
+        stats = limiter.stats()
+        assert (stats["active"], stats["queued"], stats["rejected"], stats["max_queue_depth"]) == (0, 0, 1, 2), f"Stats: {stats}"
+
+        # Waiters time out, and cancelled waiters leave the queue
+        limiter = proxy.ProviderLimiter("openai", max_concurrency=1, queue_timeout=0.05)
+        await limiter.acquire()
+        try:
+            await limiter.acquire()
+            assert False, "Queue wait didn't time out"
+        except proxy.AdmissionRejected:
+            pass
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert (limiter.timed_out, len(limiter.queue)) == (1, 0), f"Stats: {limiter.stats()}"
+        limiter.release()
+        assert limiter.active == 0
+
+        # Requests and tokens per minute hold back the next request until the buckets refill
+        limiter = proxy.ProviderLimiter("openai", rpm=1200, tpm=60000)
+        limiter.requests.level = 0
+        start = time.monotonic()
+        await limiter.acquire()
+        assert time.monotonic() - start >= 0.04, "RPM limit not applied"
+        limiter.release()
+        limiter.tokens.level = 0
+        start = time.monotonic()
+        await limiter.acquire(tokens=50)
+        assert time.monotonic() - start >= 0.04, "TPM limit not applied"
+        limiter.release()
+
+        saved_scheduler = proxy.admission_scheduler
+        proxy.admission_scheduler = proxy.AdmissionScheduler({"openai": {"max_concurrency": 1}}, max_queue=1, queue_timeout=5)
+        try:
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    responses = await asyncio.gather(*(client.post("/v1/messages", json=TEST_SCENARIOS["simple"]) for _ in range(3)))
+                    statuses = sorted(r.status_code for r in responses)
+                    assert statuses == [200, 200, 429], f"Statuses: {statuses}"
+                    rejected = next(r for r in responses if r.status_code == 429)
+                    assert int(rejected.headers["retry-after"]) >= 1, "Missing Retry-After"
+
+                    # A stream keeps its slot until it ends
+                    stream = asyncio.create_task(client.post("/v1/messages", json=TEST_SCENARIOS["simple_stream"]))
+                    await asyncio.sleep(0.05)
+                    start = time.monotonic()
+                    response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                    assert response.status_code == 200 and (await stream).status_code == 200
+                    assert time.monotonic() - start >= 0.3, "Request was admitted while the stream was open"
+            stats = proxy.admission_scheduler.stats()["openai"]
+            assert (stats["active"], stats["admitted"], stats["rejected"]) == (0, 4, 1), f"Stats: {stats}"
+        finally:
+            proxy.admission_scheduler = saved_scheduler
+
+        print("\n✅ Test admission_control passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test admission_control: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+class FlakyBackend(FakeBackend):
+    """FakeBackend whose calls fail per model: failures maps a model to a list of errors for its next calls.
+
+    An error of "midstream" makes a stream fail after its first chunk, and
+    "slow" makes the call take a second longer.
+    """
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    async def acompletion(self, **kwargs):
+        pending = self.failures.get(kwargs["model"])
+        error = pending.pop(0) if pending else None
+        if error is None:
+            return await super().acompletion(**kwargs)
+        self.calls.append(kwargs)
+        if error == "slow":
+            await asyncio.sleep(1)
+            return self._stream() if kwargs.get("stream") else make_fake_response("".join(self.chunks))
+        if error == "midstream":
+            async def broken_stream():
+                yield make_fake_chunk(content="Hello")
+                raise ConnectionError("upstream went away")
+            return broken_stream()
+        if kwargs.get("stream") and getattr(error, "status_code", None) == 503:
+            # The stream opens, then fails before its first chunk
+            async def failed_stream():
+                raise error
+                yield
+            return failed_stream()
+        raise error
+
+def make_upstream_error(error_class, status_code, headers=None):
+    import litellm
+    response = httpx.Response(status_code, headers=headers or {}, request=httpx.Request("POST", "http://upstream"))
+    return error_class(message=f"HTTP {status_code}", llm_provider="openai", model="gpt-4.1", response=response)
+
+async def test_offline_retry_failover():
+    """Failed upstream calls are retried with backoff, then failed over along the fallback chain."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: retry_failover {'='*20}")
+    try:
+        import server as proxy
+        import litellm
+
+        policy = proxy.RetryPolicy(max_retries=2, backoff=0.01, max_backoff=1, status_codes=frozenset({429, 503}))
+        rate_limited = make_upstream_error(litellm.RateLimitError, 429, {"retry-after": "0.05"})
+        assert 0.05 <= policy.retry_delay(rate_limited, 0) <= 1, "Retry-After not honored"
+        assert policy.retry_delay(rate_limited, 2) is None, "Retried past max_retries"
+        assert policy.retry_delay(make_upstream_error(litellm.RateLimitError, 429, {"retry-after": "30"}), 0) is None
+        assert policy.retry_delay(make_upstream_error(litellm.BadRequestError, 400), 0) is None
+        assert policy.can_fail_over(make_upstream_error(litellm.AuthenticationError, 401))
+        chains = proxy.FallbackChains("openai/gpt-4.1 > gemini/gemini-2.0-flash > anthropic/claude-3-haiku, openai/o3>openai/gpt-4.1")
+        assert chains.candidates_for("gemini/gemini-2.0-flash") == ["gemini/gemini-2.0-flash", "anthropic/claude-3-haiku"]
+        assert chains.candidates_for("openai/gpt-4.1")[1:] == ["gemini/gemini-2.0-flash", "anthropic/claude-3-haiku"]
+        assert chains.candidates_for("openai/gpt-4o") == ["openai/gpt-4o"]
+
+        primary, fallback = "openai/gpt-4.1", "gemini/gemini-2.0-flash"
+        saved = (proxy.retry_policy, proxy.fallback_chains)
+        proxy.retry_policy = proxy.RetryPolicy(max_retries=1, backoff=0.01, max_backoff=1, status_codes=frozenset({429, 503}))
+        proxy.fallback_chains = proxy.FallbackChains(f"{primary}>{fallback}")
+        backend = FlakyBackend({}, completion_delay=0, chunk_delay=0)
+        try:
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    async def post(data, failures):
+                        backend.failures = failures
+                        del backend.calls[:]
+                        response = await client.post("/v1/messages", json=data)
+                        return response, [call["model"] for call in backend.calls]
+
+                    # A retry succeeds on the same model
+                    response, models = await post(TEST_SCENARIOS["simple"], {primary: [rate_limited]})
+                    assert response.status_code == 200 and models == [primary, primary], f"{response.status_code} {models}"
+
+                    # Retries exhausted, so the request fails over
+                    unavailable = make_upstream_error(litellm.ServiceUnavailableError, 503)
+                    response, models = await post(TEST_SCENARIOS["simple"], {primary: [unavailable, unavailable]})
+                    assert response.status_code == 200 and models == [primary, primary, fallback], f"{response.status_code} {models}"
+                    assert response.json()["model"] == fallback, f"Served by {response.json()['model']}"
+
+                    # Invalid requests fail everywhere, so they aren't retried
+                    response, models = await post(TEST_SCENARIOS["simple"], {primary: [make_upstream_error(litellm.BadRequestError, 400)]})
+                    assert response.status_code == 400 and models == [primary], f"{response.status_code} {models}"
+
+                    # A stream that fails before its first chunk fails over
+                    stream_data = TEST_SCENARIOS["simple_stream"]
+                    response, models = await post(stream_data, {primary: [unavailable, unavailable]})
+                    events = collapse_text_deltas(parse_sse_events(response.text))
+                    text = "".join(e["delta"]["text"] for e in events if e["type"] == "content_block_delta")
+                    assert models == [primary, primary, fallback], f"Stream models: {models}"
+                    assert text == "".join(backend.chunks[i % len(backend.chunks)] for i in range(20)), f"Stream text: {text!r}"
+
+                    # Once a chunk has been sent, a failing stream ends with an error instead
+                    response, models = await post(stream_data, {primary: ["midstream"]})
+                    events = parse_sse_events(response.text)
+                    assert models == [primary], f"Stream models: {models}"
+                    assert any(e["type"] == "message_delta" and e["delta"]["stop_reason"] == "error" for e in events)
+
+                    # A slow provider counts as failed after the attempt timeout
+                    proxy.retry_policy = proxy.RetryPolicy(max_retries=0, status_codes=frozenset({503}), attempt_timeout=0.1)
+                    start = time.monotonic()
+                    response, models = await post(TEST_SCENARIOS["simple"], {primary: ["slow"]})
+                    assert response.status_code == 200 and models == [primary, fallback], f"{response.status_code} {models}"
+                    assert time.monotonic() - start < 0.5, "Timed out attempt wasn't abandoned"
+            assert proxy.retry_policy.stats()["failovers"] == 1
+        finally:
+            proxy.retry_policy, proxy.fallback_chains = saved
+
+        print("\n✅ Test retry_failover passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test retry_failover: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_native_failover():
+    """A stream that fails over to an openai/ model read by the native adapter keeps its output."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: native_failover {'='*20}")
+    import server as proxy
+    import litellm
+    from loadgen import MockUpstream, MockSettings
+    upstream = MockUpstream(MockSettings(output_tokens=12, chunk_tokens=5, first_token_ms=0))
+    await upstream.start()
+    primary, fallback = "gemini/gemini-2.0-flash", "openai/gpt-4.1"
+    saved = (proxy.retry_policy, proxy.fallback_chains, proxy.openai_stream_adapter)
+    proxy.retry_policy = proxy.RetryPolicy(max_retries=0, status_codes=frozenset({503}))
+    proxy.fallback_chains = proxy.FallbackChains(f"{primary}>{fallback}")
+    proxy.openai_stream_adapter = proxy.OpenAIStreamAdapter(True, upstream.openai_url)
+    backend = FlakyBackend({primary: [make_upstream_error(litellm.ServiceUnavailableError, 503)]}, completion_delay=0, chunk_delay=0)
+    try:
+        async with LocalProxy(backend) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                response = await client.post("/v1/messages", json={**TEST_SCENARIOS["simple_stream"], "model": primary})
+        assert [call["model"] for call in backend.calls] == [primary], f"Calls: {backend.calls}"
+        assert proxy.openai_stream_adapter.requests == 1
+        events = collapse_text_deltas(parse_sse_events(response.text))
+        text = "".join(e["delta"]["text"] for e in events if e["type"] == "content_block_delta")
+        assert text == "".join(upstream.text_pieces(12)), f"Stream text: {text!r}"
+        delta = next(e for e in events if e["type"] == "message_delta")
+        assert delta["delta"]["stop_reason"] == "end_turn" and delta["usage"]["output_tokens"] == 12, f"Delta: {delta}"
+
+        print("\n✅ Test native_failover passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test native_failover: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+    finally:
+        proxy.retry_policy, proxy.fallback_chains, proxy.openai_stream_adapter = saved
+        await upstream.stop()
+
+async def test_offline_hedging():
+    """Late small model calls are raced against a hedged duplicate, with delays from latency histograms."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: hedging {'='*20}")
+    try:
+        import server as proxy
+
+        histogram = proxy.LatencyHistogram(window=100)
+        for i in range(100):
+            histogram.observe(0.1 if i < 90 else 2.0)
+        assert 0.1 <= histogram.percentile(50) < 0.125, f"p50: {histogram.percentile(50)}"
+        assert 2.0 <= histogram.percentile(95) < 2.5, f"p95: {histogram.percentile(95)}"
+        for _ in range(100):
+            histogram.observe(0.1)
+        assert histogram.total < 200, "Histogram didn't decay"
+        latency = proxy.UpstreamLatency(percentile=50, default_delay=1.5, min_delay=0.2, min_samples=10)
+        assert latency.hedge_delay("openai/gpt-4.1-mini") == 1.5
+        for _ in range(10):
+            latency.observe("openai/gpt-4.1-mini", 0.01)
+        assert latency.hedge_delay("openai/gpt-4.1-mini") == 0.2, "Hedge delay below the minimum"
+
+        small = proxy.model_router.small_target
+        small_request = {**TEST_SCENARIOS["simple"], "model": "claude-3-haiku-20240307"}
+        saved = (proxy.HEDGE_REQUESTS, proxy.upstream_latency, proxy.admission_scheduler)
+        proxy.HEDGE_REQUESTS = True
+        proxy.upstream_latency = proxy.UpstreamLatency(default_delay=0.1, min_samples=1000)
+        proxy.admission_scheduler = proxy.AdmissionScheduler({"openai": {"max_concurrency": 10}})
+        backend = FlakyBackend({}, completion_delay=0.15, chunk_delay=0.005)
+        try:
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    # A stalled small model call is answered by its hedge
+                    backend.failures = {small: ["slow"]}
+                    start = time.monotonic()
+                    response = await client.post("/v1/messages", json=small_request)
+                    assert response.status_code == 200 and time.monotonic() - start < 0.8, "Hedge didn't win"
+                    assert [call["model"] for call in backend.calls] == [small, small], f"Calls: {backend.calls}"
+
+                    # Streams too, before their first chunk
+                    backend.failures = {small: ["slow"]}
+                    start = time.monotonic()
+                    response = await client.post("/v1/messages", json={**small_request, "stream": True})
+                    events = collapse_text_deltas(parse_sse_events(response.text))
+                    text = "".join(e["delta"]["text"] for e in events if e["type"] == "content_block_delta")
+                    assert text == "".join(backend.chunks[i % len(backend.chunks)] for i in range(20)), f"Text: {text!r}"
+                    assert time.monotonic() - start < 0.8 and len(backend.calls) == 4, "Stream hedge didn't win"
+
+                    # Big model calls aren't hedged
+                    response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                    assert response.status_code == 200 and len(backend.calls) == 5, f"Calls: {len(backend.calls)}"
+            await asyncio.sleep(0.05)
+            stats = proxy.upstream_latency.stats()
+            assert (stats["hedges"], stats["hedge_wins"]) == (2, 2), f"Stats: {stats}"
+            assert stats["models"][small]["samples"] >= 2, f"Stats: {stats}"
+            assert proxy.admission_scheduler.stats()["openai"]["active"] == 0, "Hedged calls kept their slots"
+        finally:
+            proxy.HEDGE_REQUESTS, proxy.upstream_latency, proxy.admission_scheduler = saved
+
+        print("\n✅ Test hedging passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test hedging: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_circuit_breaker():
+    """Failing upstream models trip their breaker, which reroutes or fails fast, then probes recovery."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: circuit_breaker {'='*20}")
+    try:
+        import server as proxy
+        import litellm
+
+        breaker = proxy.CircuitBreaker(window=60, min_requests=4, error_rate=0.5, slow_call=1.0, open_seconds=0.05)
+        for failed in (False, False, True):
+            breaker.record(failed)
+        assert breaker.allow() and breaker.state == "closed"
+        breaker.record(False, seconds=2.0)  # Too slow, so it counts as an error
+        assert breaker.state == "open" and not breaker.allow(), f"Breaker: {breaker.stats()}"
+        await asyncio.sleep(0.06)
+        assert breaker.allow() and not breaker.allow(), "Half open breaker should allow one probe"
+        breaker.record(True)
+        assert breaker.state == "open", "Failed probe didn't reopen the breaker"
+        await asyncio.sleep(0.06)
+        assert breaker.allow()
+        breaker.record(None)  # A cancelled probe frees its place
+        assert breaker.allow()
+        breaker.record(False)
+        assert breaker.state == "closed" and breaker.stats()["calls"] == 0, f"Breaker: {breaker.stats()}"
+
+        primary, fallback = "openai/gpt-4.1", "gemini/gemini-2.0-flash"
+        saved = (proxy.circuit_breakers, proxy.fallback_chains, proxy.retry_policy)
+        proxy.circuit_breakers = proxy.CircuitBreakers(enabled=True, min_requests=2, error_rate=0.5, open_seconds=60)
+        proxy.fallback_chains = proxy.FallbackChains(f"{primary}>{fallback}")
+        proxy.retry_policy = proxy.RetryPolicy(status_codes=frozenset({503}))
+        unavailable = make_upstream_error(litellm.ServiceUnavailableError, 503)
+        invalid = make_upstream_error(litellm.BadRequestError, 400)
+        backend = FlakyBackend({primary: [invalid, unavailable, unavailable]}, completion_delay=0, chunk_delay=0)
+        try:
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    # Invalid requests don't count against the model
+                    response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                    assert response.status_code == 400
+                    states = (await client.get("/admin/circuit-breakers")).json()
+                    assert states["breakers"][primary]["failures"] == 0, f"States: {states}"
+
+                    for _ in range(2):
+                        response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                        assert response.status_code == 200 and response.json()["model"] == fallback
+                    states = (await client.get("/admin/circuit-breakers")).json()
+                    assert states["enabled"] and states["breakers"][primary]["state"] == "open", f"States: {states}"
+
+                    # An open breaker reroutes straight to the alternative
+                    del backend.calls[:]
+                    response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple"])
+                    assert response.status_code == 200 and [call["model"] for call in backend.calls] == [fallback]
+
+                    # Without one, it fails fast
+                    proxy.fallback_chains = proxy.FallbackChains()
+                    response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple_stream"])
+                    assert response.status_code == 503 and int(response.headers["retry-after"]) > 1, response.status_code
+                    assert len(backend.calls) == 1, "Open breaker still called upstream"
+        finally:
+            proxy.circuit_breakers, proxy.fallback_chains, proxy.retry_policy = saved
+
+        print("\n✅ Test circuit_breaker passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test circuit_breaker: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def parse_prometheus_text(text):
+    """Map each sample line of a Prometheus text exposition ("name{labels}") to its value."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            samples[series] = float(value)
+    return samples
+
+async def test_offline_metrics():
+    """/metrics exposes request counts and latency histograms labeled by model and provider."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: metrics {'='*20}")
+    backend = FakeBackend(completion_delay=0.02, chunk_delay=0)
+    try:
+        import server as proxy
+
+        histogram = proxy.Histogram("test_seconds", "Test.", ("model",), buckets=(0.1, 1))
+        histogram.observe(('say "hi"\n',), 0.05)
+        histogram.observe(('say "hi"\n',), 5)
+        samples = parse_prometheus_text(proxy.MetricsRegistry().render() + "\n".join(histogram.samples()))
+        labels = 'model="say \\"hi\\"\\n"'
+        assert samples[f'test_seconds_bucket{{{labels},le="0.1"}}'] == 1, f"Samples: {samples}"
+        assert samples[f'test_seconds_bucket{{{labels},le="+Inf"}}'] == 2
+        assert samples[f"test_seconds_sum{{{labels}}}"] == 5.05 and samples[f"test_seconds_count{{{labels}}}"] == 2
+
+        # A model name no other test uses, so the counts below are exact
+        original = "claude-3-sonnet-metrics"
+        data = {**TEST_SCENARIOS["simple"], "model": original}
+        async with LocalProxy(backend) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                assert (await client.post("/v1/messages", json=data)).status_code == 200
+                assert (await client.post("/v1/messages", json={**data, "stream": True})).status_code == 200
+                count_data = {"model": original, "messages": data["messages"]}
+                assert (await client.post("/v1/messages/count_tokens", json=count_data)).status_code == 200
+                response = await client.get("/metrics")
+        assert response.headers["content-type"].startswith("text/plain"), response.headers["content-type"]
+        samples = parse_prometheus_text(response.text)
+
+        labels = f'original_model="{original}",mapped_model="openai/gpt-4.1",provider="openai"'
+        expected = {
+            f'proxy_requests_total{{route="messages",{labels},status="200"}}': 2,
+            f'proxy_requests_total{{route="count_tokens",{labels},status="200"}}': 1,
+            f'proxy_request_duration_seconds_count{{route="messages",{labels}}}': 2,
+            f"proxy_upstream_first_byte_seconds_count{{{labels}}}": 2,
+            f"proxy_first_sse_byte_seconds_count{{{labels}}}": 1,
+            f"proxy_stream_duration_seconds_count{{{labels}}}": 1,
+            f'proxy_translation_seconds_count{{direction="request",{labels}}}': 2,
+            f'proxy_translation_seconds_count{{direction="response",{labels}}}': 1,
+            f"proxy_output_tokens_per_second_count{{{labels}}}": 1,
+            f"proxy_streams_in_flight{{{labels}}}": 0,
+        }
+        for series, value in expected.items():
+            assert samples.get(series) == value, f"{series} = {samples.get(series)}, expected {value}"
+        assert samples[f"proxy_upstream_first_byte_seconds_sum{{{labels}}}"] >= 0.02, "Upstream time not measured"
+        assert "proxy_single_flight_joined_total" in samples and "proxy_upstream_retries_total" in samples
+
+        print("\n✅ Test metrics passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test metrics: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_tracing():
+    """With tracing on, each stage gets a span, and the client's trace is continued through to the upstream call."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: tracing {'='*20}")
+    backend = FakeBackend(completion_delay=0, chunk_delay=0)
+    try:
+        import server as proxy
+        import tempfile
+
+        trace_id, client_span_id = "ab" * 16, "cd" * 8
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "traces.jsonl")
+            saved = proxy.tracing
+            proxy.tracing = proxy.Tracing("file", path)
+            try:
+                async with LocalProxy(backend) as local:
+                    async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                        headers = {"traceparent": f"00-{trace_id}-{client_span_id}-01"}
+                        response = await client.post("/v1/messages", json=TEST_SCENARIOS["calculator"], headers=headers)
+                        assert response.status_code == 200, response.text
+                        response = await client.post("/v1/messages", json=TEST_SCENARIOS["simple_stream"])
+                        assert response.status_code == 200 and "message_stop" in response.text
+                        count_data = {"model": MODEL, "messages": TEST_SCENARIOS["simple"]["messages"]}
+                        assert (await client.post("/v1/messages/count_tokens", json=count_data)).status_code == 200
+                # Spans are exported when the app shuts down
+                with open(path, encoding="utf-8") as f:
+                    spans = [json.loads(line) for line in f]
+            finally:
+                proxy.tracing.shutdown()
+                proxy.tracing = saved
+
+        def children(parent):
+            return {span["name"]: span for span in spans if span["parent_id"] == parent["context"]["span_id"]}
+
+        requests = [span for span in spans if span["name"] == "POST /v1/messages"]
+        assert len(requests) == 2, f"Spans: {[span['name'] for span in spans]}"
+        completion = next(span for span in requests if not span["attributes"]["proxy.stream"])
+        assert completion["context"]["trace_id"] == f"0x{trace_id}" and completion["parent_id"] == f"0x{client_span_id}"
+        assert completion["kind"] == "SpanKind.SERVER"
+        attributes = completion["attributes"]
+        assert attributes["proxy.messages"] == 1 and attributes["proxy.tools"] == 1, f"Attributes: {attributes}"
+        assert attributes["gen_ai.usage.input_tokens"] == 10 and attributes["gen_ai.usage.output_tokens"] == 5
+        stages = children(completion)
+        assert set(stages) == {"validate_request", "translate_request", "upstream", "translate_response"}, f"Stages: {list(stages)}"
+        assert "translate_messages" in children(stages["translate_request"])
+        assert children(stages["translate_request"])["translate_messages"]["attributes"]["proxy.flavor"] == "openai"
+        # The upstream call carries the upstream span as its parent
+        upstream_id = stages["upstream"]["context"]["span_id"][2:]
+        assert backend.calls[0]["extra_headers"]["traceparent"] == f"00-{trace_id}-{upstream_id}-01", backend.calls[0]["extra_headers"]
+
+        stream = next(span for span in requests if span["attributes"]["proxy.stream"])
+        assert stream["context"]["trace_id"] != f"0x{trace_id}" and stream["parent_id"] is None
+        streaming = children(stream)["handle_streaming"]
+        assert streaming["attributes"]["proxy.upstream_chunks"] == 21 and streaming["attributes"]["proxy.sse_frames"] > 0
+        assert streaming["attributes"]["proxy.encode_seconds"] > 0, f"Attributes: {streaming['attributes']}"
+        assert stream["end_time"] >= streaming["end_time"], "Request span ended before its stream"
+
+        count = next(span for span in spans if span["name"] == "POST /v1/messages/count_tokens")
+        assert count["attributes"]["gen_ai.usage.input_tokens"] > 0 and "validate_request" in children(count)
+
+        print("\n✅ Test tracing passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test tracing: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_logging():
+    """Log records are queued unformatted, filtered in one pass, and can be written as JSON."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: logging {'='*20}")
+    try:
+        import server as proxy
+        import logging
+        import queue
+
+        class Formatted:
+            calls = 0
+            def __str__(self):
+                Formatted.calls += 1
+                return "formatted"
+
+        # Below the level, arguments are never formatted
+        argument = Formatted()
+        proxy.logger.debug("Request: %s", argument)
+        assert Formatted.calls == 0, "Disabled debug record was formatted"
+
+        # The queue handler leaves formatting to the writer, and drops records when full
+        handler = proxy.LogQueueHandler(queue.Queue(1))
+        for _ in range(2):
+            handler.handle(proxy.logger.makeRecord("server", logging.WARNING, __file__, 0, "Arg: %s", (argument,), None))
+        assert handler.dropped == 1 and Formatted.calls == 0, f"Dropped {handler.dropped}, formatted {Formatted.calls} times"
+        record = handler.queue.get_nowait()
+        assert record.getMessage() == "Arg: formatted"
+
+        blocked = logging.makeLogRecord({"msg": 'HTTP Request: %s %s "%s"', "args": ("POST", "http://x", "200")})
+        allowed = logging.makeLogRecord({"msg": "Upstream %s failed", "args": ("openai/gpt-4.1",)})
+        assert not proxy.MessageFilter().filter(blocked) and proxy.MessageFilter().filter(allowed)
+
+        # Debug records whose message isn't a string still format
+        formatter = proxy.ColorizedFormatter("%(message)s")
+        assert formatter.format(logging.makeLogRecord({"levelno": logging.DEBUG, "msg": {"model": "gpt-4.1"}})) == "{'model': 'gpt-4.1'}"
+        assert formatter.format(logging.makeLogRecord({"levelno": logging.DEBUG, "msg": ValueError("boom")})) == "boom"
+        mapping = logging.makeLogRecord({"levelno": logging.DEBUG, "msg": "📌 MODEL MAPPING: '%s'", "args": ("haiku",)})
+        assert formatter.format(mapping) == f"{formatter.BOLD}{formatter.GREEN}📌 MODEL MAPPING: 'haiku'{formatter.RESET}"
+
+        # Request summaries carry their fields, for the colored lines or JSON
+        records = []
+        capture = logging.Handler()
+        capture.emit = records.append
+        proxy.request_logger.addHandler(capture)
+        try:
+            proxy.log_request_beautifully("POST", "/v1/messages?beta=true", "claude-3-haiku", "openai/gpt-4.1-mini", 3, 2, 200)
+        finally:
+            proxy.request_logger.removeHandler(capture)
+        entry = json.loads(proxy.JSONFormatter().format(records[0]))
+        assert entry["mapped_model"] == "openai/gpt-4.1-mini" and entry["tools"] == 2 and entry["status_code"] == 200, entry
+        lines = proxy.RequestLineFormatter().format(records[0]).split("\n")
+        assert len(lines) == 2 and "beta" not in lines[0] and "gpt-4.1-mini" in lines[1] and "openai/" not in lines[1], lines
+
+        print("\n✅ Test logging passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test logging: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_mock_upstream():
+    """loadgen's mock upstream speaks the OpenAI and Gemini APIs well enough for LiteLLM, streamed or not."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: mock_upstream {'='*20}")
+    try:
+        import litellm
+        from loadgen import MockUpstream, MockSettings
+
+        upstream = MockUpstream(MockSettings(output_tokens=12, chunk_tokens=5, first_token_ms=0, tool_share=1.0))
+        await upstream.start()
+        try:
+            tools = [{"type": "function", "function": {
+                "name": "search_files", "description": "Search",
+                "parameters": {"type": "object", "properties": {"query": {"type": "string"}}},
+            }}]
+            targets = (
+                ("openai/gpt-4.1", upstream.openai_url),
+                ("gemini/gemini-2.0-flash", upstream.gemini_url),
+            )
+            for model, api_base in targets:
+                request = dict(model=model, api_base=api_base, api_key="mock", max_tokens=100, tools=tools,
+                               messages=[{"role": "user", "content": "hi"}])
+                response = await litellm.acompletion(**request)
+                message = response.choices[0].message
+                assert len(message.content.split()) == 12, f"{model}: {message.content!r}"
+                assert message.tool_calls[0].function.name == "search_files", f"{model}: {message.tool_calls}"
+                assert response.usage.completion_tokens == 12
+
+                text, tool_names = "", []
+                async for chunk in await litellm.acompletion(**request, stream=True):
+                    delta = chunk.choices[0].delta if chunk.choices else None
+                    if delta is not None and delta.content:
+                        text += delta.content
+                    if delta is not None and delta.tool_calls:
+                        tool_names += [call.function.name for call in delta.tool_calls if call.function.name]
+                assert len(text.split()) == 12 and tool_names == ["search_files"], f"{model}: {text!r} {tool_names}"
+
+            # Injected errors come back as provider errors
+            upstream.settings.error_rate = 1.0
+            try:
+                await litellm.acompletion(model="openai/gpt-4.1", api_base=upstream.openai_url, api_key="mock",
+                                          messages=[{"role": "user", "content": "hi"}], max_retries=0)
+                raise AssertionError("Injected error wasn't raised")
+            except litellm.ServiceUnavailableError:
+                pass
+        finally:
+            await upstream.stop()
+
+        print("\n✅ Test mock_upstream passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test mock_upstream: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+async def test_offline_shared_store():
+    """The shared store backends agree, and workers on one store share rate limits, cached responses and metrics."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: shared_store {'='*20}")
+    try:
+        import shutil
+        import tempfile
+        import threading
+        import server as proxy
+        from loadgen import MockRedis, free_port
+
+        redis = MockRedis()
+        redis.start()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "test.store")
+        try:
+            stores = [
+                proxy.MemorySharedStore(),
+                proxy.SharedMemoryStore(path, slots=64, slot_size=2048),
+                proxy.RedisSharedStore(redis.url, prefix="test:"),
+            ]
+            for store in stores:
+                name = type(store).__name__
+                assert store.get("greeting") is None
+                assert store.set("greeting", b"hello", ttl=0.2) and store.get("greeting") == b"hello", name
+                assert store.incr("count", 2, ttl=10) == 2 and store.incr("count", 0.5) == 2.5, name
+                assert sorted(store.keys("")) == ["count", "greeting"], f"{name}: {store.keys('')}"
+                store.delete("count")
+                assert store.get("count") is None, name
+                time.sleep(0.25)
+                assert store.get("greeting") is None, f"{name}: didn't expire"
+            assert not stores[1].set("large", b"x" * 4096), "A value larger than a slot was stored"
+
+            # Two workers: separate mappings of the same file
+            first, second = stores[1], proxy.SharedMemoryStore(path, slots=64, slot_size=2048)
+            limiters = [proxy.ProviderLimiter("openai", rpm=2, store=store) for store in (first, second)]
+            assert isinstance(limiters[0].requests, proxy.SharedTokenBucket)
+            await limiters[0].acquire()
+            await limiters[1].acquire()
+            assert limiters[0].requests.delay(1) > 0 and limiters[1].requests.delay(1) > 0, "RPM wasn't shared"
+            unshared = proxy.ProviderLimiter("openai", rpm=2, store=stores[0])
+            assert isinstance(unshared.requests, proxy.TokenBucket)
+
+            # Workers admitting at once can't overshoot the shared limit
+            from concurrent.futures import ThreadPoolExecutor
+            bucket = proxy.SharedTokenBucket(first, "limit:race", 5)
+            with ThreadPoolExecutor(8) as pool:
+                taken = list(pool.map(lambda _: bucket.try_take(1) == 0, range(40)))
+            assert sum(taken) == 5, f"Admitted {sum(taken)} of a limit of 5"
+
+            # A blocking store is only called off the event loop
+            redis_limiter = proxy.ProviderLimiter("openai", rpm=1, queue_timeout=0.05, store=stores[2])
+            store_threads = []
+            incr = stores[2].incr
+            def recording_incr(*args, **kwargs):
+                store_threads.append(threading.current_thread())
+                return incr(*args, **kwargs)
+            stores[2].incr = recording_incr
+            await redis_limiter.acquire()
+            try:
+                await redis_limiter.acquire()
+                assert False, "Admitted over the shared RPM"
+            except proxy.AdmissionRejected as e:
+                assert e.retry_after > 1, f"Retry after: {e.retry_after}"
+            assert store_threads and threading.main_thread() not in store_threads, "The store was called on the event loop"
+
+            record = {"content": "cached", "finish_reason": "stop"}
+            await proxy.ResponseCache(proxy.SharedResponseStore(first, ttl=60, max_bytes=1024)).put("key", record)
+            assert await proxy.ResponseCache(proxy.SharedResponseStore(second, ttl=60, max_bytes=1024)).get("key") == record
+
+            # A blocking store's entries are counted in a thread, and not again until COUNT_SECONDS pass
+            redis_responses = proxy.SharedResponseStore(stores[2], ttl=60, max_bytes=1024)
+            redis_responses.put("key", b"{}")
+            assert len(redis_responses) == 0, "Counted on the event loop"
+            for _ in range(100):
+                if not redis_responses.counting:
+                    break
+                time.sleep(0.01)
+            redis_responses.put("other", b"{}")
+            assert len(redis_responses) == 1 and not redis_responses.counting, "Counted again within COUNT_SECONDS"
+            second.close()
+
+            # Scrapes add up every worker's counters and histograms
+            snapshots = []
+            for requests, state in ((3, 0), (4, 1)):
+                registry = proxy.MetricsRegistry()
+                registry.add(proxy.Counter("test_requests_total", "Test.", ("model",))).inc(("m",), requests)
+                registry.add(proxy.Histogram("test_seconds", "Test.", buckets=(1,))).observe((), requests)
+                registry.add(proxy.Gauge("test_state", "Test.", merge="max")).set((), state)
+                snapshots.append(registry.snapshot())
+            samples = parse_prometheus_text(proxy.MetricsRegistry().render(proxy.MetricsRegistry.merge(snapshots)))
+            assert samples['test_requests_total{model="m"}'] == 7, f"Samples: {samples}"
+            assert samples["test_seconds_count"] == 2 and samples["test_seconds_sum"] == 7
+            assert samples["test_state"] == 1
+
+            # An unreachable Redis reads as empty rather than failing requests
+            missing = proxy.RedisSharedStore(f"redis://127.0.0.1:{free_port()}/0", timeout=0.5)
+            assert missing.get("key") is None and missing.incr("key", 1, ttl=10) == 1 and not missing.set("key", b"v")
+        finally:
+            redis.stop()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        print("\n✅ Test shared_store passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test shared_store: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+class EndlessBackend:
+    """Streams chunks until it's closed, recording when it was. With finish_after, a stream ends with usage after that many chunks."""
+
+    def __init__(self, chunk_delay=0.01, content="tok ", finish_after=None):
+        self.chunk_delay = chunk_delay
+        self.content = content
+        self.finish_after = finish_after
+        self.sent = 0
+        self.closed = []
+
+    async def acompletion(self, **kwargs):
+        return self._stream()
+
+    def completion(self, **kwargs):
+        raise AssertionError("Blocking completion called")
+
+    async def _stream(self):
+        try:
+            index = 0
+            while self.finish_after is None or index < self.finish_after:
+                await asyncio.sleep(self.chunk_delay)
+                self.sent += 1
+                index += 1
+                yield make_fake_chunk(content=self.content)
+            yield make_fake_chunk(finish_reason="stop", usage=SimpleNamespace(prompt_tokens=10, completion_tokens=index))
+        finally:
+            self.closed.append(time.monotonic())
+
+async def test_offline_stream_cancellation():
+    """A stream whose client disconnects or falls behind is closed upstream at once, and counted."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: stream_cancellation {'='*20}")
+    import server as proxy
+    settings = (proxy.STREAM_BUFFER_FRAMES, proxy.STREAM_BUFFER_POLICY, proxy.STREAM_SLOW_CLIENT_TIMEOUT_SECONDS)
+    try:
+        # A model name no other test uses, so the counts below are exact
+        original = "claude-3-sonnet-cancellation"
+        data = {**TEST_SCENARIOS["simple"], "model": original, "stream": True}
+        labels = f'original_model="{original}",mapped_model="openai/gpt-4.1",provider="openai"'
+
+        # A finished stream sets the expected length, 40 chunks of one token each
+        async with LocalProxy(EndlessBackend(chunk_delay=0, finish_after=40)) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                assert (await client.post("/v1/messages", json=data)).status_code == 200
+
+        backend = EndlessBackend(chunk_delay=0.01)
+        async with LocalProxy(backend) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                async with client.stream("POST", "/v1/messages", json=data) as response:
+                    frames = response.aiter_raw()
+                    await frames.__anext__()
+                    while backend.sent < 10:
+                        await asyncio.sleep(0.01)
+                    await frames.aclose()
+                disconnected = time.monotonic()
+                for _ in range(100):
+                    if backend.closed:
+                        break
+                    await asyncio.sleep(0.01)
+                assert backend.closed, "The upstream stream wasn't closed after the client disconnected"
+                assert backend.closed[0] - disconnected < 0.5, f"Closed after {backend.closed[0] - disconnected:.2f}s"
+                samples = parse_prometheus_text((await client.get("/metrics")).text)
+        assert samples[f'proxy_streams_cancelled_total{{{labels},reason="client_disconnect"}}'] == 1, f"Samples: {samples}"
+        avoided = samples[f"proxy_stream_tokens_avoided_total{{{labels}}}"]
+        assert 0 < avoided < 40, f"Tokens avoided: {avoided}"
+        assert samples[f"proxy_streams_in_flight{{{labels}}}"] == 0
+
+        # A client that stops reading fills the buffer, and is cut off under the disconnect policy
+        proxy.STREAM_BUFFER_FRAMES, proxy.STREAM_BUFFER_POLICY, proxy.STREAM_SLOW_CLIENT_TIMEOUT_SECONDS = 4, "disconnect", 0.2
+        backend = EndlessBackend(chunk_delay=0, content="x" * 10000)
+        async with LocalProxy(backend) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                async with client.stream("POST", "/v1/messages", json=data) as response:
+                    frames = response.aiter_raw()
+                    await frames.__anext__()
+                    for _ in range(200):
+                        if backend.closed:
+                            break
+                        await asyncio.sleep(0.01)
+                    assert backend.closed, "The upstream stream wasn't closed for a stalled client"
+                    await frames.aclose()
+                samples = parse_prometheus_text((await client.get("/metrics")).text)
+        assert samples[f'proxy_streams_cancelled_total{{{labels},reason="slow_client"}}'] == 1, f"Samples: {samples}"
+        assert samples[f"proxy_stream_buffer_full_total{{{labels}}}"] >= 1
+
+        print("\n✅ Test stream_cancellation passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test stream_cancellation: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+    finally:
+        proxy.STREAM_BUFFER_FRAMES, proxy.STREAM_BUFFER_POLICY, proxy.STREAM_SLOW_CLIENT_TIMEOUT_SECONDS = settings
+
+async def test_offline_anthropic_passthrough():
+    """anthropic/ models go to the Anthropic API with the client's body, and its SSE comes back byte for byte."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: anthropic_passthrough {'='*20}")
+    import server as proxy
+    from loadgen import MockUpstream, MockSettings
+    saved = proxy.anthropic_passthrough
+    upstream = MockUpstream(MockSettings(output_tokens=12, chunk_tokens=5, first_token_ms=0, tool_share=1.0))
+    await upstream.start()
+    try:
+        proxy.anthropic_passthrough = proxy.AnthropicPassthrough(True, upstream.anthropic_url, "sk-ant-offline")
+        model = "claude-opus-4-1-20250805"
+        labels = f'original_model="anthropic/{model}",mapped_model="anthropic/{model}",provider="anthropic"'
+        data = {
+            **TEST_SCENARIOS["calculator"],
+            "model": f"anthropic/{model}",
+            # Fields the proxy's request model doesn't know are forwarded too
+            "system": [{"type": "text", "text": "Be brief.", "cache_control": {"type": "ephemeral"}}],
+        }
+        tool_name = data["tools"][0]["name"]
+        backend = FakeBackend(completion_delay=0)
+        async with LocalProxy(backend) as local:
+            headers = {"anthropic-beta": "prompt-caching-2024-07-31"}
+            async with httpx.AsyncClient(base_url=local.url, timeout=30, headers=headers) as client:
+                response = await client.post("/v1/messages", json={**data, "stream": True})
+                assert response.status_code == 200, f"Stream failed: {response.text}"
+                sent = upstream.last_body
+                assert sent["model"] == model and sent["system"] == data["system"] and "original_model" not in sent, f"Body: {sent}"
+                assert upstream.last_headers["x-api-key"] == "sk-ant-offline"
+                assert upstream.last_headers["anthropic-beta"] == "prompt-caching-2024-07-31"
+                prompt_tokens = len(json.dumps(sent["messages"])) // 4
+                expected = "".join(upstream.anthropic_stream(model, tool_name, prompt_tokens, 12))
+                assert response.text == expected, f"Relayed stream differs:\n{response.text}"
+
+                response = await client.post("/v1/messages", json=data)
+                assert response.status_code == 200, f"Request failed: {response.text}"
+                message = response.json()
+                assert message == upstream.anthropic_response(model, message["content"][0]["text"], tool_name, prompt_tokens, 12)
+                assert message["usage"]["cache_read_input_tokens"] == prompt_tokens // 2
+                assert not backend.calls, "LiteLLM was called for a passthrough request"
+
+                samples = parse_prometheus_text((await client.get("/metrics")).text)
+                assert samples[f'proxy_passthrough_tokens_total{{{labels},type="cache_read_input"}}'] == 2 * (prompt_tokens // 2)
+                assert samples[f'proxy_passthrough_tokens_total{{{labels},type="output"}}'] == 24, f"Samples: {samples}"
+
+                # Upstream errors keep their status
+                upstream.settings.error_rate, upstream.settings.error_status = 1.0, 529
+                response = await client.post("/v1/messages", json=data)
+                assert response.status_code == 529, f"Status: {response.status_code}"
+        assert "anthropic" not in proxy.upstream_clients.http_clients, "The passthrough client wasn't closed at shutdown"
+
+        # The passthrough also serves requests that fail over to it from another provider
+        import litellm
+        upstream.settings.error_rate = 0.0
+        primary = "openai/gpt-4.1"
+        saved_policy = (proxy.retry_policy, proxy.fallback_chains, proxy.response_cache)
+        proxy.retry_policy = proxy.RetryPolicy(max_retries=0, status_codes=frozenset({503}))
+        proxy.response_cache = proxy.ResponseCache(proxy.MemoryResponseStore(ttl=60, max_entries=10, max_bytes=1 << 20))
+        proxy.fallback_chains = proxy.FallbackChains(f"{primary}>anthropic/{model}")
+        backend = FlakyBackend({}, completion_delay=0, chunk_delay=0)
+        try:
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    backend.failures = {primary: [make_upstream_error(litellm.ServiceUnavailableError, 503)]}
+                    response = await client.post("/v1/messages", json={**data, "model": primary, "stream": True})
+                    assert [call["model"] for call in backend.calls] == [primary], f"Calls: {backend.calls}"
+                    assert upstream.last_body["model"] == model
+                    assert response.text == expected, f"Failed over stream differs:\n{response.text}"
+
+                    # Nor is a failed over response cached as an empty record
+                    deterministic = {**data, "model": primary, "temperature": 0}
+                    for _ in range(2):
+                        backend.failures = {primary: [make_upstream_error(litellm.ServiceUnavailableError, 503)]}
+                        response = await client.post("/v1/messages", json=deterministic)
+                        assert response.status_code == 200 and response.json()["content"], f"Response: {response.text}"
+                    assert proxy.response_cache.stats()["entries"] == 0, f"Cache: {proxy.response_cache.stats()}"
+        finally:
+            proxy.retry_policy, proxy.fallback_chains, proxy.response_cache = saved_policy
+
+        # Usage is read from frames split anywhere across chunks
+        stream = expected.encode("utf-8")
+        usage = proxy.SSEUsage()
+        for start in range(0, len(stream), 7):
+            usage.feed(stream[start:start + 7])
+        assert usage.tokens == upstream.anthropic_usage(prompt_tokens, 12), f"Usage: {usage.tokens}"
+
+        print("\n✅ Test anthropic_passthrough passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test anthropic_passthrough: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+    finally:
+        proxy.anthropic_passthrough = saved
+        await upstream.stop()
+
+async def test_offline_openai_native_streaming():
+    """openai/ streams read by the native adapter give the same Anthropic events as through LiteLLM."""
+    print(f"\n{'='*20} RUNNING OFFLINE TEST: openai_native_streaming {'='*20}")
+    import server as proxy
+    import litellm
+    from loadgen import MockUpstream, MockSettings
+    saved = proxy.openai_stream_adapter, proxy.OPENAI_API_KEY
+    upstream = MockUpstream(MockSettings(output_tokens=12, chunk_tokens=5, first_token_ms=0, tool_share=1.0))
+    await upstream.start()
+
+    litellm_acompletion = litellm.acompletion
+    async def acompletion(**kwargs):
+        # LiteLLM itself, pointed at the mock upstream
+        kwargs.pop("client", None)
+        return await litellm_acompletion(**kwargs, api_base=upstream.openai_url)
+    backend = SimpleNamespace(acompletion=acompletion, completion=None)
+    try:
+        proxy.OPENAI_API_KEY = "sk-offline"
+        data = {**TEST_SCENARIOS["calculator"], "model": "claude-3-sonnet-native-stream", "stream": True}
+        streams = {}
+        for native in (False, True):
+            proxy.openai_stream_adapter = proxy.OpenAIStreamAdapter(native, upstream.openai_url)
+            async with LocalProxy(backend) as local:
+                async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                    response = await client.post("/v1/messages", json=data)
+                    assert response.status_code == 200, f"Stream failed: {response.text}"
+                    streams[native] = parse_sse_events(response.text)
+        assert proxy.openai_stream_adapter.requests == 1
+        assert upstream.last_body["stream_options"] == {"include_usage": True} and "top_k" not in upstream.last_body
+        assert upstream.last_headers["authorization"] == "Bearer sk-offline"
+
+        # The trailing usage chunk counts, which handle_streaming stops before
+        native_delta = next(event for event in streams[True] if event["type"] == "message_delta")
+        assert native_delta["usage"]["output_tokens"] == 12, f"Delta: {native_delta}"
+        assert native_delta["delta"]["stop_reason"] == "tool_use"
+        without_usage = lambda events: [event for event in normalize_stream_events(events) if event["type"] != "message_delta"]
+        assert without_usage(streams[True]) == without_usage(streams[False]), (
+            f"Native stream differs:\n{streams[True]}\nLiteLLM stream:\n{streams[False]}"
+        )
+
+        # Upstream errors keep their status
+        upstream.settings.error_rate, upstream.settings.error_status = 1.0, 429
+        async with LocalProxy(backend) as local:
+            async with httpx.AsyncClient(base_url=local.url, timeout=30) as client:
+                response = await client.post("/v1/messages", json=data)
+                assert response.status_code == 429, f"Status: {response.status_code}"
+
+        # Reasoning models are left to LiteLLM, which rewrites their parameters
+        adapter = proxy.OpenAIStreamAdapter(True, upstream.openai_url)
+        reasoning = proxy.MessagesRequest.model_validate({**data, "model": "o3-mini"})
+        assert reasoning.model == "openai/o3-mini" and not adapter.handles(reasoning)
+        # and Anthropic's "any" tool_choice is sent as OpenAI's "required"
+        forced = proxy.MessagesRequest.model_validate({**data, "model": "gpt-4.1", "tool_choice": {"type": "any"}})
+        assert adapter.handles(forced)
+        body = adapter.body(proxy.build_litellm_request(forced))
+        assert body["tool_choice"] == "required" and body["model"] == "gpt-4.1", f"Body: {body}"
+
+        # data: lines are decoded however the bytes are split
+        events = [{"choices": [{"index": 0, "delta": {"content": f"word {i} "}, "finish_reason": None}]} for i in range(5)]
+        body = "".join(f"data: {json.dumps(event)}\n\n" for event in events).encode() + b": keep-alive\n\ndata: [DONE]\n\n"
+        async def pieces():
+            for start in range(0, len(body), 7):
+                yield body[start:start + 7]
+        decoded = [event async for event in proxy.OpenAIStreamAdapter.events(httpx.Response(200, content=pieces()))]
+        assert decoded == events, f"Decoded: {decoded}"
+
+        print("\n✅ Test openai_native_streaming passed!")
+        return True
+    except Exception as e:
+        print(f"\n❌ Error in test openai_native_streaming: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+    finally:
+        proxy.openai_stream_adapter, proxy.OPENAI_API_KEY = saved
+        await upstream.stop()
+
+OFFLINE_TESTS = [
+    test_offline_nonstreaming_does_not_block_streams,
+    test_offline_request_parsing,
+    test_offline_sse_encoding,
+    test_offline_delta_coalescing,
+    test_offline_model_routing,
+    test_offline_tool_cache,
+    test_offline_conversation_cache,
+    test_offline_golden_translation,
+    test_offline_native_tool_calls,
+    test_offline_upstream_clients,
+    test_offline_token_counting,
+    test_offline_response_cache,
+    test_offline_single_flight,
+    test_offline_admission_control,
+    test_offline_retry_failover,
+    test_offline_native_failover,
+    test_offline_hedging,
+    test_offline_circuit_breaker,
+    test_offline_metrics,
+    test_offline_tracing,
+    test_offline_logging,
+    test_offline_mock_upstream,
+    test_offline_shared_store,
+    test_offline_stream_cancellation,
+    test_offline_anthropic_passthrough,
+    test_offline_openai_native_streaming,
+]
+
+async def run_offline_tests():
+    """Run all offline tests and return True if they all pass."""
+    results = {}
+    for test in OFFLINE_TESTS:
+        results[test.__name__] = await test()
+
+    print("\n\n=========== OFFLINE TEST SUMMARY ===========\n")
+    passed = sum(1 for v in results.values() if v)
+    for test, result in results.items():
+        print(f"{test}: {'✅ PASS' if result else '❌ FAIL'}")
+    print(f"\nTotal: {passed}/{len(results)} tests passed")
+    return passed == len(results)
+
 # ================= MAIN =================
 
 async def run_tests(args):
@@ -695,18 +2680,24 @@ async def run_tests(args):
         return False
 
 async def main():
-    # Check that API key is set
-    if not ANTHROPIC_API_KEY:
-        print("Error: ANTHROPIC_API_KEY not set in .env file")
-        return
-    
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Test the Claude-on-OpenAI proxy")
     parser.add_argument("--no-streaming", action="store_true", help="Skip streaming tests")
     parser.add_argument("--streaming-only", action="store_true", help="Only run streaming tests")
     parser.add_argument("--simple", action="store_true", help="Only run simple tests (no tools)")
     parser.add_argument("--tools-only", action="store_true", help="Only run tool tests")
+    parser.add_argument("--offline", action="store_true", help="Only run offline tests against a fake backend")
     args = parser.parse_args()
+
+    # Offline tests don't talk to any real API
+    if args.offline:
+        success = await run_offline_tests()
+        sys.exit(0 if success else 1)
+
+    # Check that API key is set
+    if not ANTHROPIC_API_KEY:
+        print("Error: ANTHROPIC_API_KEY not set in .env file")
+        return
     
     # Run tests
     success = await run_tests(args)